@@ -1,12 +1,15 @@
-from ComplexPrepCubes import utils
+from ComplexPrepCubes import utils, solvation
 from OpenMMCubes import utils as pack_utils
+from OpenMMCubes import compression, profiling
 from floe.api import (OEMolComputeCube, ParallelOEMolComputeCube, parameter, MoleculeInputPort)
 from openeye import oechem
 import traceback
 from simtk import unit
 from simtk.openmm import app
+from OpenMMCubes.spatial import atom_coords
 from oeommtools import utils as oeommutils
 from oeommtools.packmol import oesolvate
+import numpy as np
 import parmed
 
 
@@ -49,24 +52,39 @@ class HydrationCube(ParallelOEMolComputeCube):
         default=True,
         help_text="If Checked/True the molecule before solvation is attached to the solvated one")
 
+    solvation_engine = parameter.StringParameter(
+        'solvation_engine',
+        default='PDBFixer',
+        choices=['PDBFixer', 'Tiling'],
+        help_text="""Solvation engine. PDBFixer adds the solvent by using the OpenMM Modeller,
+        Tiling fills the box with copies of a pre-equilibrated TIP3P water box""")
+
     def begin(self):
         self.opt = vars(self.args)
         self.opt['Logger'] = self.log
+        self.profiler = profiling.Profiler(self.name)
 
     def process(self, system, port):
 
         try:
+            self.profiler.start(system.GetTitle())
             # Solvate the system
-            sol_system = utils.hydrate(system, self.opt)
+            with self.profiler.phase('hydrate'):
+                if self.opt['solvation_engine'] == 'Tiling':
+                    sol_system = solvation.tile_hydrate(system, self.opt)
+                else:
+                    sol_system = utils.hydrate(system, self.opt)
             sol_system.SetTitle(system.GetTitle())
             # Attached the original system to the solvated one
             if self.opt['ref_structure']:
                 sol_system.SetData(oechem.OEGetTag("RefStructure"), system)
+            self.profiler.finish(sol_system)
             self.success.emit(sol_system)
         except Exception as e:
             # Attach error message to the molecule that failed
             self.log.error(traceback.format_exc())
             system.SetData('error', str(e))
+            self.profiler.finish(system)
             # Return failed mol
             self.failure.emit(system)
 
@@ -158,10 +176,12 @@ class SolvationCube(ParallelOEMolComputeCube):
     def begin(self):
         self.opt = vars(self.args)
         self.opt['Logger'] = self.log
+        self.profiler = profiling.Profiler(self.name)
 
     def process(self, solute, port):
 
         try:
+            self.profiler.start(solute.GetTitle())
             opt = dict(self.opt)
             # Update cube simulation parameters with the eventually molecule SD tags
             new_args = {dp.GetTag(): dp.GetValue() for dp in oechem.OEGetSDDataPairs(solute) if dp.GetTag() in
@@ -178,14 +198,17 @@ class SolvationCube(ParallelOEMolComputeCube):
                 opt.update(new_args)
 
             # Solvate the system
-            sol_system = oesolvate(solute, **opt)
+            with self.profiler.phase('solvate'):
+                sol_system = oesolvate(solute, **opt)
             self.log.info("Solvated System atom number {}".format(sol_system.NumAtoms()))
             sol_system.SetTitle(solute.GetTitle())
+            self.profiler.finish(sol_system)
             self.success.emit(sol_system)
         except Exception as e:
             # Attach error message to the molecule that failed
             self.log.error(traceback.format_exc())
             solute.SetData('error', str(e))
+            self.profiler.finish(solute)
             # Return failed mol
             self.failure.emit(solute)
 
@@ -225,6 +248,69 @@ class ComplexPrep(OEMolComputeCube):
         self.wait_on('system_port')
         self.count = 0
         self.check_system = False
+        # System components and their spatial indexes computed once per system
+        self.components = None
+        self.indexes = {}
+        self.profiler = profiling.Profiler(self.name)
+
+    def split_system(self):
+        """
+        Splits the current system in protein, ligand, water and excipients.
+        The system ligand and excipients are the only system molecules which
+        can compete with a ligand conformer in the ligand selection, and are
+        kept together as the ligand candidates
+        """
+        if self.components is None:
+            with self.profiler.phase('split_system'):
+                protein, ligand, water, excipients = oeommutils.split(self.system)
+                candidates = oechem.OEMol(ligand)
+                oechem.OEAddMols(candidates, excipients)
+                self.components = {'protein': protein,
+                                   'water': water,
+                                   'excipients': excipients,
+                                   'candidates': candidates}
+
+        return self.components
+
+    def split_complex(self, conf_mol):
+        """
+        Returns the protein, ligand, water and excipients of the complex made of
+        the current system and the ligand conformer, and the names of the
+        components which are the same of the system ones. Only the ligand
+        candidates of the system and the conformer are split. The whole complex
+        is split only if part of the conformer is not taken as ligand or excipient
+        """
+        components = self.split_system()
+
+        complx = components['candidates'].CreateCopy()
+        oechem.OEAddMols(complx, conf_mol)
+        protein, ligand, water, excipients = oeommutils.split(complx)
+
+        if protein.NumAtoms() or water.NumAtoms():
+            complx = self.system.CreateCopy()
+            oechem.OEAddMols(complx, conf_mol)
+            return tuple(oeommutils.split(complx)) + ([],)
+
+        shared = ['protein', 'water']
+        if np.array_equal(atom_coords(excipients)[1], atom_coords(components['excipients'])[1]):
+            shared.append('excipients')
+            excipients = components['excipients']
+
+        return components['protein'], ligand, components['water'], excipients, shared
+
+    def component_index(self, name, component, shared):
+        """
+        Returns the spatial index of the named complex component. The
+        indexes of the components shared with the system are built
+        once per system
+        """
+        with self.profiler.phase('index'):
+            if name not in shared:
+                return utils.ShellIndex(component)
+            if name not in self.indexes:
+                self.indexes[name] = utils.ShellIndex(component)
+
+        return self.indexes[name]
 
     def process(self, mol, port):
         try:
@@ -236,6 +322,8 @@ class ComplexPrep(OEMolComputeCube):
 
                 self.system = mol
                 self.check_system = True
+                self.components = None
+                self.indexes = {}
                 return
 
             if self.check_system:
@@ -248,12 +336,12 @@ class ComplexPrep(OEMolComputeCube):
                     name = 'p' + self.system.GetTitle() + '_l' + mol.GetTitle()[0:12] + '_' + str(self.count)
 
                 for conf in mol.GetConfs():
+                    self.profiler.start(name)
                     conf_mol = oechem.OEMol(conf)
-                    complx = self.system.CreateCopy()
-                    oechem.OEAddMols(complx, conf_mol)
-                    
+
                     # Split the complex in components
-                    protein, ligand, water, excipients = oeommutils.split(complx)
+                    with self.profiler.phase('split'):
+                        protein, ligand, water, excipients, shared = self.split_complex(conf_mol)
 
                     # If the protein does not contain any atom emit a failure
                     if not protein.NumAtoms():  # Error: protein molecule is empty
@@ -264,15 +352,20 @@ class ComplexPrep(OEMolComputeCube):
                         oechem.OEThrow.Fatal("The Ligand molecule does not contains atoms")
 
                     # Check if the ligand is inside the binding site. Cutoff distance 3A
-                    if not oeommutils.check_shell(ligand, protein, 3):
+                    with self.profiler.phase('check_shell'):
+                        inside = self.component_index('protein', protein, shared).check_shell(ligand, 3)
+                    if not inside:
                         oechem.OEThrow.Fatal("The ligand is probably outside the protein binding site")
 
                     # Removing possible clashes between the ligand and water or excipients
-                    if water.NumAtoms():
-                        water_del = oeommutils.delete_shell(ligand, water, 1.5, in_out='in')
+                    with self.profiler.phase('delete_shell'):
+                        if water.NumAtoms():
+                            water_index = self.component_index('water', water, shared)
+                            water_del = water_index.delete_shell(ligand, 1.5, in_out='in')
 
-                    if excipients.NumAtoms():
-                        excipient_del = oeommutils.delete_shell(ligand, excipients, 1.5, in_out='in')
+                        if excipients.NumAtoms():
+                            excipients_index = self.component_index('excipients', excipients, shared)
+                            excipient_del = excipients_index.delete_shell(ligand, 1.5, in_out='in')
 
                     # Reassemble the complex
                     new_complex = protein.CreateCopy()
@@ -288,6 +381,7 @@ class ComplexPrep(OEMolComputeCube):
                     new_complex.SetData(oechem.OEGetTag('IDTag'), name_c)
                     new_complex.SetTitle(name_c)
                     num_conf += 1
+                    self.profiler.finish(new_complex)
                     self.success.emit(new_complex)
                 self.count += 1
 
@@ -295,6 +389,7 @@ class ComplexPrep(OEMolComputeCube):
             # Attach error message to the molecule that failed
             self.log.error(traceback.format_exc())
             mol.SetData('error', str(e))
+            self.profiler.finish(mol)
             # Return failed mol
             self.failure.emit(mol)
 
@@ -355,15 +450,45 @@ class ForceFieldPrep(ParallelOEMolComputeCube):
         choices=['GAFF', 'GAFF2', 'SMIRNOFF'],
         help_text='Force field used to parametrize other molecules not recognized by the protein force field')
 
+    topology_store = parameter.StringParameter(
+        'topology_store',
+        default='',
+        help_text='Local directory used as content-addressed store for the parametrized topology. '
+                  'If empty the topology is attached to the complex, otherwise only its hash is '
+                  'attached and the directory must be reachable by the downstream cubes')
+
+    payload_codec = parameter.StringParameter(
+        'payload_codec',
+        default='none',
+        choices=['none', 'gzip', 'zstd', 'lz4'],
+        help_text="""Compression codec used for the MD data attached to the molecule.
+        zstd and lz4 fall back to gzip if not installed""")
+
+    payload_codec_level = parameter.IntegerParameter(
+        'payload_codec_level',
+        default=0,
+        help_text="Compression level. If 0 the codec default level is used")
+
+    system_cache = parameter.BooleanParameter(
+        'system_cache',
+        default=True,
+        description="""Attach the serialized OpenMM System created with the default
+        MD settings to the complex to be reused by the downstream cubes""")
+
     def begin(self):
         self.opt = vars(self.args)
         self.opt['Logger'] = self.log
+        self.codec = compression.get_codec(self.opt['payload_codec'], self.opt['payload_codec_level'])
+        self.profiler = profiling.Profiler(self.name)
 
     def process(self, mol, port):
         try:
+            self.profiler.start(mol.GetTitle())
 
             # Split the complex in components in order to apply the FF
-            protein, ligand, water, excipients = oeommutils.split(mol, ligand_res_name=self.opt['ligand_res_name'])
+            with self.profiler.phase('split'):
+                protein, ligand, water, excipients = oeommutils.split(mol,
+                                                                      ligand_res_name=self.opt['ligand_res_name'])
 
             self.log.info("\nComplex name: {}\nProtein atom numbers = {}\nLigand atom numbers = {}\n"
                           "Water atom numbers = {}\nExcipients atom numbers = {}".format(mol.GetTitle(),
@@ -381,31 +506,36 @@ class ForceFieldPrep(ParallelOEMolComputeCube):
             # Apply FF to the Protein
             if protein.NumAtoms():
                 oe_mol_list.append(protein)
-                protein_structure = utils.applyffProtein(protein, self.opt)
+                with self.profiler.phase('ff_protein'):
+                    protein_structure = utils.applyffProtein(protein, self.opt)
                 par_mol_list.append(protein_structure)
 
             # Apply FF to the ligand
             if ligand.NumAtoms():
                 oe_mol_list.append(ligand)
-                ligand_structure = utils.applyffLigand(ligand, self.opt)
+                with self.profiler.phase('ff_ligand'):
+                    ligand_structure = utils.applyffLigand(ligand, self.opt)
                 par_mol_list.append(ligand_structure)
 
             # Apply FF to water molecules
             if water.NumAtoms():
                 oe_mol_list.append(water)
-                water_structure = utils.applyffWater(water, self.opt)
+                with self.profiler.phase('ff_water'):
+                    water_structure = utils.applyffWater(water, self.opt)
                 par_mol_list.append(water_structure)
 
             # Apply FF to the excipients
             if excipients.NumAtoms():
-                excipient_structure = utils.applyffExcipients(excipients, self.opt)
+                with self.profiler.phase('ff_excipients'):
+                    excipient_structure = utils.applyffExcipients(excipients, self.opt)
                 par_mol_list.append(excipient_structure)
 
                 # The excipient order is set equal to the order in related
                 # parmed structure to avoid possible atom index mismatching
-                excipients = oeommutils.openmmTop_to_oemol(excipient_structure.topology,
-                                                           excipient_structure.positions,
-                                                           verbose=False)
+                with self.profiler.phase('openmmTop_to_oemol'):
+                    excipients = oeommutils.openmmTop_to_oemol(excipient_structure.topology,
+                                                               excipient_structure.positions,
+                                                               verbose=False)
                 oechem.OEPerceiveBondOrders(excipients)
                 oe_mol_list.append(excipients)
 
@@ -438,11 +568,14 @@ class ForceFieldPrep(ParallelOEMolComputeCube):
                 self.log.warn("System has been parametrize without periodic box vectors for vacuum simulation")
 
             # Attach the Parmed structure to the complex
-            packed_complex = pack_utils.PackageOEMol.pack(complx, complex_structure)
-
-            # Attach the reference positions to the complex
-            ref_positions = complex_structure.positions
-            packedpos = pack_utils.PackageOEMol.encodePyObj(ref_positions)
+            with self.profiler.phase('encode'):
+                packed_complex = pack_utils.PackageOEMol.pack(complx, complex_structure,
+                                                              store_path=self.opt['topology_store'],
+                                                              codec=self.codec)
+
+                # Attach the reference positions to the complex
+                ref_positions = complex_structure.positions
+                packedpos = pack_utils.PackageOEMol.encodeRefPositions(ref_positions, codec=self.codec)
             packed_complex.SetData(oechem.OEGetTag('OEMDDataRefPositions'), packedpos)
 
             # Set atom serial numbers, Ligand name and HETATM flag
@@ -458,22 +591,28 @@ class ForceFieldPrep(ParallelOEMolComputeCube):
             if packed_complex.GetMaxAtomIdx() != complex_structure.topology.getNumAtoms():
                 raise ValueError("OEMol complex and Parmed structure mismatch atom numbers")
 
-            # Check if it is possible to create the OpenMM System
-            if is_periodic:
-                complex_structure.createSystem(nonbondedMethod=app.CutoffPeriodic,
-                                               nonbondedCutoff=10.0 * unit.angstroms,
-                                               constraints=app.HBonds,
-                                               removeCMMotion=False)
-            else:
-                complex_structure.createSystem(nonbondedMethod=app.NoCutoff,
-                                               constraints=app.HBonds,
-                                               removeCMMotion=False)
-
+            # Check if it is possible to create the OpenMM System. The System is
+            # created with the default MD cube settings and attached to the complex
+            with self.profiler.phase('createSystem'):
+                if is_periodic:
+                    pack_utils.create_system(complex_structure, molecule=packed_complex, logger=self.log,
+                                             cache=self.opt['system_cache'], codec=self.codec,
+                                             nonbondedMethod='PME',
+                                             nonbondedCutoff=10.0,
+                                             constraints='HBonds')
+                else:
+                    pack_utils.create_system(complex_structure, molecule=packed_complex, logger=self.log,
+                                             cache=self.opt['system_cache'], codec=self.codec,
+                                             nonbondedMethod='NoCutoff',
+                                             constraints='HBonds')
+
+            self.profiler.finish(packed_complex)
             self.success.emit(packed_complex)
         except Exception as e:
             # Attach error message to the molecule that failed
             self.log.error(traceback.format_exc())
             mol.SetData('error', str(e))
+            self.profiler.finish(mol)
             # Return failed mol
             self.failure.emit(mol)
 
@@ -0,0 +1,246 @@
+import itertools
+import numpy as np
+from openeye import oechem
+from simtk import unit
+from simtk.openmm import app, Vec3
+from pkg_resources import resource_filename
+from OpenMMCubes import utils
+from OpenMMCubes.spatial import CellGrid
+
+# Water concentration (M) used to compute the number of ion pairs
+WATER_MOLARITY = 55.4
+# Radius (A) of the water molecule added to the solute atom radii
+WATER_RADIUS = 1.4
+# Minimum oxygen-oxygen distance (A) between a water and the
+# periodic images of the other waters
+WATER_CLASH_DISTANCE = 2.5
+# Bondi van der Waals radii (A) of the solute atoms by atomic number
+VDW_RADII = {1: 1.2, 6: 1.7, 7: 1.55, 8: 1.52, 9: 1.47, 15: 1.8, 16: 1.8, 17: 1.75, 35: 1.85, 53: 1.98}
+DEFAULT_VDW_RADIUS = 1.7
+
+# The pre-equilibrated water box loaded once per worker
+_WATER_BOX = None
+
+
+def water_box():
+    """
+    Returns the pre-equilibrated TIP3P water box distributed with OpenMM
+
+    Returns
+    -------
+    waters : numpy array
+        The (M, 3, 3) O, H1, H2 coordinates in angstroms of the waters
+    edge : float
+        The cubic box edge in angstroms
+    """
+    global _WATER_BOX
+
+    if _WATER_BOX is None:
+        pdb = app.PDBFile(resource_filename('simtk.openmm.app', 'data/tip3p.pdb'))
+        xyz = np.asarray(pdb.getPositions(asNumpy=True).value_in_unit(unit.angstroms))
+
+        waters = []
+        for res in pdb.topology.residues():
+            idx = dict((at.name, at.index) for at in res.atoms())
+            waters.append([idx['O'], idx['H1'], idx['H2']])
+
+        edge = pdb.topology.getUnitCellDimensions()[0].value_in_unit(unit.angstroms)
+        waters = xyz[np.array(waters)]
+
+        # Whole waters with the oxygen wrapped in the box
+        waters -= np.floor(waters[:, :1] / edge) * edge
+        _WATER_BOX = (waters, edge)
+
+    return _WATER_BOX
+
+
+def _tile(box_edge):
+    """
+    Fills the cubic box with copies of the water box. The waters
+    with the oxygen outside the box are discarded
+    """
+    waters, edge = water_box()
+
+    n = int(np.ceil(box_edge / edge))
+    shifts = np.array(list(itertools.product(range(n), repeat=3)), dtype=np.float64) * edge
+    tiled = (waters[np.newaxis] + shifts[:, np.newaxis, np.newaxis, :]).reshape(-1, 3, 3)
+
+    inside = np.all((tiled[:, 0] >= 0.0) & (tiled[:, 0] < box_edge), axis=1)
+
+    return tiled[inside]
+
+
+def _solute_clashes(oxygens, solute_xyz, radii):
+    """
+    Returns the mask of the waters whose oxygen is closer than the
+    water radius plus the atom radius to any solute atom
+    """
+    clash = np.zeros(len(oxygens), dtype=bool)
+    if not len(solute_xyz):
+        return clash
+
+    cutoffs = radii + WATER_RADIUS
+    grid = CellGrid(oxygens, cutoffs.max())
+    i, j = grid.pairs(solute_xyz, cutoffs.max())
+
+    dist2 = ((oxygens[j] - solute_xyz[i]) ** 2).sum(axis=1)
+    clash[j[dist2 < cutoffs[i] ** 2]] = True
+
+    return clash
+
+
+def _periodic_clashes(oxygens, box_edge):
+    """
+    Returns the mask of the waters too close to the periodic images
+    of the other waters. For each clashing pair the water with the
+    largest index is removed
+    """
+    clash = np.zeros(len(oxygens), dtype=bool)
+    cutoff = WATER_CLASH_DISTANCE
+
+    near = np.nonzero(np.any((oxygens < cutoff) | (oxygens >= box_edge - cutoff), axis=1))[0]
+    if not len(near):
+        return clash
+
+    grid = CellGrid(oxygens, cutoff)
+    for shift in itertools.product([-1, 0, 1], repeat=3):
+        if shift == (0, 0, 0):
+            continue
+        i, j = grid.pairs(oxygens[near] + np.array(shift) * box_edge, cutoff)
+        clash[np.maximum(near[i], j)] = True
+
+    return clash
+
+
+def _ion_counts(charge, nwaters, salt_concentration):
+    """
+    Returns the number of positive and negative ions neutralizing the
+    system charge and reaching the salt concentration in millimolar
+    """
+    npos = max(0, -charge)
+    nneg = max(0, charge)
+
+    pairs = int(np.floor((nwaters - npos - nneg) * salt_concentration / 1000.0 / WATER_MOLARITY + 0.5))
+
+    return npos + pairs, nneg + pairs
+
+
+def _solvent_molecule(waters, ions):
+    """
+    Builds the water and ion OEMol from the coordinate arrays
+
+    Parameters
+    ----------
+    waters : numpy array
+        The (M, 3, 3) O, H1, H2 water coordinates
+    ions : list
+        The (name, atomic number, formal charge, xyz) ions
+
+    Returns
+    -------
+    mol : OEMol
+        The solvent molecule
+    """
+    mol = oechem.OEMol()
+
+    # Water chain
+    for num in range(len(waters)):
+        o = mol.NewAtom(oechem.OEElemNo_O)
+        h1 = mol.NewAtom(oechem.OEElemNo_H)
+        h2 = mol.NewAtom(oechem.OEElemNo_H)
+        mol.NewBond(o, h1, 1)
+        mol.NewBond(o, h2, 1)
+        for at, name in zip([o, h1, h2], ['O', 'H1', 'H2']):
+            at.SetName(name)
+            res = oechem.OEResidue()
+            res.SetName('HOH')
+            res.SetResidueNumber(num + 1)
+            res.SetChainID('W')
+            res.SetHetAtom(True)
+            oechem.OEAtomSetResidue(at, res)
+
+    # Ion chain
+    for num, (name, atomic_num, charge, xyz) in enumerate(ions):
+        at = mol.NewAtom(atomic_num)
+        at.SetName(name.capitalize())
+        at.SetFormalCharge(charge)
+        res = oechem.OEResidue()
+        res.SetName(name)
+        res.SetResidueNumber(num + 1)
+        res.SetChainID('I')
+        res.SetHetAtom(True)
+        oechem.OEAtomSetResidue(at, res)
+
+    xyz = [waters.reshape(-1, 3)] + [np.asarray(ion[3]).reshape(1, 3) for ion in ions]
+    mol.SetCoords(oechem.OEFloatArray(np.concatenate(xyz).ravel().tolist()))
+
+    oechem.OEAssignImplicitHydrogens(mol)
+
+    return mol
+
+
+def tile_hydrate(system, opt):
+    """
+    This function solvates the system by tiling a pre-equilibrated TIP3P
+    water box in a cubic box. The waters overlapping the system or the
+    periodic images of the other waters are removed and the ions are
+    added by replacing random waters. The output is the same of the
+    PDBFixer based hydrate function: the water and ion molecule with
+    the box vectors attached, followed by the centered system
+
+    Parameters:
+    -----------
+    system: OEMol molecule
+        The system to solvate
+    opt: python dictionary
+        The parameters used to solvate the system: solvent_padding,
+        salt_concentration and the optional random seed
+
+    Return:
+    -------
+    oe_mol: OEMol
+        The solvated system
+    """
+    sol_system = system.CreateCopy()
+
+    atoms = [at for at in sol_system.GetAtoms()]
+    coords = sol_system.GetCoords()
+    solute_xyz = np.array([coords[at.GetIdx()] for at in atoms], dtype=np.float64).reshape(-1, 3)
+    radii = np.array([VDW_RADII.get(at.GetAtomicNum(), DEFAULT_VDW_RADIUS) for at in atoms])
+
+    # Cubic box centered on the system bounding box (Angstrom units)
+    bb_min, bb_max = solute_xyz.min(axis=0), solute_xyz.max(axis=0)
+    box_edge = 2.0 * opt['solvent_padding'] + np.max(bb_max - bb_min)
+
+    solute_xyz += box_edge / 2.0 - (bb_min + bb_max) / 2.0
+    sol_system.SetCoords(dict((at.GetIdx(), tuple(xyz)) for at, xyz in zip(atoms, solute_xyz.tolist())))
+
+    waters = _tile(box_edge)
+    waters = waters[~_solute_clashes(waters[:, 0], solute_xyz, radii)]
+    waters = waters[~_periodic_clashes(waters[:, 0], box_edge)]
+
+    # Ions replace random waters
+    npos, nneg = _ion_counts(oechem.OENetCharge(sol_system), len(waters), opt['salt_concentration'])
+    if npos + nneg > len(waters):
+        oechem.OEThrow.Fatal("The box is too small to add {} ions".format(npos + nneg))
+
+    rng = np.random.RandomState(opt.get('seed'))
+    replaced = rng.choice(len(waters), npos + nneg, replace=False)
+
+    ions = [('NA', oechem.OEElemNo_Na, 1, waters[idx, 0]) for idx in replaced[:npos]]
+    ions += [('CL', oechem.OEElemNo_Cl, -1, waters[idx, 0]) for idx in replaced[npos:]]
+
+    waters = np.delete(waters, replaced, axis=0)
+
+    oe_mol = _solvent_molecule(waters, ions)
+
+    # Setting the box vectors
+    edge = box_edge / 10.0
+    omm_box_vectors = unit.Quantity((Vec3(edge, 0.0, 0.0), Vec3(0.0, edge, 0.0), Vec3(0.0, 0.0, edge)),
+                                    unit.nanometers)
+    box_vectors = utils.PackageOEMol.encodePyObj(omm_box_vectors)
+    oe_mol.SetData(oechem.OEGetTag('box_vectors'), box_vectors)
+
+    oechem.OEAddMols(oe_mol, sol_system)
+
+    return oe_mol
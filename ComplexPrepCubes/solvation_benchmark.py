@@ -0,0 +1,84 @@
+"""
+Benchmark of the PDBFixer and the water box tiling solvation engines
+
+Ex: python -m ComplexPrepCubes.solvation_benchmark examples/data/Bace_protein.pdb
+"""
+from __future__ import print_function
+import sys
+import time
+import argparse
+from openeye import oechem
+from ComplexPrepCubes import utils, solvation
+from OpenMMCubes.utils import get_data_filename
+
+DEFAULT_FILES = ['data/Bace_protein.pdb',
+                 'data/T4-protein.pdb']
+
+ENGINES = [('PDBFixer', utils.hydrate),
+           ('Tiling', solvation.tile_hydrate)]
+
+
+def solvent_counts(sol_system):
+    """
+    Returns the number of waters and ions of the solvated system
+    """
+    waters = set()
+    ions = 0
+
+    for at in sol_system.GetAtoms():
+        res = oechem.OEAtomGetResidue(at)
+        if res.GetName() == 'HOH':
+            waters.add((res.GetChainID(), res.GetResidueNumber()))
+        elif res.GetName() in ['NA', 'CL']:
+            ions += 1
+
+    return len(waters), ions
+
+
+def run_solvation_benchmarks(fnames, opt, repeats=1, stream=None):
+    """
+    Solvates the first molecule of each passed file with each engine
+    and writes a report table to the selected stream
+    """
+    if stream is None:
+        stream = sys.stdout
+
+    for fname in fnames:
+        system = oechem.OEMol()
+        with oechem.oemolistream(fname) as ifs:
+            if not oechem.OEReadMolecule(ifs, system):
+                raise IOError('Unable to read a molecule from {}'.format(fname))
+
+        stream.write('{} ({} atoms)\n'.format(fname, system.NumAtoms()))
+        stream.write('  {:<10} {:>10} {:>8} {:>6} {:>8}\n'.format('engine', 'time (s)', 'waters', 'ions', 'atoms'))
+
+        for name, hydrate in ENGINES:
+            wall = float('inf')
+            for i in range(repeats):
+                start = time.perf_counter()
+                sol_system = hydrate(system, opt)
+                wall = min(wall, time.perf_counter() - start)
+
+            waters, ions = solvent_counts(sol_system)
+            stream.write('  {:<10} {:>10.2f} {:>8} {:>6} {:>8}\n'.format(name, wall, waters, ions,
+                                                                        sol_system.NumAtoms()))
+        stream.write('\n')
+        stream.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the solvation engines')
+    parser.add_argument('files', nargs='*', help='Molecule files. Default: the bundled example proteins')
+    parser.add_argument('--padding', type=float, default=10.0, help='Solvent padding in A')
+    parser.add_argument('--salt', type=float, default=50.0, help='Salt concentration in millimolar')
+    parser.add_argument('--repeats', type=int, default=1, help='Number of timing repetitions')
+    args = parser.parse_args()
+
+    fnames = args.files or [get_data_filename('examples', fn) for fn in DEFAULT_FILES]
+    opt = {'solvent_padding': args.padding, 'salt_concentration': args.salt, 'seed': 0}
+
+    run_solvation_benchmarks(fnames, opt, repeats=args.repeats)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,9 @@
 import unittest
 from ComplexPrepCubes.cubes import ComplexPrep, ForceFieldPrep
+from ComplexPrepCubes import utils, solvation
+import numpy as np
 from openeye import oechem
+from oeommtools import utils as oeommutils
 from OpenMMCubes.cubes import utils as ommutils
 from floe.test import CubeTestRunner
 
@@ -49,6 +52,49 @@ class ComplexPrepTester(unittest.TestCase):
 
         self.assertEquals(complex.GetMaxAtomIdx(), 52312)
 
+    def _baseline_complex(self, system, conf_mol):
+        # The complex assembled by splitting the whole complex with the oeommtools functions
+        complx = system.CreateCopy()
+        oechem.OEAddMols(complx, conf_mol)
+        protein, ligand, water, excipients = oeommutils.split(complx)
+        new_complex = protein.CreateCopy()
+        oechem.OEAddMols(new_complex, ligand)
+        oechem.OEAddMols(new_complex, oeommutils.delete_shell(ligand, excipients, 1.5, in_out='in'))
+        oechem.OEAddMols(new_complex, oeommutils.delete_shell(ligand, water, 1.5, in_out='in'))
+        return new_complex
+
+    def test_components(self):
+        fn_ligand = ommutils.get_data_filename('examples', 'data/lig_CAT13a.oeb.gz')
+        ligand = oechem.OEMol()
+        with oechem.oemolistream(fn_ligand) as ifs:
+            oechem.OEReadMolecule(ifs, ligand)
+
+        # The second system already carries a ligand
+        for fn in ['data/Bace_solvated.oeb.gz', 'data/pbace_lcat13a_solvated_complex.oeb.gz']:
+            system = oechem.OEMol()
+            with oechem.oemolistream(ommutils.get_data_filename('examples', fn)) as ifs:
+                oechem.OEReadMolecule(ifs, system)
+
+            self.cube.process(system, 'system_port')
+            self.cube.process(oechem.OEMol(ligand), self.cube.intake.name)
+            self.assertEqual(self.runner.outputs['failure'].qsize(), 0)
+
+            for conf in ligand.GetConfs():
+                expected = self._baseline_complex(system, oechem.OEMol(conf))
+                complex = self.runner.outputs['success'].get()
+                self.assertEqual(complex.NumAtoms(), expected.NumAtoms())
+                self.assertEqual([comp.NumAtoms() for comp in oeommutils.split(complex)],
+                                 [comp.NumAtoms() for comp in oeommutils.split(expected)])
+
+            # The system components are split and indexed once per system
+            indexes = dict(self.cube.indexes)
+            self.assertIn('protein', indexes)
+            self.cube.process(oechem.OEMol(ligand), self.cube.intake.name)
+            for name in indexes:
+                self.assertIs(self.cube.indexes[name], indexes[name])
+            for conf in ligand.GetConfs():
+                self.runner.outputs['success'].get()
+
     def tearDown(self):
         self.runner.finalize()
 
@@ -56,6 +102,77 @@ class ComplexPrepTester(unittest.TestCase):
         pass
 
 
+class ShellIndexTester(unittest.TestCase):
+    """
+    Test the spatial index against the oeommtools check_shell and delete_shell
+    """
+
+    def setUp(self):
+        fn_complex = ommutils.get_data_filename('examples',
+                                                'data/pbace_lcat13a_solvated_complex.oeb.gz')
+        complex = oechem.OEMol()
+
+        with oechem.oemolistream(fn_complex) as ifs:
+            oechem.OEReadMolecule(ifs, complex)
+
+        self.protein, self.ligand, self.water, self.excipients = oeommutils.split(complex)
+
+    def test_check_shell(self):
+        index = utils.ShellIndex(self.protein)
+        for cutoff in [1.0, 3.0]:
+            self.assertEqual(index.check_shell(self.ligand, cutoff),
+                             oeommutils.check_shell(self.ligand, self.protein, cutoff))
+
+    def test_delete_shell(self):
+        index = utils.ShellIndex(self.water)
+        for cutoff, in_out in [(1.5, 'in'), (5.0, 'in'), (5.0, 'out')]:
+            expected = oeommutils.delete_shell(self.ligand, self.water, cutoff, in_out=in_out)
+            water_del = index.delete_shell(self.ligand, cutoff, in_out=in_out)
+            self.assertEqual(water_del.NumAtoms(), expected.NumAtoms())
+            self.assertEqual(water_del.NumBonds(), expected.NumBonds())
+            self.assertEqual(water_del.GetMaxAtomIdx(), water_del.NumAtoms())
+            self.assertEqual([oechem.OEAtomGetResidue(at).GetResidueNumber() for at in water_del.GetAtoms()],
+                             [oechem.OEAtomGetResidue(at).GetResidueNumber() for at in expected.GetAtoms()])
+            self.assertEqual(water_del.GetCoords(), expected.GetCoords())
+
+        # The indexed molecule is not modified
+        self.assertEqual(index.molecule.NumAtoms(), self.water.NumAtoms())
+
+
+class TileHydrateTester(unittest.TestCase):
+    """
+    Test the water box tiling solvation
+    """
+
+    def setUp(self):
+        fn_protein = ommutils.get_data_filename('examples', 'data/T4-protein.pdb')
+        self.protein = oechem.OEMol()
+
+        with oechem.oemolistream(fn_protein) as ifs:
+            oechem.OEReadMolecule(ifs, self.protein)
+
+    def test_ion_counts(self):
+        self.assertEqual(solvation._ion_counts(0, 0, 50.0), (0, 0))
+        self.assertEqual(solvation._ion_counts(-7, 10000, 50.0), (16, 9))
+
+    def test_tile_hydrate(self):
+        opt = {'solvent_padding': 10.0, 'salt_concentration': 50.0, 'seed': 0}
+        sol_system = solvation.tile_hydrate(self.protein, opt)
+
+        self.assertTrue(sol_system.HasData(oechem.OEGetTag('box_vectors')))
+        self.assertEqual(oechem.OENetCharge(sol_system), 0)
+
+        protein, ligand, water, excipients = oeommutils.split(sol_system)
+        self.assertEqual(protein.NumAtoms(), self.protein.NumAtoms())
+        self.assertFalse(oeommutils.check_shell(protein, water, 1.5))
+
+        # No water clashes across the periodic boundaries
+        oxygens = np.array([water.GetCoords(at) for at in water.GetAtoms(oechem.OEIsOxygen())])
+        box_edge = 2.0 * opt['solvent_padding'] + np.max(np.ptp(np.array(list(self.protein.GetCoords().values())),
+                                                                axis=0))
+        self.assertFalse(np.any(solvation._periodic_clashes(oxygens, box_edge)))
+
+
 class ForceFieldPrepTester(unittest.TestCase):
     """
       Test the Complex Preparation  cube
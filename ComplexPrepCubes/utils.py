@@ -4,6 +4,7 @@ from simtk.openmm import app
 import parmed
 from LigPrepCubes import ff_utils
 from OpenMMCubes import utils
+from OpenMMCubes.spatial import CellGrid, atom_coords, residue_index
 import numpy as np
 from oeommtools import utils as oeommutils
 from pdbfixer import PDBFixer
@@ -430,6 +431,91 @@ def hydrate(system, opt):
     return oe_mol
 
 
+class ShellIndex(object):
+    """
+    Spatial index over the atoms of a molecule, e.g. the protein or the
+    water of a solvated receptor. The index is built once and answers the
+    check_shell and delete_shell queries of each ligand by comparing the
+    ligand atoms only with the atoms of the neighbouring grid cells. The
+    results are the same of the oeommtools check_shell and delete_shell
+    functions
+    """
+
+    def __init__(self, molecule, cell_size=3.0):
+        """
+        Initialization function
+
+        Parameters
+        ----------
+        molecule : OEMol
+            The indexed molecule
+        cell_size : float
+            The grid cell edge in angstroms
+        """
+        self.molecule = molecule
+        self.atoms, xyz = atom_coords(molecule)
+        self.grid = CellGrid(xyz, cell_size)
+
+        # Residue number of each atom by atom index. The residues are
+        # deleted as a whole as the oeommtools delete_shell does
+        self.residues = residue_index(molecule)
+
+    def check_shell(self, core_mol, cutoff):
+        """
+        Returns True if at least one indexed atom is within the
+        cutoff distance in angstroms from the core_mol atoms
+        """
+        atoms, xyz = atom_coords(core_mol)
+        return len(self.grid.pairs(xyz, cutoff)[0]) > 0
+
+    def shell_atoms(self, core_mol, cutoff):
+        """
+        Returns the sorted indexes of the atoms of the residues which have at least
+        one atom within the cutoff distance in angstroms from the core_mol atoms
+        """
+        atoms, xyz = atom_coords(core_mol)
+        close = self.atoms[self.grid.within(xyz, cutoff)]
+        selected = np.isin(self.residues, np.unique(self.residues[close])) & (self.residues >= 0)
+
+        return np.nonzero(selected)[0]
+
+    def delete_shell(self, core_mol, cutoff, in_out='in'):
+        """
+        This function deletes the residues of the indexed molecule that are
+        close (in_out=in) or far (in_out=out) than the cutoff distance in
+        angstroms from the core_mol atoms
+
+        Parameters
+        ----------
+        core_mol : OEMol
+            The reference molecule, e.g. the ligand
+        cutoff : float
+            The cutoff distance in angstroms
+        in_out : str
+            in or out
+
+        Returns
+        -------
+        reset_del : OEMol
+            The molecule without the deleted atoms and with reset atom indexes
+        """
+        if in_out not in ['in', 'out']:
+            raise ValueError("The in_out parameter value is not recognized: {}".format(in_out))
+
+        # The output is built from the kept atoms, the indexed molecule is not copied
+        bv = oechem.OEBitVector(self.molecule.GetMaxAtomIdx())
+        for idx in self.shell_atoms(core_mol, cutoff).tolist():
+            bv.SetBitOn(idx)
+
+        if in_out == 'in':
+            bv.NegateBits()
+
+        reset_del = oechem.OEMol()
+        oechem.OESubsetMol(reset_del, self.molecule, oechem.OEAtomIdxSelected(bv))
+
+        return reset_del
+
+
 def order_check(mol, fname):
     """
     TO REMOVE
@@ -1,6 +1,7 @@
 import traceback
 from openeye import oechem, oedocking
 import OpenMMCubes.utils as utils
+from OpenMMCubes import profiling
 from LigPrepCubes import ff_utils
 from floe.api import OEMolComputeCube, ParallelOEMolComputeCube, parameter
 from oeommtools import utils as oeommutils
@@ -43,19 +44,24 @@ class LigChargeCube(ParallelOEMolComputeCube):
     def begin(self):
         self.opt = vars(self.args)
         self.opt['Logger'] = self.log
+        self.profiler = profiling.Profiler(self.name)
 
     def process(self, ligand, port):
 
         try:
+            self.profiler.start(ligand.GetTitle())
+
             # Ligand sanitation
-            ligand = oeommutils.sanitizeOEMolecule(ligand)
+            with self.profiler.phase('sanitize'):
+                ligand = oeommutils.sanitizeOEMolecule(ligand)
 
             # Charge the ligand
             if self.opt['charge_ligands']:
                 self.log.info("ELF10 Charges applied to the ligand")
-                charged_ligand = ff_utils.assignELF10charges(ligand,
-                                                             self.opt['max_conformers'],
-                                                             strictStereo=False)
+                with self.profiler.phase('charges'):
+                    charged_ligand = ff_utils.assignELF10charges(ligand,
+                                                                 self.opt['max_conformers'],
+                                                                 strictStereo=False)
 
                 # If the ligand has been charged then transfer the computed
                 # charges to the starting ligand
@@ -63,12 +69,14 @@ class LigChargeCube(ParallelOEMolComputeCube):
                 for at in ligand.GetAtoms():
                     at.SetPartialCharge(map_charges[at.GetIdx()])
 
+            self.profiler.finish(ligand)
             self.success.emit(ligand)
 
         except Exception as e:
             # Attach error message to the molecule that failed
             self.log.error(traceback.format_exc())
             ligand.SetData('error', str(e))
+            self.profiler.finish(ligand)
             # Return failed mol
             self.failure.emit(ligand)
 
@@ -118,6 +126,8 @@ class FREDDocking(OEMolComputeCube):
         if not self.dock.Initialize(receptor):
             raise Exception("Unable to initialize Docking with {0}".format(self.args.receptor))
 
+        self.profiler = profiling.Profiler(self.name)
+
     def clean(self, mol):
         mol.DeleteData('CLASH')
         mol.DeleteData('CLASHTYPE')
@@ -126,8 +136,10 @@ class FREDDocking(OEMolComputeCube):
 
     def process(self, mcmol, port):
         try:
+            self.profiler.start(mcmol.GetTitle())
             dockedMol = oechem.OEMol()
-            res = self.dock.DockMultiConformerMolecule(dockedMol, mcmol)
+            with self.profiler.phase('dock'):
+                res = self.dock.DockMultiConformerMolecule(dockedMol, mcmol)
             if res == oedocking.OEDockingReturnCode_Success:
                 oedocking.OESetSDScore(dockedMol, self.dock, self.sdtag)
                 self.dock.AnnotatePose(dockedMol)
@@ -135,12 +147,16 @@ class FREDDocking(OEMolComputeCube):
                 self.log.info("{} {} score = {:.4f}".format(self.sdtag, dockedMol.GetTitle(), score))
                 oechem.OESetSDData(dockedMol, self.sdtag, "{}".format(score))
                 self.clean(dockedMol)
+                self.profiler.finish(dockedMol)
                 self.success.emit(dockedMol)
+            else:
+                self.profiler.finish()
 
         except Exception as e:
             # Attach error message to the molecule that failed
             self.log.error(traceback.format_exc())
             mcmol.SetData('error', str(e))
+            self.profiler.finish(mcmol)
             # Return failed molecule
             self.failure.emit(mcmol)
 
@@ -5,6 +5,7 @@ from floe.api import (parameter, MoleculeOutputPort, SourceCube)
 from floe.api.orion import StreamingDataset, config_from_env
 
 from openeye import oechem
+from OpenMMCubes import compression, payload
 
 try:
     import cPickle as pickle
@@ -13,9 +14,16 @@ except ImportError:
 
 
 class MoleculeSerializerMixin(object):
+    """
+    By default molecules are serialized as gzipped oeb strings. A different
+    compression codec can be selected with set_codec: the raw oeb string is
+    then wrapped in a binary payload whose header records the codec, and
+    decode auto-detects the format
+    """
 
     def __init__(self, *args, **kwargs):
         super(MoleculeSerializerMixin, self).__init__(*args, **kwargs)
+        self.codec = None
         self._ifs = oechem.oemolistream()
         self._ifs.SetFormat(oechem.OEFormat_OEB)
         self._ifs.Setgz(True)
@@ -25,6 +33,19 @@ class MoleculeSerializerMixin(object):
         self._ofs.Setgz(True)
         self._ofs.SetFormat(oechem.OEFormat_OEB)
 
+    def set_codec(self, codec=None, level=None):
+        """
+        Selects the compression codec used to encode the molecules. None
+        or gzip select the default gzipped oeb strings
+        """
+        codec = compression.get_codec(codec, level) if codec else None
+        if codec is not None and codec.name == compression.GzipCodec.name and not level:
+            codec = None
+        self.codec = codec
+        self._ofs.close()
+        self._ofs.Setgz(self.codec is None)
+        self._ofs.openstring()
+
     def encode(self, *mols):
         """
         By default, serializes molecules as gzipped oeb files in a string
@@ -36,6 +57,8 @@ class MoleculeSerializerMixin(object):
         res = self._ofs.GetString()
         self._ofs.close()
         self._ofs.openstring()
+        if self.codec is not None:
+            res = payload.encode([('oeb', res)], codec=self.codec)
         return res
 
     def decode(self, mol_data):
@@ -45,6 +68,10 @@ class MoleculeSerializerMixin(object):
         mol = oechem.OEMol()
         if type(mol_data) == oechem.OEMol:
             return mol_data
+        is_payload = payload.is_payload(mol_data)
+        if is_payload:
+            mol_data = payload.decode(mol_data)['oeb']
+        self._ifs.Setgz(not is_payload)
         if not self._ifs.openstring(mol_data):
             raise RuntimeError("Failed to open string")
         if not oechem.OEReadMolecule(self._ifs, mol):
@@ -0,0 +1,119 @@
+"""
+Benchmark of the compression codecs used for the MD payloads and the port messages
+
+Ex: python -m OpenMMCubes.codec_benchmark examples/data/pbace_lcat13a_solvated_complex.oeb.gz
+"""
+from __future__ import print_function
+import sys
+import time
+import argparse
+import numpy as np
+from openeye import oechem
+from OpenMMCubes import compression, payload
+from OpenMMCubes.utils import get_data_filename
+
+DEFAULT_FILES = ['data/pbace_lcat13a_solvated_complex.oeb.gz',
+                 'data/pCDK2_l1h1q_solvated_complex.oeb.gz']
+
+
+def molecule_messages(fname):
+    """
+    Reads the first molecule in the passed file and returns the messages to
+    benchmark: the raw oeb string as sent through the ports and the
+    coordinate array block as attached to the molecule by the MD cubes
+    """
+    mol = oechem.OEMol()
+    with oechem.oemolistream(fname) as ifs:
+        if not oechem.OEReadMolecule(ifs, mol):
+            raise IOError('Unable to read a molecule from {}'.format(fname))
+
+    ofs = oechem.oemolostream()
+    ofs.SetFormat(oechem.OEFormat_OEB)
+    ofs.Setgz(False)
+    ofs.openstring()
+    oechem.OEWriteConstMolecule(ofs, mol)
+    oeb = ofs.GetString()
+    ofs.close()
+
+    coords = mol.GetCoords()
+    xyz = np.array([coords[idx] for idx in sorted(coords)], dtype=np.float64)
+
+    return mol.NumAtoms(), [('oeb', [('oeb', oeb)]), ('coords', [('coordinates', xyz)])]
+
+
+def benchmark_codec(blocks, codec, repeats=3):
+    """
+    Encodes and decodes the passed blocks with the selected codec
+
+    Returns
+    -------
+    size : int
+        The encoded payload size in bytes
+    encode_speed : float
+        The encode throughput in MB/s of raw data
+    decode_speed : float
+        The decode throughput in MB/s of raw data
+    """
+    raw_size = len(payload.encode(blocks))
+
+    encode_time = decode_time = float('inf')
+
+    for i in range(repeats):
+        start = time.perf_counter()
+        data = payload.encode(blocks, codec=codec)
+        encode_time = min(encode_time, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        payload.decode(data)
+        decode_time = min(decode_time, time.perf_counter() - start)
+
+    mb = raw_size / 1.0e6
+
+    return len(data), mb / max(encode_time, 1e-9), mb / max(decode_time, 1e-9)
+
+
+def run_codec_benchmarks(fnames, codecs=None, repeats=3, stream=None):
+    """
+    Runs the codec benchmarks on the first molecule of each passed file
+    and writes a report table to the selected stream
+    """
+    if stream is None:
+        stream = sys.stdout
+
+    if codecs is None:
+        codecs = [c.name for c in compression.CODECS if c.available()]
+        codecs += ['gzip:1', 'gzip:9']
+
+    for fname in fnames:
+        natoms, messages = molecule_messages(fname)
+        stream.write('{} ({} atoms)\n'.format(fname, natoms))
+
+        for label, blocks in messages:
+            raw_size = len(payload.encode(blocks))
+            stream.write('  {} message, raw size {:.2f} MB\n'.format(label, raw_size / 1.0e6))
+            stream.write('    {:<8} {:>12} {:>8} {:>14} {:>14}\n'.format('codec', 'size (MB)', 'ratio',
+                                                                        'encode (MB/s)', 'decode (MB/s)'))
+            for spec in codecs:
+                codec = compression.get_codec(spec)
+                size, enc, dec = benchmark_codec(blocks, codec, repeats=repeats)
+                stream.write('    {:<8} {:>12.3f} {:>8.2f} {:>14.1f} {:>14.1f}\n'.format(spec, size / 1.0e6,
+                                                                                   raw_size / float(size),
+                                                                                   enc, dec))
+        stream.write('\n')
+        stream.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the MD payload compression codecs')
+    parser.add_argument('files', nargs='*', help='Molecule files. Default: the bundled solvated complexes')
+    parser.add_argument('--codecs', nargs='*', help='Codecs to test e.g. none gzip:1 zstd lz4')
+    parser.add_argument('--repeats', type=int, default=3, help='Number of timing repetitions')
+    args = parser.parse_args()
+
+    fnames = args.files or [get_data_filename('examples', fn) for fn in DEFAULT_FILES]
+
+    run_codec_benchmarks(fnames, codecs=args.codecs, repeats=args.repeats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+import zlib
+import warnings
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+
+class Codec(object):
+    """
+    Base compression codec. Each codec is identified in the payload
+    header by its integer id, so decoders can auto-detect it
+    """
+    name = 'none'
+    id = 0
+    default_level = 0
+
+    def __init__(self, level=None):
+        self.level = self.default_level if not level else level
+
+    @classmethod
+    def available(cls):
+        return True
+
+    def compress(self, data):
+        return data
+
+    def decompress(self, data):
+        return data
+
+    def __repr__(self):
+        return '{}(level={})'.format(self.name, self.level)
+
+
+class GzipCodec(Codec):
+    """
+    Deflate compression from the python standard library
+    """
+    name = 'gzip'
+    id = 1
+    default_level = 6
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class ZstdCodec(Codec):
+    """
+    Zstandard compression. Requires the zstandard package
+    """
+    name = 'zstd'
+    id = 2
+    default_level = 3
+
+    @classmethod
+    def available(cls):
+        return zstandard is not None
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+class LZ4Codec(Codec):
+    """
+    LZ4 frame compression. Requires the lz4 package
+    """
+    name = 'lz4'
+    id = 3
+    default_level = 0
+
+    @classmethod
+    def available(cls):
+        return lz4frame is not None
+
+    def compress(self, data):
+        return lz4frame.compress(data, compression_level=self.level)
+
+    def decompress(self, data):
+        return lz4frame.decompress(data)
+
+
+CODECS = [Codec, GzipCodec, ZstdCodec, LZ4Codec]
+CODEC_NAMES = [c.name for c in CODECS]
+
+_BY_NAME = {c.name: c for c in CODECS}
+_BY_ID = {c.id: c for c in CODECS}
+
+
+def get_codec(codec=None, level=None):
+    """
+    Returns a codec instance
+
+    Parameters
+    ----------
+    codec : str, Codec or None
+        The codec name: none, gzip, zstd or lz4. A level can be appended
+        to the name e.g. gzip:9. None selects no compression
+    level : int or None
+        The compression level. If None or 0 the codec default is used
+
+    Returns
+    -------
+    codec : Codec
+        The selected codec. If the required codec package is not installed
+        the standard library gzip codec is returned
+    """
+    if isinstance(codec, Codec):
+        return codec
+
+    if not codec:
+        return Codec()
+
+    name = codec
+    if ':' in codec:
+        name, lvl = codec.split(':', 1)
+        level = int(lvl)
+
+    try:
+        cls = _BY_NAME[name.lower()]
+    except KeyError:
+        raise ValueError('Unknown codec {}. Supported codecs: {}'.format(name, CODEC_NAMES))
+
+    if not cls.available():
+        warnings.warn('The {} codec is not available, falling back to {}'.format(cls.name, GzipCodec.name))
+        return GzipCodec()
+
+    return cls(level)
+
+
+def codec_from_id(codec_id):
+    """
+    Returns the codec instance used to decode the passed codec id
+    """
+    try:
+        cls = _BY_ID[codec_id]
+    except KeyError:
+        raise ValueError('Unknown codec id {}'.format(codec_id))
+
+    if not cls.available():
+        raise RuntimeError('The data has been compressed with the {} codec, '
+                           'which is not installed'.format(cls.name))
+    return cls()
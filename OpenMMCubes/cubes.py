@@ -1,7 +1,9 @@
+import json
 import traceback
 import OpenMMCubes.simtools as simtools
 import OpenMMCubes.utils as utils
-from floe.api import ParallelOEMolComputeCube, parameter
+from OpenMMCubes import compression, profiling
+from floe.api import ParallelOEMolComputeCube, parameter, MoleculeOutputPort
 from openeye import oechem
 
 
@@ -21,6 +23,9 @@ class OpenMMminimizeCube(ParallelOEMolComputeCube):
     Input parameters:
     steps (integer): the number of steps of minimization to apply. If 0
     the minimization will proceed until convergence is reached
+    tolerance (decimal): the RMS force in kJ/(mol nm) at convergence
+    restraint_release (string): restraint weight scale factors of the
+    minimization stages
     """
     
     # Override defaults for some parameters
@@ -37,6 +42,20 @@ class OpenMMminimizeCube(ParallelOEMolComputeCube):
                   If 0 the minimization will continue 
                   until convergence""")
 
+    tolerance = parameter.DecimalParameter(
+        'tolerance',
+        default=10.0,
+        help_text="""Energy tolerance in kJ/(mol nm). Each minimization stage
+                  stops when the root-mean-square of the force components
+                  is lower, the OpenMM minimizer criterion""")
+
+    restraint_release = parameter.StringParameter(
+        'restraint_release',
+        default='1.0',
+        help_text="""Comma separated restraint weight scale factors of the staged
+                  minimization, e.g. 1.0, 0.1, 0.0 to minimize with strong, weak
+                  and no restraints. Each stage runs up to steps iterations""")
+
     restraints = parameter.StringParameter(
         'restraints',
         default='',
@@ -103,8 +122,9 @@ class OpenMMminimizeCube(ParallelOEMolComputeCube):
     platform = parameter.StringParameter(
         'platform',
         default='Auto', 
-        choices=['Auto', 'Reference', 'CPU', 'CUDA', 'OpenCL'],
-        help_text='Select which platform to use to run the simulation')
+        choices=['Auto', 'Auto-Benchmarked', 'Reference', 'CPU', 'CUDA', 'OpenCL'],
+        help_text="""Select which platform to use to run the simulation. Auto-Benchmarked
+        selects the fastest validated platform and precision from the host benchmarks""")
 
     cuda_opencl_precision = parameter.StringParameter(
         'cuda_opencl_precision',
@@ -112,15 +132,71 @@ class OpenMMminimizeCube(ParallelOEMolComputeCube):
         choices=['single', 'mixed', 'double'],
         help_text='Select the CUDA or OpenCL precision')
 
+    cpu_threads = parameter.IntegerParameter(
+        'cpu_threads',
+        default=0,
+        help_text="""Number of CPU platform threads. If 0 the threads are set from
+        the CPUs available to each co-resident worker""")
+
+    cpu_workers = parameter.IntegerParameter(
+        'cpu_workers',
+        default=1,
+        help_text="Number of MD workers sharing the host CPUs")
+
+    cpu_pinning = parameter.BooleanParameter(
+        'cpu_pinning',
+        default=False,
+        description="Pin each worker to its own set of host CPUs")
+
+    cpu_calibration = parameter.BooleanParameter(
+        'cpu_calibration',
+        default=False,
+        description="""Select the CPU threads by a short benchmark of the
+        simulated system. The result is stored per host and computed once""")
+
+    payload_codec = parameter.StringParameter(
+        'payload_codec',
+        default='none',
+        choices=['none', 'gzip', 'zstd', 'lz4'],
+        help_text="""Compression codec used for the MD data attached to the molecule.
+        zstd and lz4 fall back to gzip if not installed""")
+
+    payload_codec_level = parameter.IntegerParameter(
+        'payload_codec_level',
+        default=0,
+        help_text="Compression level. If 0 the codec default level is used")
+
+    system_cache = parameter.BooleanParameter(
+        'system_cache',
+        default=True,
+        description="""Reuse the serialized OpenMM System attached to the molecule
+        if it has been created with the same topology and settings""")
+
+    context_cache = parameter.BooleanParameter(
+        'context_cache',
+        default=False,
+        description="""Reuse the OpenMM Context of a previous molecule with the same
+        topology and settings. Up to 2 Contexts are kept alive per worker. For each
+        molecule the step counter, time, reporters, positions, velocities, box and
+        the restraint reference positions and weight are reset. The integrator and
+        barostat internal state, e.g. the random number stream and the barostat
+        move size, are carried over from the previous molecule. The reuses are only
+        reported as Context cache hits in the cube log""")
+
     def begin(self):
         self.opt = vars(self.args)
         self.opt['Logger'] = self.log
         self.opt['SimType'] = 'min'
+        self.codec = compression.get_codec(self.opt['payload_codec'], self.opt['payload_codec_level'])
+        self.opt['codec'] = self.codec
+        self.profiler = profiling.Profiler(self.name)
 
         return
 
     def process(self, mol, port):
         try:
+            self.profiler.start(mol.GetTitle())
+
             # The copy of the dictionary option as local variable
             # is necessary to avoid filename collisions due to
             # the parallel cube processes
@@ -138,18 +214,23 @@ class OpenMMminimizeCube(ParallelOEMolComputeCube):
                 self.log.info("Updating parameters for molecule: {}\n{}".format(mol.GetTitle(), new_args))
                 opt.update(new_args)
 
-            if utils.PackageOEMol.checkTags(mol, ['Structure']):
-                gd = utils.PackageOEMol.unpack(mol)
+            if utils.PackageOEMol.checkStructure(mol):
+                gd = utils.PackageOEMol.unpack(mol, tags=['IDTag'])
                 opt['outfname'] = '{}-{}'.format(gd['IDTag'], self.opt['outfname'])
 
-            mdData = utils.MDData(mol)
+            with self.profiler.phase('decode'):
+                mdData = utils.MDData(mol)
 
             opt['molecule'] = mol
+            # The throughput SD tags are prefixed by the cube name
+            opt['stage_name'] = self.name
 
             self.log.info('MINIMIZING System: %s' % gd['IDTag'])
             simtools.simulation(mdData, **opt)
 
-            packedmol = mdData.packMDData(mol)
+            with self.profiler.phase('encode'):
+                packedmol = mdData.packMDData(mol, codec=self.codec)
+            self.profiler.finish(packedmol)
 
             self.success.emit(packedmol)
 
@@ -157,6 +238,7 @@ class OpenMMminimizeCube(ParallelOEMolComputeCube):
             # Attach error message to the molecule that failed
             self.log.error(traceback.format_exc())
             mol.SetData('error', str(e))
+            self.profiler.finish(mol)
             # Return failed mol
             self.failure.emit(mol)
    
@@ -244,8 +326,28 @@ class OpenMMnvtCube(ParallelOEMolComputeCube):
     trajectory_filetype = parameter.StringParameter(
         'trajectory_filetype',
         default='DCD',
-        choices=['DCD', 'NetCDF', 'HDF5'],
-        help_text="NetCDF, DCD, HDF5. File type to write trajectory files")
+        choices=['DCD', 'NetCDF', 'HDF5', 'QTRJ'],
+        help_text="""NetCDF, DCD, HDF5, QTRJ. File type to write trajectory files.
+        QTRJ is a compressed lossy format with fixed coordinate precision""")
+
+    trajectory_subset = parameter.StringParameter(
+        'trajectory_subset',
+        default='',
+        help_text="""Mask selection of the atoms written in the trajectory e.g.
+                  protein or ligand. The selection can be refined by using logical
+                  tokens: not, noh, and, or, diff, around. If empty all the atoms
+                  are written""")
+
+    trajectory_precision = parameter.DecimalParameter(
+        'trajectory_precision',
+        default=0.001,
+        help_text="Coordinate precision in nanometers of the QTRJ trajectory files")
+
+    async_trajectory = parameter.BooleanParameter(
+        'async_trajectory',
+        default=True,
+        description="""Write the trajectory frames from a background thread instead of
+        stalling the simulation""")
 
     trajectory_interval = parameter.IntegerParameter(
         'trajectory_interval',
@@ -256,8 +358,20 @@ class OpenMMnvtCube(ParallelOEMolComputeCube):
     reporter_interval = parameter.IntegerParameter(
         'reporter_interval',
         default=0,
-        help_text="Step interval for reporting data. If 0 the reporter file"
-                  "will not be generated")
+        help_text="Step interval for reporting data. If 0 the energies "
+                  "will not be recorded")
+
+    text_log = parameter.BooleanParameter(
+        'text_log',
+        default=False,
+        description="""Also write the reported energies to the text .log file. The
+        energies are always attached to the molecule as binary table""")
+
+    progress_interval = parameter.DecimalParameter(
+        'progress_interval',
+        default=60.0,
+        help_text="""Minimum wall time in seconds between two progress lines
+        printed to stdout. If 0 the progress is not printed""")
 
     outfname = parameter.StringParameter(
         'outfname',
@@ -282,8 +396,9 @@ class OpenMMnvtCube(ParallelOEMolComputeCube):
     platform = parameter.StringParameter(
         'platform',
         default='Auto',
-        choices=['Auto', 'Reference', 'CPU', 'CUDA', 'OpenCL'],
-        help_text='Select which platform to use to run the simulation')
+        choices=['Auto', 'Auto-Benchmarked', 'Reference', 'CPU', 'CUDA', 'OpenCL'],
+        help_text="""Select which platform to use to run the simulation. Auto-Benchmarked
+        selects the fastest validated platform and precision from the host benchmarks""")
 
     cuda_opencl_precision = parameter.StringParameter(
         'cuda_opencl_precision',
@@ -291,15 +406,104 @@ class OpenMMnvtCube(ParallelOEMolComputeCube):
         choices=['single', 'mixed', 'double'],
         help_text='Select the CUDA or OpenCL precision')
 
+    cpu_threads = parameter.IntegerParameter(
+        'cpu_threads',
+        default=0,
+        help_text="""Number of CPU platform threads. If 0 the threads are set from
+        the CPUs available to each co-resident worker""")
+
+    cpu_workers = parameter.IntegerParameter(
+        'cpu_workers',
+        default=1,
+        help_text="Number of MD workers sharing the host CPUs")
+
+    cpu_pinning = parameter.BooleanParameter(
+        'cpu_pinning',
+        default=False,
+        description="Pin each worker to its own set of host CPUs")
+
+    cpu_calibration = parameter.BooleanParameter(
+        'cpu_calibration',
+        default=False,
+        description="""Select the CPU threads by a short benchmark of the
+        simulated system. The result is stored per host and computed once""")
+
+    integrator = parameter.StringParameter(
+        'integrator',
+        default='Langevin',
+        choices=['Langevin', 'LangevinMiddle', 'MTS', 'VerletAndersen'],
+        help_text="""Integrator family. Langevin, LangevinMiddle (BAOAB-like splitting),
+        MTS (multiple time step with the PME reciprocal space evaluated on the outer
+        time step) or VerletAndersen (Verlet with Andersen thermostat)""")
+
+    hmr = parameter.BooleanParameter(
+        'hmr',
+        default=False,
+        description="""Hydrogen mass repartitioning. The hydrogen masses are increased
+        to 4 amu, bonds to hydrogen are constrained and water is rigid. Required
+        by time steps larger than 2 fs""")
+
+    timestep = parameter.DecimalParameter(
+        'timestep',
+        default=2.0,
+        help_text="Integration time step in femtoseconds. Up to 4 fs with hydrogen mass repartitioning")
+
+    payload_codec = parameter.StringParameter(
+        'payload_codec',
+        default='none',
+        choices=['none', 'gzip', 'zstd', 'lz4'],
+        help_text="""Compression codec used for the MD data attached to the molecule.
+        zstd and lz4 fall back to gzip if not installed""")
+
+    payload_codec_level = parameter.IntegerParameter(
+        'payload_codec_level',
+        default=0,
+        help_text="Compression level. If 0 the codec default level is used")
+
+    system_cache = parameter.BooleanParameter(
+        'system_cache',
+        default=True,
+        description="""Reuse the serialized OpenMM System attached to the molecule
+        if it has been created with the same topology and settings""")
+
+    context_cache = parameter.BooleanParameter(
+        'context_cache',
+        default=False,
+        description="""Reuse the OpenMM Context of a previous molecule with the same
+        topology and settings. Up to 2 Contexts are kept alive per worker. For each
+        molecule the step counter, time, reporters, positions, velocities, box and
+        the restraint reference positions and weight are reset. The integrator and
+        barostat internal state, e.g. the random number stream and the barostat
+        move size, are carried over from the previous molecule. The reuses are only
+        reported as Context cache hits in the cube log""")
+
+    checkpoint_interval = parameter.IntegerParameter(
+        'checkpoint_interval',
+        default=100000,
+        help_text="""Step interval for the simulation checkpoints. If the same system
+        is processed again the simulation is resumed from the last checkpoint.
+        If 0 no checkpoint is written""")
+
+    checkpoint_dir = parameter.StringParameter(
+        'checkpoint_dir',
+        default='',
+        help_text='Local scratch directory for the checkpoint files. If empty the '
+                  'system temporary directory is used')
+
     def begin(self):
         self.opt = vars(self.args)
         self.opt['Logger'] = self.log
         self.opt['SimType'] = 'nvt'
+        self.codec = compression.get_codec(self.opt['payload_codec'], self.opt['payload_codec_level'])
+        self.opt['codec'] = self.codec
+        self.profiler = profiling.Profiler(self.name)
 
         return
 
     def process(self, mol, port):
         try:
+            self.profiler.start(mol.GetTitle())
+
             # The copy of the dictionary option as local variable
             # is necessary to avoid filename collisions due to
             # the parallel cube processes
@@ -317,19 +521,24 @@ class OpenMMnvtCube(ParallelOEMolComputeCube):
                 self.log.info("Updating parameters for molecule: {}\n{}".format(mol.GetTitle(), new_args))
                 opt.update(new_args)
 
-            if utils.PackageOEMol.checkTags(mol, ['Structure']):
-                gd = utils.PackageOEMol.unpack(mol)
+            if utils.PackageOEMol.checkStructure(mol):
+                gd = utils.PackageOEMol.unpack(mol, tags=['IDTag'])
                 opt['outfname'] = '{}-{}'.format(gd['IDTag'], self.opt['outfname'])
 
-            mdData = utils.MDData(mol)
+            with self.profiler.phase('decode'):
+                mdData = utils.MDData(mol)
 
             opt['molecule'] = mol
+            # The throughput SD tags are prefixed by the cube name
+            opt['stage_name'] = self.name
 
             self.log.info('START NVT SIMULATION: %s' % gd['IDTag'])
 
             simtools.simulation(mdData, **opt)
                 
-            packedmol = mdData.packMDData(mol)
+            with self.profiler.phase('encode'):
+                packedmol = mdData.packMDData(mol, codec=self.codec)
+            self.profiler.finish(packedmol)
 
             self.success.emit(packedmol)
 
@@ -337,6 +546,7 @@ class OpenMMnvtCube(ParallelOEMolComputeCube):
             # Attach error message to the molecule that failed
             self.log.error(traceback.format_exc())
             mol.SetData('error', str(e))
+            self.profiler.finish(mol)
             # Return failed mol
             self.failure.emit(mol)
          
@@ -369,6 +579,10 @@ class OpenMMnptCube(ParallelOEMolComputeCube):
         "item_count": {"default": 1}  # 1 molecule at a time
     }
 
+    # Port used to emit the not yet completed production segments. It is
+    # connected to the cube intake to re-queue the segments
+    segment = MoleculeOutputPort('segment')
+
     temperature = parameter.DecimalParameter(
         'temperature',
         default=300.0,
@@ -430,8 +644,28 @@ class OpenMMnptCube(ParallelOEMolComputeCube):
     trajectory_filetype = parameter.StringParameter(
         'trajectory_filetype',
         default='DCD',
-        choices=['DCD', 'NetCDF', 'HDF5'],
-        help_text="NetCDF, DCD, HDF5. File type to write trajectory files")
+        choices=['DCD', 'NetCDF', 'HDF5', 'QTRJ'],
+        help_text="""NetCDF, DCD, HDF5, QTRJ. File type to write trajectory files.
+        QTRJ is a compressed lossy format with fixed coordinate precision""")
+
+    trajectory_subset = parameter.StringParameter(
+        'trajectory_subset',
+        default='',
+        help_text="""Mask selection of the atoms written in the trajectory e.g.
+                  protein or ligand. The selection can be refined by using logical
+                  tokens: not, noh, and, or, diff, around. If empty all the atoms
+                  are written""")
+
+    trajectory_precision = parameter.DecimalParameter(
+        'trajectory_precision',
+        default=0.001,
+        help_text="Coordinate precision in nanometers of the QTRJ trajectory files")
+
+    async_trajectory = parameter.BooleanParameter(
+        'async_trajectory',
+        default=True,
+        description="""Write the trajectory frames from a background thread instead of
+        stalling the simulation""")
 
     trajectory_interval = parameter.IntegerParameter(
         'trajectory_interval',
@@ -442,8 +676,20 @@ class OpenMMnptCube(ParallelOEMolComputeCube):
     reporter_interval = parameter.IntegerParameter(
         'reporter_interval',
         default=0,
-        help_text="Step interval for reporting data. If 0 the reporter file"
-                  "will not be generated")
+        help_text="Step interval for reporting data. If 0 the energies "
+                  "will not be recorded")
+
+    text_log = parameter.BooleanParameter(
+        'text_log',
+        default=False,
+        description="""Also write the reported energies to the text .log file. The
+        energies are always attached to the molecule as binary table""")
+
+    progress_interval = parameter.DecimalParameter(
+        'progress_interval',
+        default=60.0,
+        help_text="""Minimum wall time in seconds between two progress lines
+        printed to stdout. If 0 the progress is not printed""")
 
     outfname = parameter.StringParameter(
         'outfname',
@@ -468,8 +714,9 @@ class OpenMMnptCube(ParallelOEMolComputeCube):
     platform = parameter.StringParameter(
         'platform',
         default='Auto', 
-        choices=['Auto', 'Reference', 'CPU', 'CUDA', 'OpenCL'],
-        help_text='Select which platform to use to run the simulation')
+        choices=['Auto', 'Auto-Benchmarked', 'Reference', 'CPU', 'CUDA', 'OpenCL'],
+        help_text="""Select which platform to use to run the simulation. Auto-Benchmarked
+        selects the fastest validated platform and precision from the host benchmarks""")
 
     cuda_opencl_precision = parameter.StringParameter(
         'cuda_opencl_precision',
@@ -477,15 +724,139 @@ class OpenMMnptCube(ParallelOEMolComputeCube):
         choices=['single', 'mixed', 'double'],
         help_text='Select the CUDA or OpenCL precision')
 
+    cpu_threads = parameter.IntegerParameter(
+        'cpu_threads',
+        default=0,
+        help_text="""Number of CPU platform threads. If 0 the threads are set from
+        the CPUs available to each co-resident worker""")
+
+    cpu_workers = parameter.IntegerParameter(
+        'cpu_workers',
+        default=1,
+        help_text="Number of MD workers sharing the host CPUs")
+
+    cpu_pinning = parameter.BooleanParameter(
+        'cpu_pinning',
+        default=False,
+        description="Pin each worker to its own set of host CPUs")
+
+    cpu_calibration = parameter.BooleanParameter(
+        'cpu_calibration',
+        default=False,
+        description="""Select the CPU threads by a short benchmark of the
+        simulated system. The result is stored per host and computed once""")
+
+    integrator = parameter.StringParameter(
+        'integrator',
+        default='Langevin',
+        choices=['Langevin', 'LangevinMiddle', 'MTS', 'VerletAndersen'],
+        help_text="""Integrator family. Langevin, LangevinMiddle (BAOAB-like splitting),
+        MTS (multiple time step with the PME reciprocal space evaluated on the outer
+        time step) or VerletAndersen (Verlet with Andersen thermostat)""")
+
+    hmr = parameter.BooleanParameter(
+        'hmr',
+        default=False,
+        description="""Hydrogen mass repartitioning. The hydrogen masses are increased
+        to 4 amu, bonds to hydrogen are constrained and water is rigid. Required
+        by time steps larger than 2 fs""")
+
+    timestep = parameter.DecimalParameter(
+        'timestep',
+        default=2.0,
+        help_text="Integration time step in femtoseconds. Up to 4 fs with hydrogen mass repartitioning")
+
+    payload_codec = parameter.StringParameter(
+        'payload_codec',
+        default='none',
+        choices=['none', 'gzip', 'zstd', 'lz4'],
+        help_text="""Compression codec used for the MD data attached to the molecule.
+        zstd and lz4 fall back to gzip if not installed""")
+
+    payload_codec_level = parameter.IntegerParameter(
+        'payload_codec_level',
+        default=0,
+        help_text="Compression level. If 0 the codec default level is used")
+
+    system_cache = parameter.BooleanParameter(
+        'system_cache',
+        default=True,
+        description="""Reuse the serialized OpenMM System attached to the molecule
+        if it has been created with the same topology and settings""")
+
+    context_cache = parameter.BooleanParameter(
+        'context_cache',
+        default=False,
+        description="""Reuse the OpenMM Context of a previous molecule with the same
+        topology and settings. Up to 2 Contexts are kept alive per worker. For each
+        molecule the step counter, time, reporters, positions, velocities, box and
+        the restraint reference positions and weight are reset. The integrator and
+        barostat internal state, e.g. the random number stream and the barostat
+        move size, are carried over from the previous molecule. The reuses are only
+        reported as Context cache hits in the cube log""")
+
+    checkpoint_interval = parameter.IntegerParameter(
+        'checkpoint_interval',
+        default=100000,
+        help_text="""Step interval for the simulation checkpoints. If the same system
+        is processed again the simulation is resumed from the last checkpoint.
+        If 0 no checkpoint is written""")
+
+    checkpoint_dir = parameter.StringParameter(
+        'checkpoint_dir',
+        default='',
+        help_text='Local scratch directory for the checkpoint files. If empty the '
+                  'system temporary directory is used')
+
+    segments = parameter.IntegerParameter(
+        'segments',
+        default=1,
+        help_text="""Number of segments the simulation time is split in. Each segment is
+        emitted on the segment port carrying the restart state and the references
+        to the segment output files, so the segments of different molecules
+        interleave. The segment port must be connected to the cube intake. The
+        segment files are merged at the end of the last segment. If 1 the
+        simulation is run in one go""")
+
+    segment_store = parameter.StringParameter(
+        'segment_store',
+        default='',
+        help_text="""Directory used as content-addressed store for the output files of
+        each completed segment. It must be shared by all the workers running the
+        cube. If empty the default local store is used, which is only shared by
+        the workers of the same host""")
+
+    adaptive = parameter.BooleanParameter(
+        'adaptive',
+        default=False,
+        description="""Adaptive equilibration. The simulation stops as soon as the density,
+        volume and potential energy are detected as equilibrated. The simulation time
+        is the maximum time. Not supported by segmented runs""")
+
+    adaptive_chunk = parameter.DecimalParameter(
+        'adaptive_chunk',
+        default=20.0,
+        help_text="Simulation time in ps between two equilibration checks")
+
+    adaptive_interval = parameter.IntegerParameter(
+        'adaptive_interval',
+        default=100,
+        help_text="Step interval for sampling the equilibration observables")
+
     def begin(self):
         self.opt = vars(self.args)
         self.opt['Logger'] = self.log
         self.opt['SimType'] = 'npt'
+        self.codec = compression.get_codec(self.opt['payload_codec'], self.opt['payload_codec_level'])
+        self.opt['codec'] = self.codec
+        self.profiler = profiling.Profiler(self.name)
 
         return
 
     def process(self, mol, port):
         try:
+            self.profiler.start(mol.GetTitle())
+
             # The copy of the dictionary option as local variable
             # is necessary to avoid filename collisions due to
             # the parallel cube processes
@@ -505,18 +876,365 @@ class OpenMMnptCube(ParallelOEMolComputeCube):
 
                 opt.update(new_args)
 
-            if utils.PackageOEMol.checkTags(mol, ['Structure']):
-                gd = utils.PackageOEMol.unpack(mol)
+            if utils.PackageOEMol.checkStructure(mol):
+                gd = utils.PackageOEMol.unpack(mol, tags=['IDTag'])
                 opt['outfname'] = '{}-{}'.format(gd['IDTag'], self.opt['outfname'])
 
-            mdData = utils.MDData(mol)
+            with self.profiler.phase('decode'):
+                mdData = utils.MDData(mol)
 
             opt['molecule'] = mol
+            # The throughput SD tags are prefixed by the cube name
+            opt['stage_name'] = self.name
+
+            # Segmented production: the segment index is attached to the molecule
+            segment = None
+            if self.opt['segments'] > 1:
+                segment = 0
+                if mol.HasData(oechem.OEGetTag('MDSegment')):
+                    segment = int(mol.GetData(oechem.OEGetTag('MDSegment')))
+                merge_opt = dict(opt)
+                opt['time'] = self.opt['time'] / self.opt['segments']
+                opt['segment'] = segment
+                opt['outfname'] = '{}_seg{}'.format(merge_opt['outfname'], segment)
+                opt['process_files'] = False
+                self.log.info('START NPT SIMULATION %s SEGMENT %d/%d' % (gd['IDTag'], segment + 1,
+                                                                        self.opt['segments']))
+            else:
+                self.log.info('START NPT SIMULATION %s' % gd['IDTag'])
 
-            self.log.info('START NPT SIMULATION %s' % gd['IDTag'])
             simtools.simulation(mdData, **opt)
                 
-            packedmol = mdData.packMDData(mol)
+            with self.profiler.phase('encode'):
+                packedmol = mdData.packMDData(mol, codec=self.codec)
+            self.profiler.finish(packedmol)
+
+            if segment is not None and segment + 1 < self.opt['segments']:
+                # Re-queue the next segment. The segment output files are saved in the
+                # shared store since the next segment may run on another worker
+                opt['molecule'] = packedmol
+                simtools.store_segment_files(**opt)
+                packedmol.SetData(oechem.OEGetTag('MDSegment'), segment + 1)
+                self.segment.emit(packedmol)
+            else:
+                if segment is not None:
+                    packedmol.DeleteData(oechem.OEGetTag('MDSegment'))
+                    merge_opt['molecule'] = packedmol
+                    simtools.merge_segments(self.opt['segments'], **merge_opt)
+
+                self.success.emit(packedmol)
+
+        except Exception as e:
+            # Attach error message to the molecule that failed
+            self.log.error(traceback.format_exc())
+            mol.SetData('error', str(e))
+            self.profiler.finish(mol)
+            # Return failed mol
+            self.failure.emit(mol)
+
+        return
+
+
+class OpenMMprotocolCube(ParallelOEMolComputeCube):
+    title = 'MD Protocol Cube'
+    version = "0.0.0"
+    classification = [["Simulation", "OpenMM", "Protocol"]]
+    tags = ['OpenMM', 'Parallel Cube']
+
+    description = """Multi-stage MD protocol of the protein:ligand complex.
+
+    This cube will take in the streamed complex.oeb.gz file containing
+    the solvated protein:ligand complex and will run a sequence of
+    minimization, NVT and NPT stages in a single OpenMM Context.
+    The restraint weight is updated and the barostat is switched on and
+    off between the stages without rebuilding the simulation
+
+    Input parameters:
+    ----------------
+      stages (string): JSON list of stages. Each stage is a dictionary with the
+      keys: type (min, nvt or npt), name, steps (min), time (picoseconds),
+      restraints, restraintWt, trajectory_interval, reporter_interval,
+      outfname and emit. The emit key selects the optional output port
+      (minimization or equilibration) where the system is emitted at
+      the end of the stage
+      temperature (decimal): target temperature
+      pressure (decimal): target pressure
+    """
+
+    # Override defaults for some parameters
+    parameter_overrides = {
+        "prefetch_count": {"default": 1},  # 1 molecule at a time
+        "item_timeout": {"default": 43200},  # Default 12 hour limit (units are seconds)
+        "item_count": {"default": 1}  # 1 molecule at a time
+    }
+
+    # Optional ports used to emit the systems at the end of the selected stages
+    minimization = MoleculeOutputPort('minimization')
+    equilibration = MoleculeOutputPort('equilibration')
+
+    stages = parameter.StringParameter(
+        'stages',
+        default=json.dumps([
+            {"name": "minimization", "type": "min", "steps": 20000,
+             "restraints": "noh (ligand or protein)", "restraintWt": 5.0, "emit": "minimization"},
+            {"name": "warmup", "type": "nvt", "time": 100.0,
+             "restraints": "noh (ligand or protein)", "restraintWt": 2.0},
+            {"name": "equil1", "type": "npt", "time": 100.0,
+             "restraints": "noh (ligand or protein)", "restraintWt": 2.0},
+            {"name": "equil2", "type": "npt", "time": 100.0,
+             "restraints": "noh (ligand or protein)", "restraintWt": 0.5},
+            {"name": "equil3", "type": "npt", "time": 200.0,
+             "restraints": "ca_protein or (noh ligand)", "restraintWt": 0.1, "emit": "equilibration"},
+            {"name": "prod", "type": "npt", "time": 2000.0,
+             "trajectory_interval": 1000, "reporter_interval": 1000}]),
+        help_text="""JSON list of the protocol stages. Each stage requires the type key
+        (min, nvt or npt) and can set: name, steps, time, restraints, restraintWt,
+        tolerance, restraint_release, trajectory_interval, reporter_interval,
+        outfname and emit""")
+
+    temperature = parameter.DecimalParameter(
+        'temperature',
+        default=300.0,
+        help_text="Temperature (Kelvin)")
+
+    pressure = parameter.DecimalParameter(
+        'pressure',
+        default=1.0,
+        help_text="Pressure (atm)")
+
+    freeze = parameter.StringParameter(
+        'freeze',
+        default='',
+        help_text="""Mask selection to freeze atoms along the MD simulation.
+                  Possible keywords are: ligand, protein, water, ions, ca_protein,
+                  cofactors. The selection can be refined by using logical tokens:
+                  not, noh, and, or, diff, around""")
+
+    nonbondedMethod = parameter.StringParameter(
+        'nonbondedMethod',
+        default='PME',
+        choices=['NoCutoff', 'CutoffNonPeriodic',
+                 'CutoffPeriodic', 'PME', 'Ewald'],
+        help_text="NoCutoff, CutoffNonPeriodic, CutoffPeriodic, PME, or Ewald.")
+
+    nonbondedCutoff = parameter.DecimalParameter(
+        'nonbondedCutoff',
+        default=10,
+        help_text="""The non-bonded cutoff in angstroms.
+        This is ignored if non-bonded method is NoCutoff""")
+
+    constraints = parameter.StringParameter(
+        'constraints',
+        default='HBonds',
+        choices=['None', 'HBonds', 'HAngles', 'AllBonds'],
+        help_text="""None, HBonds, HAngles, or AllBonds
+        Which type of constraints to add to the system (e.g., SHAKE).
+        None means no bonds are constrained.
+        HBonds means bonds with hydrogen are constrained""")
+
+    trajectory_filetype = parameter.StringParameter(
+        'trajectory_filetype',
+        default='DCD',
+        choices=['DCD', 'NetCDF', 'HDF5', 'QTRJ'],
+        help_text="""NetCDF, DCD, HDF5, QTRJ. File type to write trajectory files.
+        QTRJ is a compressed lossy format with fixed coordinate precision""")
+
+    trajectory_subset = parameter.StringParameter(
+        'trajectory_subset',
+        default='',
+        help_text="""Mask selection of the atoms written in the trajectory e.g.
+                  protein or ligand. The selection can be refined by using logical
+                  tokens: not, noh, and, or, diff, around. If empty all the atoms
+                  are written""")
+
+    trajectory_precision = parameter.DecimalParameter(
+        'trajectory_precision',
+        default=0.001,
+        help_text="Coordinate precision in nanometers of the QTRJ trajectory files")
+
+    async_trajectory = parameter.BooleanParameter(
+        'async_trajectory',
+        default=True,
+        description="""Write the trajectory frames from a background thread instead of
+        stalling the simulation""")
+
+    trajectory_interval = parameter.IntegerParameter(
+        'trajectory_interval',
+        default=0,
+        help_text="Default step interval for trajectory snapshots of the stages. If 0 the "
+                  "trajectory file will not be generated")
+
+    reporter_interval = parameter.IntegerParameter(
+        'reporter_interval',
+        default=0,
+        help_text="Default step interval for reporting data of the stages. If 0 the reporter "
+                  "file will not be generated")
+
+    text_log = parameter.BooleanParameter(
+        'text_log',
+        default=False,
+        description="""Also write the reported energies to the text .log file. The
+        energies are always attached to the molecule as binary table""")
+
+    progress_interval = parameter.DecimalParameter(
+        'progress_interval',
+        default=60.0,
+        help_text="""Minimum wall time in seconds between two progress lines
+        printed to stdout. If 0 the progress is not printed""")
+
+    tar = parameter.BooleanParameter(
+        'tar',
+        default=False,
+        description='Create a tar.xz file of the attached data')
+
+    center = parameter.BooleanParameter(
+        'center',
+        default=True,
+        description='Center the system to the OpenMM unit cell')
+
+    verbose = parameter.BooleanParameter(
+        'verbose',
+        default=True,
+        description='Increase log file verbosity.')
+
+    platform = parameter.StringParameter(
+        'platform',
+        default='Auto',
+        choices=['Auto', 'Auto-Benchmarked', 'Reference', 'CPU', 'CUDA', 'OpenCL'],
+        help_text="""Select which platform to use to run the simulation. Auto-Benchmarked
+        selects the fastest validated platform and precision from the host benchmarks""")
+
+    cuda_opencl_precision = parameter.StringParameter(
+        'cuda_opencl_precision',
+        default='single',
+        choices=['single', 'mixed', 'double'],
+        help_text='Select the CUDA or OpenCL precision')
+
+    cpu_threads = parameter.IntegerParameter(
+        'cpu_threads',
+        default=0,
+        help_text="""Number of CPU platform threads. If 0 the threads are set from
+        the CPUs available to each co-resident worker""")
+
+    cpu_workers = parameter.IntegerParameter(
+        'cpu_workers',
+        default=1,
+        help_text="Number of MD workers sharing the host CPUs")
+
+    cpu_pinning = parameter.BooleanParameter(
+        'cpu_pinning',
+        default=False,
+        description="Pin each worker to its own set of host CPUs")
+
+    cpu_calibration = parameter.BooleanParameter(
+        'cpu_calibration',
+        default=False,
+        description="""Select the CPU threads by a short benchmark of the
+        simulated system. The result is stored per host and computed once""")
+
+    integrator = parameter.StringParameter(
+        'integrator',
+        default='Langevin',
+        choices=['Langevin', 'LangevinMiddle', 'MTS', 'VerletAndersen'],
+        help_text="""Integrator family. Langevin, LangevinMiddle (BAOAB-like splitting),
+        MTS (multiple time step with the PME reciprocal space evaluated on the outer
+        time step) or VerletAndersen (Verlet with Andersen thermostat)""")
+
+    hmr = parameter.BooleanParameter(
+        'hmr',
+        default=False,
+        description="""Hydrogen mass repartitioning. The hydrogen masses are increased
+        to 4 amu, bonds to hydrogen are constrained and water is rigid. Required
+        by time steps larger than 2 fs""")
+
+    timestep = parameter.DecimalParameter(
+        'timestep',
+        default=2.0,
+        help_text="Integration time step in femtoseconds. Up to 4 fs with hydrogen mass repartitioning")
+
+    payload_codec = parameter.StringParameter(
+        'payload_codec',
+        default='none',
+        choices=['none', 'gzip', 'zstd', 'lz4'],
+        help_text="""Compression codec used for the MD data attached to the molecule.
+        zstd and lz4 fall back to gzip if not installed""")
+
+    payload_codec_level = parameter.IntegerParameter(
+        'payload_codec_level',
+        default=0,
+        help_text="Compression level. If 0 the codec default level is used")
+
+    system_cache = parameter.BooleanParameter(
+        'system_cache',
+        default=True,
+        description="""Reuse the serialized OpenMM System attached to the molecule
+        if it has been created with the same topology and settings""")
+
+    def begin(self):
+        self.opt = vars(self.args)
+        self.opt['Logger'] = self.log
+        self.codec = compression.get_codec(self.opt['payload_codec'], self.opt['payload_codec_level'])
+        self.opt['codec'] = self.codec
+        self.profiler = profiling.Profiler(self.name)
+
+        self.stages = json.loads(self.opt['stages'])
+
+        for idx, stage in enumerate(self.stages):
+            if stage.get('type') not in ['min', 'nvt', 'npt']:
+                raise ValueError('Stage {}: the stage type must be min, nvt or npt'.format(idx))
+            if stage.get('emit') and stage['emit'] not in ['minimization', 'equilibration']:
+                raise ValueError('Stage {}: unknown emit port {}'.format(idx, stage['emit']))
+            stage.setdefault('name', 'stage{}'.format(idx))
+
+        return
+
+    def process(self, mol, port):
+        try:
+            self.profiler.start(mol.GetTitle())
+
+            # The copy of the dictionary option as local variable
+            # is necessary to avoid filename collisions due to
+            # the parallel cube processes
+            opt = dict(self.opt)
+
+            # Update cube simulation parameters with the eventually molecule SD tags
+            new_args = {dp.GetTag(): dp.GetValue() for dp in oechem.OEGetSDDataPairs(mol) if dp.GetTag() in
+                        ["temperature", "pressure"]}
+
+            if new_args:
+                for k in new_args:
+                    try:
+                        new_args[k] = float(new_args[k])
+                    except:
+                        pass
+                self.log.info("Updating parameters for molecule: {}\n{}".format(mol.GetTitle(), new_args))
+
+                opt.update(new_args)
+
+            if utils.PackageOEMol.checkStructure(mol):
+                gd = utils.PackageOEMol.unpack(mol, tags=['IDTag'])
+
+            stages = []
+            for stage in self.stages:
+                stage = dict(stage)
+                stage['outfname'] = '{}-{}'.format(gd['IDTag'], stage.get('outfname', stage['name']))
+                stages.append(stage)
+
+            with self.profiler.phase('decode'):
+                mdData = utils.MDData(mol)
+
+            opt['molecule'] = mol
+
+            def emit(stage):
+                packedmol = mdData.packMDData(oechem.OEMol(mol), codec=self.codec)
+                getattr(self, stage['emit']).emit(packedmol)
+
+            self.log.info('START MD PROTOCOL %s' % gd['IDTag'])
+            simtools.protocol(mdData, stages, emit=emit, **opt)
+
+            with self.profiler.phase('encode'):
+                packedmol = mdData.packMDData(mol, codec=self.codec)
+            self.profiler.finish(packedmol)
 
             self.success.emit(packedmol)
 
@@ -524,7 +1242,8 @@ class OpenMMnptCube(ParallelOEMolComputeCube):
             # Attach error message to the molecule that failed
             self.log.error(traceback.format_exc())
             mol.SetData('error', str(e))
+            self.profiler.finish(mol)
             # Return failed mol
             self.failure.emit(mol)
 
-        return
\ No newline at end of file
+        return
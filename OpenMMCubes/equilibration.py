@@ -0,0 +1,122 @@
+import numpy as np
+
+try:
+    from pymbar import timeseries
+except ImportError:
+    timeseries = None
+
+# Minimum number of samples before the equilibration is tested
+MIN_SAMPLES = 20
+# The equilibration is detected if the equilibrated region
+# covers at least this fraction of the samples
+MIN_EQUILIBRATED_FRACTION = 0.5
+# Observables of the energy table monitored along the NPT equilibration
+OBSERVABLES = ['density', 'volume', 'potential']
+
+
+def statistical_inefficiency(x, mintime=3):
+    """
+    Statistical inefficiency of the passed time series computed by the
+    same integrated autocorrelation method of pymbar.timeseries
+    """
+    x = np.asarray(x, dtype=np.float64)
+    n = x.size
+    dx = x - x.mean()
+    sigma2 = (dx * dx).mean()
+
+    if sigma2 == 0.0:
+        return 1.0
+
+    g = 1.0
+    t = 1
+    while t < n - 1:
+        c = np.sum(dx[0:n - t] * dx[t:n]) / (float(n - t) * sigma2)
+        if c <= 0.0 and t > mintime:
+            break
+        g += 2.0 * c * (1.0 - float(t) / float(n))
+        t += 1
+
+    return max(g, 1.0)
+
+
+def detect_equilibration(x, nskip=1):
+    """
+    This function detects the equilibrated region of a time series as
+    the starting sample which maximizes the number of uncorrelated
+    samples (Chodera, JCTC 12:1799, 2016). pymbar.timeseries.detectEquilibration
+    is used if pymbar is installed
+
+    Parameters
+    ----------
+    x : numpy array
+        The time series
+    nskip : int
+        The interval between the tested starting samples
+
+    Returns
+    -------
+    t0 : int
+        The first sample of the equilibrated region
+    g : float
+        The statistical inefficiency of the equilibrated region
+    neff : float
+        The number of uncorrelated samples of the equilibrated region
+    """
+    x = np.asarray(x, dtype=np.float64)
+
+    if timeseries is not None:
+        t0, g, neff = timeseries.detectEquilibration(x, nskip=nskip)
+        return int(t0), float(g), float(neff)
+
+    n = x.size
+    if n < 2 or x.std() == 0.0:
+        return 0, 1.0, float(n)
+
+    best = (0, 1.0, -1.0)
+    for t in range(0, n - 1, nskip):
+        g = statistical_inefficiency(x[t:])
+        neff = (n - t) / g
+        if neff > best[2]:
+            best = (t, g, neff)
+
+    return best
+
+
+def equilibrated(table, observables=OBSERVABLES, min_samples=MIN_SAMPLES, fraction=MIN_EQUILIBRATED_FRACTION):
+    """
+    Checks if all the selected observables of the energy table are
+    equilibrated: the equilibrated region detected for each of them
+    must cover at least the selected fraction of the samples
+
+    Parameters
+    ----------
+    table : dict
+        The energy table recorded by the EnergyReporter
+    observables : list of str
+        The monitored columns of the table
+    min_samples : int
+        The minimum number of samples
+    fraction : float
+        The minimum fraction of equilibrated samples
+
+    Returns
+    -------
+    t0 : int or None
+        The first equilibrated sample of all the observables or
+        None if the system is not equilibrated yet
+    """
+    n = len(table['step'])
+    if n < min_samples:
+        return None
+
+    t0 = 0
+    for name in observables:
+        values = table[name]
+        if not np.all(np.isfinite(values)):
+            continue
+        t, g, neff = detect_equilibration(values, nskip=max(1, n // 100))
+        if n - t < fraction * n:
+            return None
+        t0 = max(t0, t)
+
+    return t0
@@ -0,0 +1,116 @@
+import re
+import numpy as np
+from collections import OrderedDict
+from oeommtools import utils as oeommutils
+from OpenMMCubes import store
+from OpenMMCubes.spatial import CellGrid, coords_by_idx, residue_index
+from OpenMMCubes.utils import PackageOEMol
+
+# Selections cached by (topology hash, mask). The masks using the around
+# operator depend on the coordinates and are also keyed by a coordinate digest
+_MASK_CACHE = OrderedDict()
+_MASK_CACHE_SIZE = 64
+
+# Residue index of each atom cached by topology hash
+_RESIDUES = OrderedDict()
+_RESIDUES_SIZE = 16
+
+# Distance selection: "5.0 around ligand"
+_AROUND = re.compile(r'^\s*(\d+(?:\.\d*)?)\s+around\s+(.+?)\s*$')
+
+
+def _cache_get(cache, key):
+    if key is not None and key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    return None
+
+
+def _cache_put(cache, key, value, size):
+    if key is not None:
+        cache[key] = value
+        if len(cache) > size:
+            cache.popitem(last=False)
+    return value
+
+
+def _residue_index(molecule, topology_hash=None):
+    """
+    Returns the array of residue numbers indexed by atom index,
+    cached by topology hash
+    """
+    residues = _cache_get(_RESIDUES, topology_hash)
+    if residues is not None and len(residues) == molecule.GetMaxAtomIdx():
+        return residues
+
+    return _cache_put(_RESIDUES, topology_hash, residue_index(molecule), _RESIDUES_SIZE)
+
+
+def _select_around(molecule, cutoff, mask, topology_hash=None):
+    """
+    Selects the residues which have at least one atom within the cutoff
+    distance in angstroms from the atoms selected by the mask. As in the
+    oeommtools mask language, the atoms selected by the mask are excluded
+    """
+    ref = select_atoms(molecule, mask)
+    if not len(ref):
+        return ref
+
+    xyz = coords_by_idx(molecule)
+    residues = _residue_index(molecule, topology_hash)
+
+    atoms = np.nonzero(residues >= 0)[0]
+    grid = CellGrid(xyz[atoms], cutoff)
+    close = atoms[grid.within(xyz[ref], cutoff)]
+
+    selected = np.isin(residues, np.unique(residues[close])) & (residues >= 0)
+    selected[ref] = False
+
+    return np.nonzero(selected)[0].astype(np.int64)
+
+
+def select_atoms(molecule, mask):
+    """
+    This function selects the atoms of the passed molecule by using the
+    mask language of oeommtools (not, noh, and, or, diff, around). The
+    selections are cached by topology hash and mask, therefore the same
+    mask is evaluated only once on the same topology. The simple
+    "distance around mask" selections are evaluated by using a cell
+    grid spatial index
+
+    Parameters
+    ----------
+    molecule : OEMol
+        The molecule to select from
+    mask : str
+        The selection mask
+
+    Returns
+    -------
+    atom_indices : numpy array
+        The sorted indexes of the selected atoms
+    """
+    topology_hash = PackageOEMol.getTopologyHash(molecule)
+
+    key = None
+    if topology_hash is not None:
+        key = (topology_hash, mask)
+        if 'around' in mask:
+            key += (store.digest(coords_by_idx(molecule).tobytes()),)
+
+    atom_indices = _cache_get(_MASK_CACHE, key)
+    if atom_indices is not None:
+        return atom_indices
+
+    around = _AROUND.match(mask)
+
+    if around and 'around' not in around.group(2):
+        atom_indices = _select_around(molecule, float(around.group(1)), around.group(2), topology_hash)
+    else:
+        atom_indices = np.array(sorted(oeommutils.select_oemol_atom_idx_by_language(molecule, mask=mask)),
+                                dtype=np.int64)
+
+    # The cached arrays are shared
+    atom_indices.flags.writeable = False
+
+    return _cache_put(_MASK_CACHE, key, atom_indices, _MASK_CACHE_SIZE)
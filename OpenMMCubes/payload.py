@@ -0,0 +1,159 @@
+import struct
+from collections import OrderedDict
+import numpy as np
+from OpenMMCubes import compression
+
+# The first byte is not part of the base64 alphabet, therefore
+# a binary payload can never be mistaken for a legacy base64 pickle
+MAGIC = b'\x93OMD'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sHHI')
+# The low byte of the header flags stores the compression codec id
+_CODEC_MASK = 0xff
+_ARRAY = 0
+_BYTES = 1
+
+
+def is_payload(data):
+    """
+    Returns True if the passed data has been produced by the encode function
+    """
+    return isinstance(data, (bytes, bytearray)) and bytes(data[:len(MAGIC)]) == MAGIC
+
+
+def encode(blocks, codec=None):
+    """
+    This function packs a set of named blocks into a single binary payload.
+    Numpy arrays are stored as raw little-endian buffers together with their
+    dtype and shape, while bytes blocks are stored verbatim. The blocks are
+    compressed with the selected codec, which is recorded in the header
+
+    Parameters
+    ----------
+    blocks : dict or list of (name, value) pairs
+        The blocks to pack. Values can be numpy arrays or bytes. None
+        values are skipped
+    codec : str, compression.Codec or None
+        The compression codec. None means no compression
+
+    Returns
+    -------
+    payload : bytes
+        The binary payload
+    """
+    if isinstance(blocks, dict):
+        blocks = list(blocks.items())
+
+    blocks = [(name, value) for name, value in blocks if value is not None]
+    codec = compression.get_codec(codec)
+
+    chunks = []
+
+    for name, value in blocks:
+        bname = name.encode('utf-8')
+        chunks.append(struct.pack('<H', len(bname)))
+        chunks.append(bname)
+
+        if isinstance(value, (bytes, bytearray)):
+            chunks.append(struct.pack('<BQ', _BYTES, len(value)))
+            chunks.append(bytes(value))
+        else:
+            array = np.ascontiguousarray(value)
+            array = array.astype(array.dtype.newbyteorder('<'), copy=False)
+            dtype = array.dtype.str.encode('ascii')
+            chunks.append(struct.pack('<BB', _ARRAY, len(dtype)))
+            chunks.append(dtype)
+            chunks.append(struct.pack('<B', array.ndim))
+            chunks.append(struct.pack('<{}Q'.format(array.ndim), *array.shape))
+            chunks.append(struct.pack('<Q', array.nbytes))
+            chunks.append(array.tobytes())
+
+    header = _HEADER.pack(MAGIC, VERSION, codec.id & _CODEC_MASK, len(blocks))
+
+    return header + codec.compress(b''.join(chunks))
+
+
+def get_codec(data):
+    """
+    Returns the codec used to compress the passed payload
+    """
+    version, flags, nblocks = read_header(data)
+    return compression.codec_from_id(flags & _CODEC_MASK)
+
+
+def read_header(data):
+    """
+    Returns the (version, flags, number of blocks) tuple of the passed payload
+    """
+    if not is_payload(data):
+        raise ValueError('The passed data is not a binary MD payload')
+
+    magic, version, flags, nblocks = _HEADER.unpack_from(data, 0)
+
+    if version > VERSION:
+        raise ValueError('Unsupported payload version {}. The maximum supported '
+                         'version is {}'.format(version, VERSION))
+
+    return version, flags, nblocks
+
+
+def decode(data):
+    """
+    This function unpacks a binary payload produced by the encode function
+
+    Parameters
+    ----------
+    data : bytes
+        The binary payload
+
+    Returns
+    -------
+    blocks : OrderedDict
+        The unpacked blocks as name: numpy array or bytes
+    """
+    version, flags, nblocks = read_header(data)
+
+    codec = compression.codec_from_id(flags & _CODEC_MASK)
+
+    if codec.id:
+        data = codec.decompress(bytes(memoryview(data)[_HEADER.size:]))
+        offset = 0
+    else:
+        offset = _HEADER.size
+
+    view = memoryview(data)
+    blocks = OrderedDict()
+
+    for i in range(nblocks):
+        name_len, = struct.unpack_from('<H', data, offset)
+        offset += 2
+        name = bytes(view[offset:offset + name_len]).decode('utf-8')
+        offset += name_len
+
+        kind, = struct.unpack_from('<B', data, offset)
+        offset += 1
+
+        if kind == _BYTES:
+            nbytes, = struct.unpack_from('<Q', data, offset)
+            offset += 8
+            blocks[name] = bytes(view[offset:offset + nbytes])
+        elif kind == _ARRAY:
+            dtype_len, = struct.unpack_from('<B', data, offset)
+            offset += 1
+            dtype = np.dtype(bytes(view[offset:offset + dtype_len]).decode('ascii'))
+            offset += dtype_len
+            ndim, = struct.unpack_from('<B', data, offset)
+            offset += 1
+            shape = struct.unpack_from('<{}Q'.format(ndim), data, offset)
+            offset += 8 * ndim
+            nbytes, = struct.unpack_from('<Q', data, offset)
+            offset += 8
+            # The copy detaches the array from the molecule data buffer
+            blocks[name] = np.frombuffer(view[offset:offset + nbytes], dtype=dtype).reshape(shape).copy()
+        else:
+            raise ValueError('Unknown block type {} for block {}'.format(kind, name))
+
+        offset += nbytes
+
+    return blocks
@@ -0,0 +1,490 @@
+import os
+import json
+import atexit
+import tempfile
+import platform
+import numpy as np
+from simtk import unit, openmm
+from OpenMMCubes import store
+from PlatformTestCubes.benchmarking import timeIntegration
+from PlatformTestCubes.testInstallation import median_force_error
+
+# File name of the per host CPU thread calibrations
+CPU_CALIBRATION_FNAME = 'cpu_threads.json'
+
+# File name of the per host platform benchmarks
+BENCHMARK_FNAME = 'platform_benchmarks.json'
+
+# Maximum median relative force difference from the Reference platform
+FORCE_TOLERANCE = 1e-3
+
+# Precisions benchmarked on the CUDA and OpenCL platforms
+GPU_PRECISIONS = ['single', 'mixed']
+
+# Names of the NonbondedForce methods
+NONBONDED_METHODS = ['NoCutoff', 'CutoffNonPeriodic', 'CutoffPeriodic', 'Ewald', 'PME', 'LJPME']
+
+# Calibration run length
+CALIBRATION_STEPS = 100
+CALIBRATION_TIME_STEP = 0.002
+
+# Worker slot claimed by this process and its CPU set
+_WORKER_SLOT = None
+_WORKER_CPUS = None
+
+
+def cache_dir():
+    """
+    Returns the directory of the per host platform data. The location
+    can be changed with the OPENMM_CUBES_CACHE environment variable
+    """
+    path = os.environ.get('OPENMM_CUBES_CACHE', os.path.join(os.path.expanduser('~'), '.openmm_cubes'))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _cpu_model():
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except IOError:
+        pass
+    return platform.processor()
+
+
+def host_fingerprint():
+    """
+    Returns a digest identifying the host hardware and the OpenMM version
+    """
+    host = [platform.node(), platform.machine(), _cpu_model(), os.cpu_count(), openmm.version.version]
+    return store.digest(json.dumps(host).encode())
+
+
+def atom_bucket(natoms):
+    """
+    Returns the power of two atom count bucket used to key the calibrations
+    """
+    return int(2 ** np.ceil(np.log2(max(natoms, 1))))
+
+
+def available_cpus():
+    """
+    Returns the sorted list of the CPUs this process is allowed to run on
+    """
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count()))
+
+
+def load_host_data(fname):
+    """
+    Loads the per host JSON data file from the cache directory
+    """
+    path = os.path.join(cache_dir(), fname)
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError:
+        # A corrupted file is recomputed
+        return {}
+
+
+def save_host_data(fname, key, value):
+    """
+    Updates the selected key of the per host JSON data file. The file
+    is replaced atomically since several workers can share it
+    """
+    data = load_host_data(fname)
+    data[key] = value
+    path = os.path.join(cache_dir(), fname)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + fname)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _release_slot(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def claim_worker_slot(workers):
+    """
+    Claims one of the worker slots of the host by creating a lock file
+    with the process id. The slots of dead processes are reclaimed
+
+    Returns
+    -------
+    slot : int
+        The worker slot in the range [0, workers)
+    """
+    global _WORKER_SLOT
+
+    if _WORKER_SLOT is not None:
+        return _WORKER_SLOT
+
+    path = os.path.join(cache_dir(), 'workers')
+    os.makedirs(path, exist_ok=True)
+
+    for slot in range(workers):
+        fname = os.path.join(path, 'slot_{}.pid'.format(slot))
+        for attempt in range(2):
+            try:
+                fd = os.open(fname, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    with open(fname) as f:
+                        pid = int(f.read().strip() or 0)
+                except (IOError, ValueError):
+                    pid = 0
+                if pid == os.getpid():
+                    _WORKER_SLOT = slot
+                    return slot
+                if pid and _pid_alive(pid):
+                    break
+                _release_slot(fname)
+                continue
+            with os.fdopen(fd, 'w') as f:
+                f.write(str(os.getpid()))
+            atexit.register(_release_slot, fname)
+            _WORKER_SLOT = slot
+            return slot
+
+    # More workers than declared: share a slot
+    _WORKER_SLOT = os.getpid() % workers
+    return _WORKER_SLOT
+
+
+def worker_cpus(workers, pinning=False, logger=None):
+    """
+    Returns the CPU set of this worker. The host CPUs are split in equal
+    contiguous sets, one for each co-resident worker. If pinning is
+    selected the process is bound to its CPU set
+
+    Parameters
+    ----------
+    workers : int
+        The number of MD workers running on the host
+    pinning : bool
+        If True the process affinity is set to the worker CPU set
+    logger : Logger or None
+        The logger
+
+    Returns
+    -------
+    cpus : list
+        The CPUs of the worker
+    """
+    global _WORKER_CPUS
+
+    if _WORKER_CPUS is not None:
+        return _WORKER_CPUS
+
+    cpus = available_cpus()
+    workers = max(1, min(workers, len(cpus)))
+
+    if not pinning:
+        return cpus[:max(1, len(cpus) // workers)]
+
+    slot = claim_worker_slot(workers)
+    size = len(cpus) // workers
+    _WORKER_CPUS = cpus[slot * size:(slot + 1) * size]
+
+    try:
+        os.sched_setaffinity(0, _WORKER_CPUS)
+        if logger is not None:
+            logger.info('Worker slot {} pinned to the CPUs {}'.format(slot, _WORKER_CPUS))
+    except (AttributeError, OSError) as e:
+        if logger is not None:
+            logger.warn('It was not possible to pin the worker to the CPUs {}: {}'.format(_WORKER_CPUS, str(e)))
+
+    return _WORKER_CPUS
+
+
+def _ns_per_day(system, positions, box, properties, platform_name='CPU', steps=CALIBRATION_STEPS):
+    """
+    Runs a short Langevin simulation of a copy of the passed System
+    and returns the simulation speed in ns/day
+    """
+    system = openmm.XmlSerializer.deserialize(openmm.XmlSerializer.serialize(system))
+    dt = CALIBRATION_TIME_STEP * unit.picoseconds
+    integrator = openmm.LangevinIntegrator(300 * unit.kelvin, 1 / unit.picoseconds, dt)
+    context = openmm.Context(system, integrator, openmm.Platform.getPlatformByName(platform_name), properties)
+    context.setPositions(positions)
+    if box is not None:
+        context.setPeriodicBoxVectors(box[0], box[1], box[2])
+    context.setVelocitiesToTemperature(300 * unit.kelvin)
+
+    elapsed = timeIntegration(context, steps, 5)
+    del context, integrator
+
+    return (dt * steps * 86400 / max(elapsed, 1e-9)).value_in_unit(unit.nanoseconds)
+
+
+def calibrate_cpu_threads(system, positions, box, workers, max_threads, logger=None):
+    """
+    Selects the CPU platform thread count which maximizes the aggregate
+    simulation speed of the co-resident workers. The tested thread
+    counts are the powers of two up to the CPUs available per worker
+
+    Returns
+    -------
+    threads : int
+        The selected thread count
+    speeds : dict
+        The aggregate ns/day measured for each thread count
+    """
+    candidates = sorted(set([2**i for i in range(int(np.log2(max_threads)) + 1)] + [max_threads]))
+
+    speeds = {}
+    for threads in candidates:
+        speeds[threads] = workers * _ns_per_day(system, positions, box, {'Threads': str(threads)})
+        if logger is not None:
+            logger.info('CPU calibration: {} threads x {} workers {:.3f} ns/day'.format(threads, workers,
+                                                                                   speeds[threads]))
+
+    return max(speeds, key=speeds.get), speeds
+
+
+def cpu_threads(system=None, positions=None, box=None, **opt):
+    """
+    Returns the CPU platform thread count for this worker. An explicit
+    cpu_threads option is used as is, otherwise the threads are set
+    to the CPUs per co-resident worker or, if cpu_calibration is
+    selected, to the calibrated value persisted for the host
+    """
+    logger = opt.get('Logger')
+
+    if opt.get('cpu_threads', 0) > 0:
+        return opt['cpu_threads']
+
+    workers = max(1, opt.get('cpu_workers', 1))
+    cpus = worker_cpus(workers, pinning=opt.get('cpu_pinning', False), logger=logger)
+    max_threads = max(1, len(cpus))
+
+    if not opt.get('cpu_calibration', False) or system is None or positions is None:
+        return max_threads
+
+    key = '{}:{}:{}:{}'.format(host_fingerprint(), workers, max_threads, atom_bucket(system.getNumParticles()))
+    calibrations = load_host_data(CPU_CALIBRATION_FNAME)
+
+    if key in calibrations:
+        threads = calibrations[key]['threads']
+        if logger is not None:
+            logger.info('CPU threads from the host calibration: {}'.format(threads))
+        return threads
+
+    threads, speeds = calibrate_cpu_threads(system, positions, box, workers, max_threads, logger=logger)
+    save_host_data(CPU_CALIBRATION_FNAME, key, {'threads': threads,
+                                                'ns_per_day': {str(k): v for k, v in speeds.items()}})
+    return threads
+
+
+def fastest_platform():
+    """
+    Returns the name of the platform OpenMM selects by default
+    """
+    platforms = [openmm.Platform.getPlatform(i) for i in range(openmm.Platform.getNumPlatforms())]
+    return max(platforms, key=lambda p: p.getSpeed()).getName()
+
+
+def platform_properties(platform_name, system=None, positions=None, box=None, **opt):
+    """
+    Returns the OpenMM platform properties for the selected platform:
+    the precision for CUDA and OpenCL and the thread count for CPU
+    """
+    if platform_name in ['CUDA', 'OpenCL']:
+        return {'Precision': opt['cuda_opencl_precision']}
+    elif platform_name == 'CPU':
+        threads = cpu_threads(system=system, positions=positions, box=box, **opt)
+        if opt.get('Logger') is not None:
+            opt['Logger'].info('CPU platform threads: {}'.format(threads))
+        return {'Threads': str(threads)}
+    return {}
+
+
+def nonbonded_method(system):
+    """
+    Returns the name of the nonbonded method of the passed System
+    """
+    for force in system.getForces():
+        if isinstance(force, openmm.NonbondedForce):
+            return NONBONDED_METHODS[force.getNonbondedMethod()]
+    return 'None'
+
+
+def benchmark_key(system):
+    """
+    Returns the benchmark cache key: host fingerprint,
+    atom count bucket and nonbonded method
+    """
+    return '{}:{}:{}'.format(host_fingerprint(), atom_bucket(system.getNumParticles()), nonbonded_method(system))
+
+
+def _forces(system, positions, box, platform_name, properties):
+    """
+    Returns the forces in kJ/mol/nm on the passed positions
+    computed with the selected platform
+    """
+    system = openmm.XmlSerializer.deserialize(openmm.XmlSerializer.serialize(system))
+    integrator = openmm.VerletIntegrator(0.001 * unit.picoseconds)
+    context = openmm.Context(system, integrator, openmm.Platform.getPlatformByName(platform_name), properties)
+    context.setPositions(positions)
+    if box is not None:
+        context.setPeriodicBoxVectors(box[0], box[1], box[2])
+    forces = context.getState(getForces=True).getForces(asNumpy=True).value_in_unit(
+        unit.kilojoules_per_mole / unit.nanometers)
+    del context, integrator
+    return forces
+
+
+def _benchmark_entry(ns_per_day, force_error):
+    valid = force_error is not None and force_error <= FORCE_TOLERANCE
+    return {'ns_per_day': ns_per_day, 'force_error': force_error, 'valid': bool(valid)}
+
+
+def _benchmark_label(platform_name, precision):
+    return platform_name if precision is None else '{}:{}'.format(platform_name, precision)
+
+
+def benchmark_platforms(system, positions, box, steps=CALIBRATION_STEPS, logger=None,
+                        cpu_threads=0, cpu_workers=1, cpu_pinning=False, cpu_calibration=False):
+    """
+    Runs a quick benchmark of the passed system on every available
+    platform and CUDA/OpenCL precision. Each platform is validated by
+    the median relative force difference from the Reference platform.
+    The CPU platform threads are set by the cpu_* options as in the
+    cpu_threads function
+
+    Returns
+    -------
+    results : dict
+        The platform:precision labels mapped to the ns/day, the force
+        error and the validation flag
+    """
+    names = [openmm.Platform.getPlatform(i).getName() for i in range(openmm.Platform.getNumPlatforms())]
+
+    reference = _forces(system, positions, box, 'Reference', {})
+
+    results = {}
+    for name in names:
+        if name == 'Reference':
+            continue
+        if name in ['CUDA', 'OpenCL']:
+            candidates = [(p, {'Precision': p}) for p in GPU_PRECISIONS]
+        else:
+            candidates = [(None, platform_properties(name, cpu_threads=cpu_threads, cpu_workers=cpu_workers,
+                                                     cpu_pinning=cpu_pinning, cpu_calibration=cpu_calibration)
+                           if name == 'CPU' else {})]
+
+        for precision, properties in candidates:
+            label = _benchmark_label(name, precision)
+            try:
+                error = median_force_error(reference, _forces(system, positions, box, name, properties))
+                speed = _ns_per_day(system, positions, box, properties, platform_name=name, steps=steps)
+            except Exception as e:
+                if logger is not None:
+                    logger.warn('Unable to benchmark the {} platform: {}'.format(label, str(e)))
+                continue
+            results[label] = _benchmark_entry(speed, error)
+            if logger is not None:
+                logger.info('Platform benchmark {}: {:.3f} ns/day, force error {:g}'.format(label, speed, error))
+
+    return results
+
+
+def record_platform_benchmarks(results):
+    """
+    Stores in the host benchmark cache the results returned by the
+    PlatformTestCubes run_platform_benchmarks function. The platforms
+    are validated against the Reference platform run of the same test
+    """
+    tests = {}
+    for result in results:
+        if result['system'] is None or nonbonded_method(result['system']) == 'None':
+            continue
+        tests.setdefault(result['test'], []).append(result)
+
+    for test, runs in tests.items():
+        reference = [r['forces'] for r in runs if r['platform'] == 'Reference']
+        key = benchmark_key(runs[0]['system'])
+        entries = load_host_data(BENCHMARK_FNAME).get(key, {})
+        for r in runs:
+            if r['platform'] == 'Reference':
+                continue
+            error = median_force_error(reference[0], r['forces']) if reference else None
+            entries[_benchmark_label(r['platform'], r['precision'])] = _benchmark_entry(r['ns_per_day'], error)
+        save_host_data(BENCHMARK_FNAME, key, entries)
+
+
+def select_platform(system, positions=None, box=None, **opt):
+    """
+    Selects the fastest validated platform and precision for the passed
+    System from the host benchmark cache. If the cache has no entry for
+    the host, system size and nonbonded method a quick benchmark is run
+    and stored
+
+    Returns
+    -------
+    platform_name : str
+        The selected platform name
+    properties : dict
+        The platform properties
+    """
+    logger = opt.get('Logger')
+
+    key = benchmark_key(system)
+    results = load_host_data(BENCHMARK_FNAME).get(key)
+
+    if not results:
+        if positions is None:
+            results = {}
+        else:
+            if logger is not None:
+                logger.info('No platform benchmark for this host and system size: running a quick benchmark')
+            # The cube options, e.g. the minimization steps, are not
+            # forwarded: only the CPU thread settings are passed
+            results = benchmark_platforms(system, positions, box, steps=CALIBRATION_STEPS, logger=logger,
+                                          cpu_threads=opt.get('cpu_threads', 0),
+                                          cpu_workers=opt.get('cpu_workers', 1),
+                                          cpu_pinning=opt.get('cpu_pinning', False),
+                                          cpu_calibration=opt.get('cpu_calibration', False))
+            save_host_data(BENCHMARK_FNAME, key, results)
+
+    available = [openmm.Platform.getPlatform(i).getName() for i in range(openmm.Platform.getNumPlatforms())]
+    valid = [(v['ns_per_day'], label) for label, v in results.items()
+             if v['valid'] and label.split(':')[0] in available]
+
+    if not valid:
+        name = fastest_platform()
+        if logger is not None:
+            logger.warn('No validated platform benchmark, using the {} platform'.format(name))
+        return name, platform_properties(name, system=system, positions=positions, box=box, **opt)
+
+    speed, label = max(valid)
+    name = label.split(':')[0]
+
+    if logger is not None:
+        logger.info('Auto-Benchmarked platform: {} ({:.3f} ns/day)'.format(label, speed))
+
+    if ':' in label:
+        return name, {'Precision': label.split(':')[1]}
+
+    return name, platform_properties(name, system=system, positions=positions, box=box, **opt)
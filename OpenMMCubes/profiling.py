@@ -0,0 +1,207 @@
+import os
+import re
+import json
+import time
+import heapq
+import cProfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from openeye import oechem
+
+# JSON-lines file where the timing records are appended. If not set
+# the records are only attached to the molecules as SD data
+PROFILE_LOG_ENV = 'OPENMM_CUBES_PROFILE_LOG'
+# Directory of the cProfile dumps. If not set cProfile is not used
+PROFILE_DIR_ENV = 'OPENMM_CUBES_PROFILE_DIR'
+# Number of the slowest items whose cProfile dump is kept by each worker
+PROFILE_SLOWEST_ENV = 'OPENMM_CUBES_PROFILE_SLOWEST'
+PROFILE_SLOWEST = 5
+
+# SD tag of the timing record: Profile_<cube name>
+PROFILE_TAG = 'Profile_{}'
+
+# Profiler of the item currently processed by this worker
+_ACTIVE = None
+
+
+@contextmanager
+def _null_phase():
+    yield
+
+
+def phase(name):
+    """
+    Times the named phase of the item currently processed by this worker.
+    The function can be used by any supporting function without passing
+    the profiler around: if no item is being profiled nothing is recorded
+
+        with profiling.phase('createSystem'):
+            system = structure.createSystem(...)
+    """
+    if _ACTIVE is None:
+        return _null_phase()
+    return _ACTIVE.phase(name)
+
+
+def format_record(record):
+    """
+    Returns the compact text of a timing record: the total and phase
+    wall/cpu times in seconds, e.g. "total=12.41/11.98 decode=0.12/0.11"
+    """
+    fields = ['total={:.2f}/{:.2f}'.format(record['wall'], record['cpu'])]
+    fields += ['{}={:.2f}/{:.2f}'.format(name, wall, cpu) for name, (wall, cpu) in record['phases'].items()]
+    return ' '.join(fields)
+
+
+class Profiler(object):
+    """
+    Records the wall and CPU time of the named phases of each item
+    processed by a cube. The timing record is attached to the item as
+    SD data and optionally appended to a JSON-lines file. If a profile
+    directory is set every item is run under cProfile and the dumps of
+    the slowest items are kept. Nested phases are included in the time
+    of the enclosing ones
+    """
+
+    def __init__(self, name, log_file=None, profile_dir=None, slowest=None):
+        """
+        Initialization function
+
+        Parameters
+        ----------
+        name : str
+            The cube name
+        log_file : str or None
+            The JSON-lines file. If None the OPENMM_CUBES_PROFILE_LOG
+            environment variable is used
+        profile_dir : str or None
+            The cProfile dump directory. If None the OPENMM_CUBES_PROFILE_DIR
+            environment variable is used
+        slowest : int or None
+            The number of cProfile dumps kept. If None the
+            OPENMM_CUBES_PROFILE_SLOWEST environment variable is used
+        """
+        self.name = name
+        self.log_file = log_file if log_file is not None else os.environ.get(PROFILE_LOG_ENV, '')
+        self.profile_dir = profile_dir if profile_dir is not None else os.environ.get(PROFILE_DIR_ENV, '')
+        if slowest is None:
+            slowest = int(os.environ.get(PROFILE_SLOWEST_ENV, PROFILE_SLOWEST))
+        self.slowest = slowest
+
+        self.item = None
+        self.phases = OrderedDict()
+        self._start = None
+        self._cprofile = None
+        # Min-heap of the (wall time, dump file) of the kept dumps
+        self._dumps = []
+        self._count = 0
+
+    def start(self, item=''):
+        """
+        Starts the timing of a new item and makes this profiler the
+        active one of the worker
+        """
+        global _ACTIVE
+
+        self.item = item
+        self.phases = OrderedDict()
+
+        if self.profile_dir and self.slowest > 0:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+        self._start = (time.perf_counter(), time.process_time())
+        _ACTIVE = self
+
+        return
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Times the named phase. The times of phases with the
+        same name are summed up
+        """
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            times = self.phases.setdefault(name, [0.0, 0.0])
+            times[0] += time.perf_counter() - wall
+            times[1] += time.process_time() - cpu
+
+    def finish(self, molecule=None):
+        """
+        Completes the timing of the current item
+
+        Parameters
+        ----------
+        molecule : OEMol or None
+            The molecule the compact timing record is attached to
+
+        Returns
+        -------
+        record : dict
+            The timing record
+        """
+        global _ACTIVE
+
+        if self._start is None:
+            return None
+
+        wall = time.perf_counter() - self._start[0]
+        cpu = time.process_time() - self._start[1]
+        self._start = None
+
+        if _ACTIVE is self:
+            _ACTIVE = None
+
+        record = OrderedDict([('cube', self.name),
+                              ('item', self.item),
+                              ('pid', os.getpid()),
+                              ('wall', round(wall, 3)),
+                              ('cpu', round(cpu, 3)),
+                              ('phases', OrderedDict((name, [round(t[0], 3), round(t[1], 3)])
+                                                     for name, t in self.phases.items()))])
+
+        if molecule is not None:
+            oechem.OESetSDData(molecule, PROFILE_TAG.format(self.name), format_record(record))
+
+        if self.log_file:
+            self._append(record)
+
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._keep_dump(self._cprofile, wall)
+            self._cprofile = None
+
+        return record
+
+    def _append(self, record):
+        # A single write on a file opened in append mode, so the
+        # lines of the parallel workers are not interleaved
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+        fd = os.open(self.log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def _keep_dump(self, profile, wall):
+        # Only the slowest items of this worker are dumped
+        if len(self._dumps) >= self.slowest and wall <= self._dumps[0][0]:
+            return
+
+        os.makedirs(self.profile_dir, exist_ok=True)
+        item = re.sub(r'[^\w.-]+', '_', str(self.item))[:64]
+        self._count += 1
+        fname = os.path.join(self.profile_dir, '{}-{}-{}-{}.prof'.format(self.name, item, os.getpid(), self._count))
+        profile.dump_stats(fname)
+
+        if len(self._dumps) < self.slowest:
+            heapq.heappush(self._dumps, (wall, fname))
+        else:
+            old_wall, old_fname = heapq.heapreplace(self._dumps, (wall, fname))
+            if os.path.isfile(old_fname):
+                os.remove(old_fname)
+
+        return
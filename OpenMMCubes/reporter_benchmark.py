@@ -0,0 +1,132 @@
+"""
+Benchmark of the time the integrator stalls to write each trajectory frame
+with the synchronous OpenMM/mdtraj reporters and the asynchronous reporter
+
+Ex: python -m OpenMMCubes.reporter_benchmark examples/data/pbace_lcat13a_solvated_complex.oeb.gz
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import argparse
+import tempfile
+import mdtraj
+from openeye import oechem
+from simtk import unit, openmm
+from simtk.openmm import app
+from OpenMMCubes import utils
+from OpenMMCubes.reporters import AsyncTrajectoryReporter
+
+DEFAULT_FILE = 'data/pbace_lcat13a_solvated_complex.oeb.gz'
+
+REPORTERS = ['DCD', 'NetCDF', 'HDF5', 'async:DCD', 'async:NetCDF', 'async:QTRJ']
+
+
+class _TimedReporter(object):
+    """
+    Wraps a reporter measuring the time spent inside report
+    """
+
+    def __init__(self, reporter):
+        self.reporter = reporter
+        self.stall_time = 0.0
+        self.nframes = 0
+
+    def describeNextReport(self, simulation):
+        return self.reporter.describeNextReport(simulation)
+
+    def report(self, simulation, state):
+        start = time.perf_counter()
+        self.reporter.report(simulation, state)
+        self.stall_time += time.perf_counter() - start
+        self.nframes += 1
+
+
+def create_reporter(spec, fname, interval, topology, precision=0.001):
+    """
+    Creates the reporter selected by the spec: a trajectory file
+    type optionally prefixed by async:
+    """
+    if spec.startswith('async:'):
+        filetype = spec.split(':', 1)[1]
+        return AsyncTrajectoryReporter(fname, interval, filetype=filetype, topology=topology, precision=precision)
+    elif spec == 'DCD':
+        return app.DCDReporter(fname, interval)
+    elif spec == 'NetCDF':
+        return mdtraj.reporters.NetCDFReporter(fname, interval)
+    elif spec == 'HDF5':
+        return mdtraj.reporters.HDF5Reporter(fname, interval)
+    raise ValueError('Unknown reporter {}'.format(spec))
+
+
+def run_reporter_benchmarks(fname, specs=None, steps=500, interval=10, precision=0.001, stream=None):
+    """
+    Runs the same short simulation with each reporter and writes a report table
+    with the stall time per frame, the wall time and the trajectory size
+    """
+    if stream is None:
+        stream = sys.stdout
+
+    if specs is None:
+        specs = REPORTERS
+
+    mol = oechem.OEMol()
+    with oechem.oemolistream(fname) as ifs:
+        if not oechem.OEReadMolecule(ifs, mol):
+            raise IOError('Unable to read a molecule from {}'.format(fname))
+
+    mdData = utils.MDData(mol)
+    structure = mdData.structure
+    system = utils.create_system(structure, nonbondedMethod='PME', nonbondedCutoff=10.0, constraints='HBonds')
+
+    stream.write('{} ({} atoms), {} steps, frame every {} steps\n'.format(fname, structure.topology.getNumAtoms(),
+                                                                         steps, interval))
+    stream.write('  {:<14} {:>16} {:>12} {:>12}\n'.format('reporter', 'stall (ms/frame)', 'wall (s)',
+                                                          'size (MB)'))
+
+    with tempfile.TemporaryDirectory() as path:
+        for spec in specs:
+            integrator = openmm.LangevinIntegrator(300*unit.kelvin, 1/unit.picoseconds, 0.002*unit.picoseconds)
+            simulation = app.Simulation(structure.topology, system, integrator)
+            simulation.context.setPositions(mdData.positions)
+            box = mdData.box
+            if box is not None:
+                simulation.context.setPeriodicBoxVectors(box[0], box[1], box[2])
+            simulation.context.setVelocitiesToTemperature(300*unit.kelvin)
+            # Warm up
+            simulation.step(interval)
+
+            ext = {'DCD': '.dcd', 'NetCDF': '.nc', 'HDF5': '.hdf5', 'QTRJ': '.qtrj'}[spec.split(':')[-1]]
+            trj_fname = os.path.join(path, spec.replace(':', '_') + ext)
+            reporter = _TimedReporter(create_reporter(spec, trj_fname, interval, structure.topology, precision))
+            simulation.reporters.append(reporter)
+
+            start = time.perf_counter()
+            simulation.step(steps)
+            if hasattr(reporter.reporter, 'close'):
+                reporter.reporter.close()
+            wall = time.perf_counter() - start
+
+            stream.write('  {:<14} {:>16.3f} {:>12.2f} {:>12.3f}\n'.format(
+                spec, 1000.0 * reporter.stall_time / max(reporter.nframes, 1), wall,
+                os.path.getsize(trj_fname) / 1.0e6))
+            stream.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the trajectory reporters stall time')
+    parser.add_argument('file', nargs='?', help='Molecule file. Default: the bundled solvated pbace complex')
+    parser.add_argument('--reporters', nargs='*', help='Reporters to test e.g. DCD async:DCD async:QTRJ')
+    parser.add_argument('--steps', type=int, default=500, help='Number of simulation steps')
+    parser.add_argument('--interval', type=int, default=10, help='Trajectory interval in steps')
+    parser.add_argument('--precision', type=float, default=0.001, help='QTRJ precision in nanometers')
+    args = parser.parse_args()
+
+    fname = args.file or utils.get_data_filename('examples', DEFAULT_FILE)
+
+    run_reporter_benchmarks(fname, specs=args.reporters, steps=args.steps, interval=args.interval,
+                            precision=args.precision)
+
+
+if __name__ == '__main__':
+    main()
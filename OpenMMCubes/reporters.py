@@ -0,0 +1,518 @@
+import os
+import time
+import struct
+import threading
+import numpy as np
+import mdtraj
+from queue import Queue
+from collections import OrderedDict
+from simtk import unit
+from simtk.openmm import app
+from OpenMMCubes import payload
+
+# Quantized trajectory file signature. The first byte is the same used by the MD payloads
+QTRJ_MAGIC = b'\x93OMQ'
+_RECORD = struct.Struct('<Q')
+
+
+class QTRJWriter(object):
+    """
+    Writer of the lossy quantized trajectory format (QTRJ). As in the XTC
+    format the coordinates are rounded to a fixed precision; the integer
+    coordinates are stored as differences between consecutive atoms, which
+    are small for bonded atoms, and compressed. The file is a header record
+    followed by one record per frame, each record being a binary MD payload
+    prefixed by its length
+    """
+
+    def __init__(self, fname, natoms, precision=0.001, codec='gzip', append=False):
+        """
+        Initialization function
+
+        Parameters
+        ----------
+        fname : str
+            The trajectory file name
+        natoms : int
+            The number of atoms per frame
+        precision : float
+            The coordinate precision in nanometers
+        codec : str or compression.Codec
+            The codec used to compress the frames
+        append : bool
+            If True the frames are appended to the existing file
+        """
+        self.natoms = natoms
+        self.precision = precision
+        self.codec = codec
+
+        if append and os.path.isfile(fname) and os.path.getsize(fname):
+            header = read_qtrj_header(fname)
+            self.precision = float(header['precision'][0])
+            self._out = open(fname, 'ab')
+        else:
+            self._out = open(fname, 'wb')
+            self._write_record(QTRJ_MAGIC, [('natoms', np.array([natoms], dtype=np.int64)),
+                                            ('precision', np.array([precision], dtype=np.float64))])
+
+    def _write_record(self, prefix, blocks):
+        data = payload.encode(blocks, codec=self.codec)
+        self._out.write(prefix + _RECORD.pack(len(data)) + data)
+
+    def write(self, step, time, xyz, box=None):
+        """
+        Writes one frame
+
+        Parameters
+        ----------
+        step : int
+            The simulation step
+        time : float
+            The simulation time in picoseconds
+        xyz : numpy array
+            The (natoms, 3) coordinates in nanometers
+        box : numpy array or None
+            The (3, 3) box vectors in nanometers
+        """
+        q = np.rint(np.asarray(xyz, dtype=np.float64) / self.precision).astype(np.int64)
+        delta = np.diff(q, axis=0, prepend=np.zeros((1, 3), dtype=np.int64))
+        # Narrow integers compress better
+        if np.abs(delta).max(initial=0) < np.iinfo(np.int16).max:
+            delta = delta.astype(np.int16)
+        else:
+            delta = delta.astype(np.int32)
+
+        self._write_record(b'', [('step', np.array([step], dtype=np.int64)),
+                                 ('time', np.array([time], dtype=np.float64)),
+                                 ('box', None if box is None else np.asarray(box, dtype=np.float32)),
+                                 ('xyz', delta)])
+
+    def flush(self):
+        self._out.flush()
+
+    def close(self):
+        self._out.close()
+
+
+def _read_record(f):
+    size = f.read(_RECORD.size)
+    if len(size) < _RECORD.size:
+        return None
+    nbytes, = _RECORD.unpack(size)
+    return payload.decode(f.read(nbytes))
+
+
+def read_qtrj_header(fname):
+    """
+    Returns the header blocks (natoms, precision) of a QTRJ file
+    """
+    with open(fname, 'rb') as f:
+        if f.read(len(QTRJ_MAGIC)) != QTRJ_MAGIC:
+            raise ValueError('The file {} is not a QTRJ trajectory'.format(fname))
+        return _read_record(f)
+
+
+def qtrj_header_size(fname):
+    """
+    Returns the size in bytes of the QTRJ file header
+    """
+    with open(fname, 'rb') as f:
+        f.seek(len(QTRJ_MAGIC))
+        nbytes, = _RECORD.unpack(f.read(_RECORD.size))
+    return len(QTRJ_MAGIC) + _RECORD.size + nbytes
+
+
+def read_qtrj(fname):
+    """
+    This function reads a QTRJ trajectory
+
+    Parameters
+    ----------
+    fname : str
+        The trajectory file name
+
+    Returns
+    -------
+    xyz : numpy array
+        The (nframes, natoms, 3) coordinates in nanometers
+    box : numpy array or None
+        The (nframes, 3, 3) box vectors in nanometers
+    steps : numpy array
+        The simulation step of each frame
+    times : numpy array
+        The simulation time of each frame in picoseconds
+    """
+    header = read_qtrj_header(fname)
+    precision = float(header['precision'][0])
+
+    xyz, box, steps, times = [], [], [], []
+
+    with open(fname, 'rb') as f:
+        f.seek(qtrj_header_size(fname))
+        while True:
+            frame = _read_record(f)
+            if frame is None:
+                break
+            xyz.append((np.cumsum(frame['xyz'].astype(np.int64), axis=0) * precision).astype(np.float32))
+            steps.append(frame['step'][0])
+            times.append(frame['time'][0])
+            if 'box' in frame:
+                box.append(frame['box'])
+
+    natoms = int(header['natoms'][0])
+
+    return (np.array(xyz, dtype=np.float32).reshape(-1, natoms, 3), np.array(box) if box else None,
+            np.array(steps), np.array(times))
+
+
+class _DCDWriter(object):
+    """
+    DCD writer based on the OpenMM DCD file
+    """
+
+    def __init__(self, fname, topology, dt, firstStep, interval, append=False):
+        self._out = open(fname, 'r+b' if append else 'wb')
+        self._dcd = app.DCDFile(self._out, topology, dt, firstStep, interval, append)
+
+    def write(self, step, time, xyz, box=None):
+        self._dcd.writeModel(xyz * unit.nanometers,
+                             periodicBoxVectors=None if box is None else box * unit.nanometers)
+
+    def flush(self):
+        self._out.flush()
+
+    def close(self):
+        self._out.close()
+
+
+class _MDTrajWriter(object):
+    """
+    NetCDF and HDF5 writers based on the mdtraj trajectory files
+    """
+
+    def __init__(self, fname, topology, filetype):
+        self._filetype = filetype
+        if filetype == 'NetCDF':
+            self._out = mdtraj.formats.NetCDFTrajectoryFile(fname, 'w')
+        else:
+            self._out = mdtraj.formats.HDF5TrajectoryFile(fname, 'w')
+            self._out.topology = mdtraj.Topology.from_openmm(topology)
+
+    def write(self, step, time, xyz, box=None):
+        lengths = angles = None
+        if box is not None:
+            params = mdtraj.utils.box_vectors_to_lengths_and_angles(box[0], box[1], box[2])
+            lengths = np.array([params[:3]])
+            angles = np.array([params[3:]])
+
+        if self._filetype == 'NetCDF':
+            # The NetCDF (AMBER) format is in angstroms
+            self._out.write(coordinates=xyz[np.newaxis] * 10.0, time=np.array([time]),
+                            cell_lengths=None if lengths is None else lengths * 10.0, cell_angles=angles)
+        else:
+            self._out.write(coordinates=xyz[np.newaxis], time=np.array([time]),
+                            cell_lengths=lengths, cell_angles=angles)
+
+    def flush(self):
+        self._out.flush()
+
+    def close(self):
+        self._out.close()
+
+
+class AsyncTrajectoryReporter(object):
+    """
+    OpenMM trajectory Reporter which copies the positions in a preallocated
+    ring buffer and writes the frames from a background thread, so the
+    integrator only stalls for the State copy. If all the buffer slots are
+    waiting to be written the reporter blocks until a slot is released
+
+    Supported file types: DCD, NetCDF, HDF5 and QTRJ (lossy fixed precision)
+    """
+
+    def __init__(self, fname, reportInterval, filetype='DCD', topology=None, natoms=None,
+                 atom_indices=None, buffer_size=16, precision=0.001, append=False,
+                 enforcePeriodicBox=True):
+        """
+        Initialization function
+
+        Parameters
+        ----------
+        fname : str
+            The trajectory file name
+        reportInterval : int
+            The interval (in steps) at which to write frames
+        filetype : str
+            DCD, NetCDF, HDF5 or QTRJ
+        topology : OpenMM Topology or None
+            The topology of the written atoms. Required by DCD and HDF5
+        natoms : int or None
+            The number of written atoms. If None it is taken from the topology
+        atom_indices : numpy array or None
+            The indices of the written atoms. If None all the atoms are written
+        buffer_size : int
+            The number of ring buffer slots
+        precision : float
+            The QTRJ coordinate precision in nanometers
+        append : bool
+            If True the frames are appended to the existing file (DCD and QTRJ)
+        enforcePeriodicBox : bool
+            If True the molecules are wrapped in the periodic box
+        """
+        self._fname = fname
+        self._reportInterval = reportInterval
+        self._filetype = filetype
+        self._topology = topology
+        self._atom_indices = None if atom_indices is None else np.asarray(atom_indices, dtype=np.int64)
+        self._precision = precision
+        self._append = append
+        self._enforcePeriodicBox = enforcePeriodicBox
+
+        if natoms is None:
+            natoms = topology.getNumAtoms() if self._atom_indices is None else len(self._atom_indices)
+        self._natoms = natoms
+
+        # Ring buffer
+        self._xyz = np.empty((buffer_size, natoms, 3), dtype=np.float32)
+        self._box = np.empty((buffer_size, 3, 3), dtype=np.float32)
+        self._has_box = np.zeros(buffer_size, dtype=bool)
+        self._steps = np.empty(buffer_size, dtype=np.int64)
+        self._times = np.empty(buffer_size, dtype=np.float64)
+
+        self._free = Queue()
+        for slot in range(buffer_size):
+            self._free.put(slot)
+        self._pending = Queue()
+
+        self._writer = None
+        self._thread = None
+        self._error = None
+
+        # Time spent by the integrator thread inside report
+        self.stall_time = 0.0
+        self.nframes = 0
+
+    def _open(self, simulation):
+        if self._filetype == 'QTRJ':
+            return QTRJWriter(self._fname, self._natoms, precision=self._precision, append=self._append)
+        elif self._filetype == 'DCD':
+            return _DCDWriter(self._fname, self._topology, simulation.integrator.getStepSize(),
+                              simulation.currentStep, self._reportInterval, append=self._append)
+        elif self._filetype in ['NetCDF', 'HDF5']:
+            if self._append:
+                raise ValueError('The {} trajectories cannot be appended'.format(self._filetype))
+            return _MDTrajWriter(self._fname, self._topology, self._filetype)
+        raise ValueError('The selected trajectory file format is not supported: {}'.format(self._filetype))
+
+    def _run(self):
+        while True:
+            slot = self._pending.get()
+            try:
+                if slot is None:
+                    return
+                if self._error is None:
+                    self._writer.write(self._steps[slot], self._times[slot], self._xyz[slot],
+                                       self._box[slot] if self._has_box[slot] else None)
+            except Exception as e:
+                self._error = e
+            finally:
+                if slot is not None:
+                    self._free.put(slot)
+                self._pending.task_done()
+
+    def describeNextReport(self, simulation):
+        steps = self._reportInterval - simulation.currentStep % self._reportInterval
+        return (steps, True, False, False, False, self._enforcePeriodicBox)
+
+    def report(self, simulation, state):
+        start = time.perf_counter()
+
+        if self._writer is None:
+            self._writer = self._open(simulation)
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+        if self._error is not None:
+            raise self._error
+
+        slot = self._free.get()
+
+        xyz = state.getPositions(asNumpy=True).value_in_unit(unit.nanometers)
+        if self._atom_indices is not None:
+            xyz = xyz[self._atom_indices]
+        self._xyz[slot] = xyz
+
+        box = state.getPeriodicBoxVectors(asNumpy=True)
+        self._has_box[slot] = box is not None
+        if box is not None:
+            self._box[slot] = box.value_in_unit(unit.nanometers)
+
+        self._steps[slot] = simulation.currentStep
+        self._times[slot] = state.getTime().value_in_unit(unit.picoseconds)
+
+        self._pending.put(slot)
+
+        self.stall_time += time.perf_counter() - start
+        self.nframes += 1
+
+    def flush(self):
+        """
+        Waits for all the buffered frames to be written and flushes the file
+        """
+        if self._writer is None:
+            return
+        self._pending.join()
+        if self._error is not None:
+            raise self._error
+        self._writer.flush()
+
+    def close(self):
+        """
+        Writes the buffered frames and closes the file
+        """
+        if self._writer is None:
+            return
+        self._pending.put(None)
+        self._thread.join()
+        self._writer.close()
+        self._writer = None
+        if self._error is not None:
+            raise self._error
+
+
+# Columns of the energy table. Units: time ps, energies kJ/mol,
+# temperature K, volume nm^3, density g/mL
+ENERGY_COLUMNS = ['step', 'time', 'potential', 'kinetic', 'temperature', 'volume', 'density']
+
+# Molar gas constant in kJ/(mol K)
+_GAS_CONSTANT = 0.00831446261815324
+# Avogadro number times 1 nm^3 in mL: g/mol / (nm^3 * _NM3_TO_ML_MOL) = g/mL
+_NM3_TO_ML_MOL = 602.214076
+
+
+class EnergyReporter(object):
+    """
+    OpenMM Reporter which records the step, time, potential and kinetic
+    energy, temperature, volume and density in preallocated numpy arrays.
+    Nothing is written to disk: the table can be attached to the molecule
+    as binary payload by using the encode method
+    """
+
+    def __init__(self, reportInterval, totalSteps=None, table=None):
+        """
+        Initialization function
+
+        Parameters
+        ----------
+        reportInterval : int
+            The interval (in steps) at which to record the energies
+        totalSteps : int or None
+            The total number of steps used to preallocate the arrays.
+            The arrays are enlarged if more records are reported
+        table : dict or None
+            The records of a previous run to continue
+        """
+        self._reportInterval = reportInterval
+
+        nrecords = 0 if table is None else len(table['step'])
+        capacity = nrecords + (totalSteps // reportInterval + 1 if totalSteps else 1024)
+
+        self._steps = np.zeros(capacity, dtype=np.int64)
+        self._values = np.zeros((capacity, len(ENERGY_COLUMNS) - 1), dtype=np.float64)
+        self._n = 0
+
+        if nrecords:
+            self._steps[:nrecords] = table['step']
+            for col, name in enumerate(ENERGY_COLUMNS[1:]):
+                self._values[:nrecords, col] = table[name]
+            self._n = nrecords
+
+        self._dof = None
+        self._mass = None
+
+    def _setup(self, system):
+        masses = np.array([system.getParticleMass(i).value_in_unit(unit.dalton)
+                           for i in range(system.getNumParticles())])
+        dof = 3 * np.count_nonzero(masses > 0.0)
+        for i in range(system.getNumConstraints()):
+            p1, p2, distance = system.getConstraintParameters(i)
+            if masses[p1] > 0.0 or masses[p2] > 0.0:
+                dof -= 1
+        if any(type(system.getForce(i)).__name__ == 'CMMotionRemover' for i in range(system.getNumForces())):
+            dof -= 3
+        self._dof = max(dof, 1)
+        self._mass = masses.sum()
+
+    def describeNextReport(self, simulation):
+        steps = self._reportInterval - simulation.currentStep % self._reportInterval
+        return (steps, False, False, False, True, False)
+
+    def report(self, simulation, state):
+        if self._dof is None:
+            self._setup(simulation.system)
+
+        if self._n == len(self._steps):
+            self._steps = np.concatenate((self._steps, np.zeros_like(self._steps)))
+            self._values = np.concatenate((self._values, np.zeros_like(self._values)))
+
+        potential = state.getPotentialEnergy().value_in_unit(unit.kilojoules_per_mole)
+        kinetic = state.getKineticEnergy().value_in_unit(unit.kilojoules_per_mole)
+
+        if simulation.system.usesPeriodicBoundaryConditions():
+            volume = state.getPeriodicBoxVolume().value_in_unit(unit.nanometers**3)
+            density = self._mass / (volume * _NM3_TO_ML_MOL)
+        else:
+            volume = density = np.nan
+
+        self._steps[self._n] = simulation.currentStep
+        self._values[self._n] = (state.getTime().value_in_unit(unit.picoseconds), potential, kinetic,
+                                 2.0 * kinetic / (self._dof * _GAS_CONSTANT), volume, density)
+        self._n += 1
+
+    def __len__(self):
+        return self._n
+
+    def table(self):
+        """
+        Returns the recorded energies as a column name: numpy array dictionary
+        """
+        table = OrderedDict([('step', self._steps[:self._n].copy())])
+        for col, name in enumerate(ENERGY_COLUMNS[1:]):
+            table[name] = self._values[:self._n, col].copy()
+        return table
+
+    def encode(self, codec=None):
+        """
+        Returns the recorded energies as binary MD payload
+        """
+        return payload.encode(list(self.table().items()), codec=codec)
+
+
+def concatenate_energies(tables):
+    """
+    Concatenates the passed energy tables, e.g. the tables
+    of consecutive production segments
+    """
+    tables = [t for t in tables if t is not None]
+    return OrderedDict([(name, np.concatenate([t[name] for t in tables])) for name in ENERGY_COLUMNS])
+
+
+class RateLimitedReporter(object):
+    """
+    Wraps a reporter forwarding at most one report every min_interval
+    seconds of wall time, e.g. to limit the progress printed to stdout
+    """
+
+    def __init__(self, reporter, min_interval):
+        self.reporter = reporter
+        self._min_interval = min_interval
+        self._last = None
+
+    def describeNextReport(self, simulation):
+        return self.reporter.describeNextReport(simulation)
+
+    def report(self, simulation, state):
+        now = time.perf_counter()
+        if self._last is None or now - self._last >= self._min_interval:
+            self._last = now
+            self.reporter.report(simulation, state)
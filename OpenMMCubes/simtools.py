@@ -1,11 +1,19 @@
-import sys, mdtraj, tarfile, os
+import sys, json, mdtraj, tarfile, os, struct, tempfile, time
 import numpy as np
+from collections import OrderedDict
 from sys import stdout
 from openeye import oechem
 from simtk import unit, openmm
 from simtk.openmm import app
 from floe.api.orion import in_orion,  upload_file
-from oeommtools import utils as oeommutils
+from OpenMMCubes import utils, payload, masks, platforms, store, equilibration, profiling, throughput
+from OpenMMCubes.reporters import (AsyncTrajectoryReporter, EnergyReporter, RateLimitedReporter,
+                                   concatenate_energies, qtrj_header_size)
+
+# Trajectory file extensions
+TRAJECTORY_EXTENSIONS = {'DCD': '.dcd', 'NetCDF': '.nc', 'HDF5': '.hdf5', 'QTRJ': '.qtrj'}
+# Trajectory file types which can be appended by a resumed simulation
+APPENDABLE_TRAJECTORIES = ['DCD', 'QTRJ']
 
 
 def simulation(mdData, **opt):
@@ -35,38 +43,211 @@ def simulation(mdData, **opt):
     box = mdData.box
 
     # Time step in ps
-    stepLen = 0.002 * unit.picoseconds
+    stepLen = _time_step(**opt)
 
     # Centering the system to the OpenMM Unit Cell
     if opt['center'] and box is not None:
         opt['Logger'].info("Centering is On")
-        # Numpy array in A
-        coords = structure.coordinates
-        # System Center of Geometry
-        cog = np.mean(coords, axis=0)
-        # System box vectors
-        box_v = structure.box_vectors.in_units_of(unit.angstrom)/unit.angstrom
-        box_v = np.array([box_v[0][0], box_v[1][1], box_v[2][2]])
-        # Translation vector
-        delta = box_v/2 - cog
-        # New Coordinates
-        new_coords = coords + delta
-        structure.coordinates = new_coords
-        positions = structure.positions
-
-    # OpenMM system
+        positions = _center_structure(structure)
+
+    settings = _system_settings(box, **opt)
+
+    # The Simulation, and its Context, is reused for molecules with the
+    # same topology and settings: only the State and the restraint
+    # reference positions are reset
+    cache_key = _simulation_key(opt['molecule'], settings, stepLen, **opt)
+    cached = _SIMULATIONS.get(cache_key) if cache_key is not None else None
+
+    if cached is not None:
+        _SIMULATIONS.move_to_end(cache_key)
+        _SIMULATION_CACHE_STATS['hits'] += 1
+        opt['Logger'].info('Context cache hit (hits: {hits}, misses: {misses})'.format(**_SIMULATION_CACHE_STATS))
+
+        simulation, force_restr = cached
+        simulation.reporters = []
+        simulation.currentStep = 0
+        simulation.context.setTime(0.0)
+
+        if force_restr is not None:
+            _reset_restraints(simulation, force_restr, positions, **opt)
+    else:
+        if cache_key is not None:
+            _SIMULATION_CACHE_STATS['misses'] += 1
+            opt['Logger'].info('Context cache miss (hits: {hits}, misses: {misses})'.format(**_SIMULATION_CACHE_STATS))
+
+        simulation, force_restr = _setup_simulation(structure, topology, positions, box, stepLen, settings, **opt)
+
+        if cache_key is not None:
+            _SIMULATIONS[cache_key] = (simulation, force_restr)
+            if len(_SIMULATIONS) > SIMULATION_CACHE_SIZE:
+                _SIMULATIONS.popitem(last=False)
+
+    # Set starting positions and velocities
+    simulation.context.setPositions(positions)
+
+    # Set Box dimensions
     if box is not None:
-        system = structure.createSystem(nonbondedMethod=eval("app.%s" % opt['nonbondedMethod']),
-                                        nonbondedCutoff=opt['nonbondedCutoff']*unit.angstroms,
-                                        constraints=eval("app.%s" % opt['constraints']),
-                                        removeCMMotion=False)
-    else:  # Vacuum
-        system = structure.createSystem(nonbondedMethod=app.NoCutoff,
-                                        constraints=eval("app.%s" % opt['constraints']),
-                                        removeCMMotion=False)
+        simulation.context.setPeriodicBoxVectors(box[0], box[1], box[2])
+
+    # If the velocities are not present in the Parmed structure
+    # new velocity vectors are generated otherwise the system is
+    # restarted from the previous State
+    if opt['SimType'] in ['nvt', 'npt']:
+
+        # Convert simulation time in steps
+        opt['steps'] = int(round(opt['time']/(stepLen.in_units_of(unit.picoseconds)/unit.picoseconds)))
+
+        # The step counter of a production segment starts at the end of the previous segment
+        first_step = opt.get('segment', 0) * opt['steps']
+        opt['steps'] += first_step
+
+        # Checkpoint of a previous run of the same system and stage
+        checkpoint = None
+        chk_fname = None
+        if opt.get('checkpoint_interval'):
+            chk_fname = checkpoint_filename(**opt)
+            chk_key = checkpoint_key(opt['molecule'], settings, stepLen, positions, **opt)
+            checkpoint = loadCheckpoint(chk_fname, key=chk_key, **opt)
+
+    if opt['SimType'] in ['nvt', 'npt'] and checkpoint is not None:
+        state, step, offsets, energies = checkpoint
+
+        opt['Logger'].info('RESUMING simulation from the checkpoint {} at step {}'.format(chk_fname, step))
+        simulation.context.setState(state)
+        simulation.currentStep = step
+
+        # Discard the data written after the checkpoint
+        _truncate_outputs(offsets, step, first_step=first_step, **opt)
+
+        # Set Reporters
+        for rep in getReporters(append=True, topology=topology, energies=energies, **opt):
+            simulation.reporters.append(rep)
+
+    elif opt['SimType'] in ['nvt', 'npt']:
+
+        if opt['trajectory_interval']:
+            _save_topology_pdb(structure, **opt)
+
+        if velocities is not None:
+            opt['Logger'].info('RESTARTING simulation from a previous State')
+            simulation.context.setVelocities(velocities)
+        else:
+            # Set the velocities drawing from the Boltzmann distribution at the selected temperature
+            opt['Logger'].info('GENERATING a new starting State')
+            simulation.context.setVelocitiesToTemperature(opt['temperature']*unit.kelvin)
+
+        simulation.currentStep = first_step
+
+        # Set Reporters
+        for rep in getReporters(topology=topology, **opt):
+            simulation.reporters.append(rep)
+
+    if opt['SimType'] in ['nvt', 'npt'] and chk_fname is not None:
+        # The checkpoint reporter is the last one so the output
+        # file offsets include the data reported at the same step
+        simulation.reporters.append(CheckpointReporter(chk_fname, opt['checkpoint_interval'],
+                                                       _output_filenames(**opt), key=chk_key))
+
+    # OpenMM platform information
+    _print_platform_info(simulation, printfile, **opt)
+
+    if opt['SimType'] in ['nvt', 'npt']:
+
+        opt['Logger'].info('Running {time} ps = {steps} steps of {SimType} at {temperature} K'.format(**opt))
+        
+        start = (simulation.currentStep, time.perf_counter(), time.process_time())
+
+        with profiling.phase('step'):
+            if opt.get('adaptive', False):
+                # The simulation stops as soon as the equilibration is detected
+                _adaptive_equilibration(simulation, stepLen, **opt)
+            else:
+                # Start Simulation. A resumed simulation only runs the remaining steps
+                simulation.step(opt['steps'] - simulation.currentStep)
+
+        # Close the reporters so the buffered frames are written
+        with profiling.phase('reporters'):
+            for rep in simulation.reporters:
+                if hasattr(rep, 'close'):
+                    rep.close()
+
+        # The throughput and the energies of the production segments are appended to the previous ones
+        _record_throughput(simulation, start, stepLen, append=opt.get('segment', 0) > 0, **opt)
+        _attach_energies(simulation, append=opt.get('segment', 0) > 0, **opt)
+
+        # The run has been completed, the checkpoint is not needed anymore
+        if chk_fname is not None and os.path.isfile(chk_fname):
+            os.remove(chk_fname)
+
+        if box is not None:
+            state = simulation.context.getState(getPositions=True, getVelocities=True,
+                                                getEnergy=True, enforcePeriodicBox=True)
+        else:
+            state = simulation.context.getState(getPositions=True, getVelocities=True,
+                                                getEnergy=True, enforcePeriodicBox=False)
+        
+    elif opt['SimType'] == 'min':
+        # Start Simulation
+        opt['Logger'].info('Minimization steps: {steps}'.format(**opt))
+
+        restraint_k = None
+        if opt['restraints']:
+            restraint_k = (opt['restraintWt'] * unit.kilocalories_per_mole/unit.angstroms**2).value_in_unit(
+                unit.kilojoules_per_mole/unit.nanometers**2)
+
+        start = (simulation.currentStep, time.perf_counter(), time.process_time())
+
+        with profiling.phase('minimization'):
+            state = _minimize(simulation, printfile, restraint_k=restraint_k, **opt)
+
+        _record_throughput(simulation, start, stepLen, **opt)
+
+    # numpy array in units of angstrom
+    xyz = state.getPositions(asNumpy=True).value_in_unit(unit.angstroms)
+    structure.coordinates = xyz
+    # OpenMM Quantity object
+    if box is not None:
+        structure.box_vectors = state.getPeriodicBoxVectors()
+
+    if opt['SimType'] in ['nvt', 'npt']:
+        # numpy array in units of angstrom/picosecond
+        structure.velocities = state.getVelocities(asNumpy=True).value_in_unit(unit.angstroms/unit.picoseconds)
+
+        # If required uploading files to Orion. The files of the production
+        # segments are processed once merged
+        if opt.get('process_files', True):
+            with profiling.phase('upload'):
+                _file_processing(**opt)
+
+    # Update the OEMol complex positions to match the new
+    # Parmed structure after the simulation
+    utils.set_oemol_coords(opt['molecule'], xyz)
+
+    return
+
+
+def _setup_simulation(structure, topology, positions, box, stepLen, settings, **opt):
+    """
+    This supporting function creates the OpenMM System with the barostat,
+    the restraint force and the frozen atoms, the Integrator and the
+    Simulation
+
+    Returns
+    -------
+    simulation : OpenMM Simulation
+        The Simulation
+    force_restr : OpenMM CustomExternalForce or None
+        The restraint force
+    """
+    # OpenMM system. The serialized System is reused if it has
+    # already been created for the same topology and settings
+    with profiling.phase('createSystem'):
+        system = utils.create_system(structure, molecule=opt['molecule'], logger=opt['Logger'],
+                                     cache=opt.get('system_cache', True), codec=opt.get('codec'),
+                                     **settings)
 
     # OpenMM Integrator
-    integrator = openmm.LangevinIntegrator(opt['temperature']*unit.kelvin, 1/unit.picoseconds, stepLen)
+    integrator = _create_integrator(system, stepLen, **opt)
     
     if opt['SimType'] == 'npt':
         if box is None:
@@ -76,14 +257,15 @@ def simulation(mdData, **opt):
         system.addForce(openmm.MonteCarloBarostat(opt['pressure']*unit.atmospheres, opt['temperature']*unit.kelvin, 25))
 
     # Apply restraints
+    force_restr = None
     if opt['restraints']:
         opt['Logger'].info("RESTRAINT mask applied to: {}"
                            "\tRestraint weight: {}".format(opt['restraints'],
                                                            opt['restraintWt'] *
                                                            unit.kilocalories_per_mole/unit.angstroms**2))
         # Select atom to restraint
-        res_atom_set = oeommutils.select_oemol_atom_idx_by_language(opt['molecule'], mask=opt['restraints'])
-        opt['Logger'].info("Number of restraint atoms: {}".format(len(res_atom_set)))
+        res_atoms = masks.select_atoms(opt['molecule'], opt['restraints'])
+        opt['Logger'].info("Number of restraint atoms: {}".format(len(res_atoms)))
         # define the custom force to restrain atoms to their starting positions
         force_restr = openmm.CustomExternalForce('k_restr*periodicdistance(x, y, z, x0, y0, z0)^2')
         # Add the restraint weight as a global parameter in kcal/mol/A^2
@@ -93,26 +275,861 @@ def simulation(mdData, **opt):
         force_restr.addPerParticleParameter("y0")
         force_restr.addPerParticleParameter("z0")
 
-        for idx in range(0, len(positions)):
-            if idx in res_atom_set:
-                xyz = positions[idx].in_units_of(unit.nanometers)/unit.nanometers
-                force_restr.addParticle(idx, xyz)
-        
+        xyz = np.asarray(positions.value_in_unit(unit.nanometers))[res_atoms]
+        _add_particles(force_restr, res_atoms, xyz)
+
         system.addForce(force_restr)
 
     # Freeze atoms
     if opt['freeze']:
-        opt['Logger'].info("FREEZE mask applied to: {}".format(opt['freeze']))
+        _freeze_atoms(system, **opt)
+
+    with profiling.phase('context'):
+        simulation = _create_simulation(topology, system, integrator, positions=positions, box=box, **opt)
+
+    return simulation, force_restr
+
+
+# Per worker cache of the Simulations keyed by topology and settings
+SIMULATION_CACHE_SIZE = 2
+_SIMULATIONS = OrderedDict()
+_SIMULATION_CACHE_STATS = {'hits': 0, 'misses': 0}
+
+# Options which change the System, the Integrator or the Context
+_SIMULATION_KEY_OPTIONS = ['SimType', 'temperature', 'pressure', 'integrator', 'restraints', 'freeze',
+                           'platform', 'cuda_opencl_precision', 'cpu_threads', 'cpu_workers',
+                           'cpu_pinning', 'cpu_calibration']
+
+
+def _simulation_key(molecule, settings, stepLen, **opt):
+    """
+    This supporting function returns the Simulation cache key: the topology
+    and parameter hash, the System settings and the simulation options. None
+    is returned if the Simulation cannot be reused
+    """
+    if not opt.get('context_cache', False):
+        return None
+
+    topology_hash = utils.PackageOEMol.getTopologyHash(molecule)
+    if topology_hash is None:
+        return None
+
+    # The around selections depend on the coordinates
+    if 'around' in opt.get('restraints', '') or 'around' in opt.get('freeze', ''):
+        return None
+
+    key = [topology_hash, sorted(settings.items()), stepLen.value_in_unit(unit.picoseconds),
+           [(k, opt.get(k)) for k in _SIMULATION_KEY_OPTIONS]]
+
+    return store.digest(json.dumps(key, default=str).encode())
+
+
+def _reset_restraints(simulation, force_restr, positions, **opt):
+    """
+    This supporting function sets the restraint reference positions
+    and weight of a reused Simulation
+    """
+    xyz = np.asarray(positions.value_in_unit(unit.nanometers))
+    for i in range(force_restr.getNumParticles()):
+        idx, params = force_restr.getParticleParameters(i)
+        force_restr.setParticleParameters(i, idx, xyz[idx].tolist())
+    force_restr.updateParametersInContext(simulation.context)
+
+    k_restr = (opt['restraintWt'] * unit.kilocalories_per_mole/unit.angstroms**2).value_in_unit(
+        unit.kilojoules_per_mole/unit.nanometers**2)
+    simulation.context.setParameter('k_restr', k_restr)
+
+    opt['Logger'].info("RESTRAINT mask applied to: {}"
+                       "\tRestraint weight: {}".format(opt['restraints'],
+                                                       opt['restraintWt'] *
+                                                       unit.kilocalories_per_mole/unit.angstroms**2))
+    return
 
-        freeze_atom_set = oeommutils.select_oemol_atom_idx_by_language(opt['molecule'], mask=opt['freeze'])
-        opt['Logger'].info("Number of frozen atoms: {}".format(len(freeze_atom_set)))
-        # Set atom masses to zero
-        for idx in range(0, len(positions)):
-            if idx in freeze_atom_set:
-                system.setParticleMass(idx, 0.0)
 
-    if opt['platform'] == 'Auto':
-        simulation = app.Simulation(topology, system, integrator)
+def protocol(mdData, stages, emit=None, **opt):
+    """
+    This supporting function runs a sequence of Minimization, NVT and NPT
+    stages in a single OpenMM Context. The System is created once with a
+    barostat and a restraint force: between stages the restraint strength
+    is updated by the k_restr global parameter, the restraint reference
+    positions are set to the stage starting positions and the barostat is
+    toggled by its frequency, so the Context is never rebuilt
+
+    Parameters
+    ----------
+    mdData : MDData data object
+        The object which recovers the relevant Parmed structure data
+        to perform MD
+    stages : list of python dictionaries
+        The protocol stages. Each stage requires the key 'type' (min, nvt
+        or npt) and can set the keys 'name', 'steps' (min), 'time' (ps),
+        'restraints', 'restraintWt', 'tolerance' (min), 'restraint_release'
+        (min), 'trajectory_interval', 'reporter_interval', 'outfname' and 'emit'
+    emit : callable or None
+        Function called as emit(stage) at the end of each stage with an
+        'emit' key. The MD data and the molecule coordinates are updated
+        before the call
+    opt: python dictionary
+        A dictionary containing all the MD setting info
+    """
+
+    if opt['Logger'] is None:
+        printfile = sys.stdout
+    else:
+        printfile = opt['Logger'].file
+
+    # The stage settings override the global ones
+    stage_opts = []
+    for idx, stage in enumerate(stages):
+        stage_opt = dict(opt)
+        stage_opt.update({'name': 'stage{}'.format(idx), 'steps': 0, 'time': 0.0,
+                          'restraints': '', 'restraintWt': 0.0})
+        stage_opt.update(stage)
+        if stage_opt['type'] not in ['min', 'nvt', 'npt']:
+            oechem.OEThrow.Fatal("The selected stage type is not supported: {}".format(stage_opt['type']))
+        stage_opt['SimType'] = stage_opt['type']
+        stage_opt['stage_name'] = stage_opt['name']
+        stage_opts.append(stage_opt)
+
+    # MD data extracted from Parmed
+    structure = mdData.structure
+    topology = mdData.topology
+    positions = mdData.positions
+    velocities = mdData.velocities
+    box = mdData.box
+
+    # Time step in ps
+    stepLen = _time_step(**opt)
+
+    # Centering the system to the OpenMM Unit Cell
+    if opt['center'] and box is not None:
+        opt['Logger'].info("Centering is On")
+        positions = _center_structure(structure)
+
+    # OpenMM system. The serialized System is reused if it has
+    # already been created for the same topology and settings
+    with profiling.phase('createSystem'):
+        system = utils.create_system(structure, molecule=opt['molecule'], logger=opt['Logger'],
+                                     cache=opt.get('system_cache', True), codec=opt.get('codec'),
+                                     **_system_settings(box, **opt))
+
+    # OpenMM Integrator
+    integrator = _create_integrator(system, stepLen, **opt)
+
+    # The barostat is added disabled and switched on by the NPT stages
+    barostat = None
+    if any(stage['type'] == 'npt' for stage in stage_opts):
+        if box is None:
+            oechem.OEThrow.Fatal("NPT simulation without box vector")
+
+        barostat = openmm.MonteCarloBarostat(opt['pressure']*unit.atmospheres, opt['temperature']*unit.kelvin, 0)
+        system.addForce(barostat)
+
+    # Each restraint mask is evaluated once. A single restraint force is applied to all the
+    # atoms selected by any stage, the per-particle parameter on switches the atoms of
+    # the current stage mask
+    res_atom_sets = {}
+    for stage in stage_opts:
+        if stage['restraints'] and stage['restraints'] not in res_atom_sets:
+            res_atom_sets[stage['restraints']] = masks.select_atoms(opt['molecule'], stage['restraints'])
+
+    res_atoms = np.unique(np.concatenate([np.empty(0, dtype=np.int64)] + list(res_atom_sets.values())))
+
+    force_restr = None
+    if len(res_atoms):
+        # define the custom force to restrain atoms to their starting positions
+        force_restr = openmm.CustomExternalForce('k_restr*on*periodicdistance(x, y, z, x0, y0, z0)^2')
+        # The restraint weight global parameter is set at the beginning of each stage
+        force_restr.addGlobalParameter("k_restr", 0.0)
+        force_restr.addPerParticleParameter("on")
+        # Define the target xyz coords for the restraint as per-atom (per-particle) parameters
+        force_restr.addPerParticleParameter("x0")
+        force_restr.addPerParticleParameter("y0")
+        force_restr.addPerParticleParameter("z0")
+
+        _add_particles(force_restr, res_atoms, np.zeros((len(res_atoms), 4)))
+
+        system.addForce(force_restr)
+
+    # Freeze atoms
+    if opt['freeze']:
+        _freeze_atoms(system, **opt)
+
+    with profiling.phase('context'):
+        simulation = _create_simulation(topology, system, integrator, positions=positions, box=box, **opt)
+
+    # Set starting positions and velocities
+    simulation.context.setPositions(positions)
+
+    # Set Box dimensions
+    if box is not None:
+        simulation.context.setPeriodicBoxVectors(box[0], box[1], box[2])
+
+    if velocities is not None:
+        opt['Logger'].info('RESTARTING simulation from a previous State')
+        simulation.context.setVelocities(velocities)
+
+    # OpenMM platform information
+    _print_platform_info(simulation, printfile, **opt)
+
+    for stage in stage_opts:
+
+        opt['Logger'].info('START STAGE {name}: {SimType}'.format(**stage))
+
+        state = simulation.context.getState(getPositions=True)
+
+        # Update the restraints to the stage starting positions
+        if force_restr is not None:
+            res_atom_set = res_atom_sets.get(stage['restraints'], np.empty(0, dtype=np.int64))
+            xyz = state.getPositions(asNumpy=True).value_in_unit(unit.nanometers)
+
+            params = np.column_stack((np.isin(res_atoms, res_atom_set), xyz[res_atoms]))
+            for i, (idx, p) in enumerate(zip(res_atoms.tolist(), params.tolist())):
+                force_restr.setParticleParameters(i, idx, p)
+            force_restr.updateParametersInContext(simulation.context)
+
+            if len(res_atom_set):
+                opt['Logger'].info("RESTRAINT mask applied to: {}"
+                                   "\tRestraint weight: {}".format(stage['restraints'],
+                                                                   stage['restraintWt'] *
+                                                                   unit.kilocalories_per_mole/unit.angstroms**2))
+                opt['Logger'].info("Number of restraint atoms: {}".format(len(res_atom_set)))
+                k_restr = (stage['restraintWt'] * unit.kilocalories_per_mole/unit.angstroms**2).value_in_unit(
+                    unit.kilojoules_per_mole/unit.nanometers**2)
+            else:
+                k_restr = 0.0
+
+            simulation.context.setParameter('k_restr', k_restr)
+
+        if barostat is not None:
+            barostat.setFrequency(25 if stage['SimType'] == 'npt' else 0)
+
+        if stage['SimType'] in ['nvt', 'npt']:
+
+            if stage['trajectory_interval']:
+                structure.coordinates = state.getPositions(asNumpy=True).value_in_unit(unit.angstroms)
+                _save_topology_pdb(structure, **stage)
+
+            if velocities is None:
+                # Set the velocities drawing from the Boltzmann distribution at the selected temperature
+                opt['Logger'].info('GENERATING a new starting State')
+                simulation.context.setVelocitiesToTemperature(opt['temperature']*unit.kelvin)
+                velocities = True
+
+            # Convert simulation time in steps
+            stage['steps'] = int(round(stage['time']/(stepLen.in_units_of(unit.picoseconds)/unit.picoseconds)))
+
+            # Set Reporters
+            simulation.currentStep = 0
+            for rep in getReporters(topology=topology, **stage):
+                simulation.reporters.append(rep)
+
+            opt['Logger'].info('Running {time} ps = {steps} steps of {SimType} at {temperature} K'.format(**stage))
+
+            start = (simulation.currentStep, time.perf_counter(), time.process_time())
+
+            # Start Simulation
+            with profiling.phase('step'):
+                simulation.step(stage['steps'])
+
+            # Close the stage reporters
+            with profiling.phase('reporters'):
+                for rep in simulation.reporters:
+                    if hasattr(rep, 'close'):
+                        rep.close()
+            _record_throughput(simulation, start, stepLen, **stage)
+            _attach_energies(simulation, **stage)
+            del simulation.reporters[:]
+
+            state = simulation.context.getState(getPositions=True, getVelocities=True,
+                                                getEnergy=True, enforcePeriodicBox=box is not None)
+
+            # numpy array in units of angstrom/picosecond
+            structure.velocities = state.getVelocities(asNumpy=True).value_in_unit(unit.angstroms/unit.picoseconds)
+
+        else:
+            opt['Logger'].info('Minimization steps: {steps}'.format(**stage))
+
+            restraint_k = None
+            if force_restr is not None and k_restr:
+                restraint_k = k_restr
+
+            start = (simulation.currentStep, time.perf_counter(), time.process_time())
+
+            with profiling.phase('minimization'):
+                state = _minimize(simulation, printfile, restraint_k=restraint_k, prefix=stage['name'], **stage)
+
+            _record_throughput(simulation, start, stepLen, **stage)
+
+        # numpy array in units of angstrom
+        xyz = state.getPositions(asNumpy=True).value_in_unit(unit.angstroms)
+        structure.coordinates = xyz
+        # OpenMM Quantity object
+        if box is not None:
+            structure.box_vectors = state.getPeriodicBoxVectors()
+
+        # Update the OEMol complex positions to match the new
+        # Parmed structure after the stage
+        utils.set_oemol_coords(opt['molecule'], xyz)
+
+        if stage['SimType'] in ['nvt', 'npt']:
+            # If required uploading files to Orion
+            with profiling.phase('upload'):
+                _file_processing(**stage)
+
+        if emit is not None and stage.get('emit'):
+            emit(stage)
+
+    return
+
+
+def checkpoint_filename(**opt):
+    """
+    Returns the checkpoint file name of the simulation. The file name
+    is built from the output file name, which starts with the system IDTag
+    """
+    chk_dir = opt.get('checkpoint_dir') or os.path.join(tempfile.gettempdir(), 'openmm_orion_checkpoints')
+    os.makedirs(chk_dir, exist_ok=True)
+
+    return os.path.join(chk_dir, os.path.basename(opt['outfname']) + '.chk')
+
+
+# Options which change the simulation resumed from a checkpoint
+_CHECKPOINT_KEY_OPTIONS = ['SimType', 'temperature', 'pressure', 'integrator', 'restraints', 'restraintWt',
+                           'freeze', 'steps', 'segment', 'trajectory_interval', 'reporter_interval']
+
+
+def checkpoint_key(molecule, settings, stepLen, positions, **opt):
+    """
+    Returns the key identifying the simulation a checkpoint belongs to:
+    the topology and parameter hash, the System settings, the time step,
+    the MD options and the starting coordinates. A checkpoint left by a
+    different run with the same file name is never resumed
+    """
+    xyz = np.asarray(positions.value_in_unit(unit.angstroms), dtype=np.float32)
+
+    key = [utils.PackageOEMol.getTopologyHash(molecule), sorted(settings.items()),
+           stepLen.value_in_unit(unit.picoseconds), [(k, opt.get(k)) for k in _CHECKPOINT_KEY_OPTIONS],
+           store.digest(xyz.tobytes())]
+
+    return store.digest(json.dumps(key, default=str).encode())
+
+
+def _output_filenames(**opt):
+    """
+    Returns the log and trajectory file names appended by the
+    reporters of a resumed simulation
+    """
+    fnames = []
+    if opt['reporter_interval'] and opt.get('text_log', False):
+        fnames.append(opt['outfname'] + '.log')
+    if opt['trajectory_interval']:
+        fnames.append(opt['outfname'] + TRAJECTORY_EXTENSIONS[opt['trajectory_filetype']])
+    return fnames
+
+
+class CheckpointReporter(object):
+    """
+    OpenMM Reporter which periodically saves the simulation State, the
+    current step and the size of the output files in a checkpoint file
+    """
+
+    def __init__(self, fname, reportInterval, fnames=(), key=''):
+        """
+        Initialization function
+
+        Parameters
+        ----------
+        fname : str
+            The checkpoint file name
+        reportInterval : int
+            The interval (in steps) at which to write the checkpoints
+        fnames : list of str
+            The output files whose size is saved in the checkpoint
+        key : str
+            The simulation key returned by checkpoint_key
+        """
+        self._fname = fname
+        self._reportInterval = reportInterval
+        self._fnames = list(fnames)
+        self._key = key
+
+    def describeNextReport(self, simulation):
+        steps = self._reportInterval - simulation.currentStep % self._reportInterval
+        return (steps, True, True, False, False, True)
+
+    def report(self, simulation, state):
+        # Flush the other reporters so the file sizes match the saved State
+        for rep in simulation.reporters:
+            if isinstance(rep, AsyncTrajectoryReporter):
+                # Wait for the buffered frames to be written
+                rep.flush()
+                continue
+            out = getattr(rep, '_out', None)
+            if hasattr(out, 'flush'):
+                out.flush()
+
+        offsets = [os.path.getsize(fn) if os.path.isfile(fn) else 0 for fn in self._fnames]
+
+        # The energies recorded in memory are saved with the State
+        energies = None
+        for rep in simulation.reporters:
+            if isinstance(rep, EnergyReporter):
+                energies = rep.encode()
+
+        data = payload.encode([('key', self._key.encode('ascii')),
+                               ('state', openmm.XmlSerializer.serialize(state).encode()),
+                               ('step', np.array([simulation.currentStep], dtype=np.int64)),
+                               ('fnames', '\n'.join(self._fnames).encode('utf-8')),
+                               ('offsets', np.array(offsets, dtype=np.int64)),
+                               ('energies', energies)], codec='gzip')
+
+        # Write to a temporary file first, a preempted worker
+        # must never leave a partially written checkpoint
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self._fname), prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, self._fname)
+
+
+def loadCheckpoint(fname, key='', **opt):
+    """
+    This function loads the simulation checkpoint
+
+    Parameters
+    ----------
+    fname : str
+        The checkpoint file name
+    key : str
+        The simulation key returned by checkpoint_key. Checkpoints
+        saved with a different key are skipped
+    opt: python dictionary
+        A dictionary containing all the MD setting info
+
+    Returns
+    -------
+    checkpoint : tuple or None
+        The (State, step, file offsets, energy table) tuple or None
+        if no valid checkpoint is present. The energy table is None
+        if the energies were not recorded
+    """
+    if not os.path.isfile(fname):
+        return None
+
+    if opt['trajectory_interval'] and opt['trajectory_filetype'] not in APPENDABLE_TRAJECTORIES:
+        opt['Logger'].warn('The checkpoint {} has been skipped: only {} trajectories '
+                           'can be appended'.format(fname, APPENDABLE_TRAJECTORIES))
+        return None
+
+    try:
+        with open(fname, 'rb') as f:
+            blocks = payload.decode(f.read())
+        chk_key = blocks['key'].decode('ascii') if 'key' in blocks else ''
+        state = openmm.XmlSerializer.deserialize(blocks['state'].decode())
+        step = int(blocks['step'][0])
+        fnames = blocks['fnames'].decode('utf-8').split('\n') if blocks['fnames'] else []
+        offsets = dict(zip(fnames, [int(off) for off in blocks['offsets']]))
+        energies = payload.decode(blocks['energies']) if 'energies' in blocks else None
+    except Exception as e:
+        opt['Logger'].warn('The checkpoint {} has been skipped: {}'.format(fname, str(e)))
+        return None
+
+    if chk_key != key:
+        opt['Logger'].warn('The checkpoint {} belongs to a different system or simulation '
+                           'settings and has been skipped'.format(fname))
+        return None
+
+    if step >= opt['steps'] or fnames != _output_filenames(**opt):
+        opt['Logger'].warn('The checkpoint {} does not match the simulation settings '
+                           'and has been skipped'.format(fname))
+        return None
+
+    # Records reported after the checkpoint are discarded
+    if energies is not None:
+        keep = energies['step'] <= step
+        energies = OrderedDict([(name, values[keep]) for name, values in energies.items()])
+
+    return state, step, offsets, energies
+
+
+def _truncate_outputs(offsets, step, first_step=0, **opt):
+    """
+    This supporting function truncates the log and trajectory files
+    to their size at the checkpoint time. The files of a production
+    segment only hold the frames written from first_step on
+    """
+    for fn, offset in offsets.items():
+        if not os.path.isfile(fn):
+            continue
+        with open(fn, 'r+b') as f:
+            f.truncate(offset)
+            # The DCD header stores the number of frames, written
+            # at the multiples of the interval after first_step
+            if fn.endswith('.dcd') and offset:
+                interval = opt['trajectory_interval']
+                f.seek(8)
+                f.write(struct.pack('<i', step // interval - first_step // interval))
+
+    return
+
+
+# Hydrogen mass in amu used by the hydrogen mass repartitioning
+HMR_HYDROGEN_MASS = 4.0
+# Maximum supported time step in fs
+MAX_TIME_STEP = 4.0
+
+
+def _time_step(**opt):
+    """
+    This supporting function returns the integration time step. Time
+    steps longer than 2 fs require the hydrogen mass repartitioning
+    """
+    timestep = opt.get('timestep', 2.0)
+
+    if timestep > MAX_TIME_STEP:
+        oechem.OEThrow.Fatal('The time step {} fs is larger than the maximum supported '
+                             'time step {} fs'.format(timestep, MAX_TIME_STEP))
+    if timestep > 2.0 and not opt.get('hmr', False):
+        oechem.OEThrow.Fatal('Time steps larger than 2 fs require the hydrogen mass repartitioning')
+
+    return timestep * unit.femtoseconds
+
+
+def _system_settings(box, **opt):
+    """
+    This supporting function returns the OpenMM System settings. With the
+    hydrogen mass repartitioning the hydrogen masses are increased taking the
+    difference from the bonded heavy atoms, bonds to hydrogen are constrained
+    and water molecules are made rigid
+    """
+    settings = {'nonbondedMethod': opt['nonbondedMethod'] if box is not None else 'NoCutoff',
+                'constraints': opt['constraints'],
+                'rigidWater': True}
+
+    if box is not None:
+        settings['nonbondedCutoff'] = opt['nonbondedCutoff']
+
+    if opt.get('hmr', False):
+        opt['Logger'].info("Hydrogen mass repartitioning is On. Hydrogen mass: {} amu".format(HMR_HYDROGEN_MASS))
+        settings['hydrogenMass'] = HMR_HYDROGEN_MASS
+        if opt['constraints'] == 'None':
+            settings['constraints'] = 'HBonds'
+
+    return settings
+
+
+# Number of inner steps per outer step of the multiple time step integrator
+MTS_SUBSTEPS = 2
+
+
+def _create_integrator(system, stepLen, **opt):
+    """
+    This supporting function creates the selected OpenMM integrator. The
+    multiple time step integrator evaluates the PME reciprocal space on the
+    outer time step (force group 1) and all the other forces on the inner
+    one (force group 0). The Verlet integrator is coupled to an Andersen
+    thermostat added to the system
+    """
+    family = opt.get('integrator', 'Langevin')
+    temperature = opt['temperature']*unit.kelvin
+    friction = 1/unit.picoseconds
+
+    if family == 'Langevin':
+        integrator = openmm.LangevinIntegrator(temperature, friction, stepLen)
+
+    elif family == 'LangevinMiddle':
+        if not hasattr(openmm, 'LangevinMiddleIntegrator'):
+            oechem.OEThrow.Fatal('The LangevinMiddle integrator requires OpenMM 7.5 or later')
+        integrator = openmm.LangevinMiddleIntegrator(temperature, friction, stepLen)
+
+    elif family == 'MTS':
+        reciprocal = False
+        for force in system.getForces():
+            force.setForceGroup(0)
+            if isinstance(force, openmm.NonbondedForce) and force.getNonbondedMethod() in [openmm.NonbondedForce.PME,
+                                                                                          openmm.NonbondedForce.Ewald]:
+                force.setReciprocalSpaceForceGroup(1)
+                reciprocal = True
+        if not reciprocal:
+            oechem.OEThrow.Fatal('The MTS integrator requires the PME or Ewald nonbonded method')
+
+        opt['Logger'].info('MTS integrator: reciprocal space every {} and direct space every {}'.format(
+            stepLen, stepLen/MTS_SUBSTEPS))
+
+        groups = [(1, 1), (0, MTS_SUBSTEPS)]
+        if hasattr(openmm, 'MTSLangevinIntegrator'):
+            integrator = openmm.MTSLangevinIntegrator(temperature, friction, stepLen, groups)
+        else:
+            integrator = openmm.MTSIntegrator(stepLen, groups)
+            system.addForce(openmm.AndersenThermostat(temperature, friction))
+
+    elif family == 'VerletAndersen':
+        integrator = openmm.VerletIntegrator(stepLen)
+        system.addForce(openmm.AndersenThermostat(temperature, friction))
+
+    else:
+        oechem.OEThrow.Fatal('The selected integrator is not supported: {}'.format(family))
+
+    return integrator
+
+
+def _center_structure(structure):
+    """
+    This supporting function translates the Parmed structure coordinates
+    to the center of the OpenMM Unit Cell and returns the new positions
+    """
+    # Numpy array in A
+    coords = structure.coordinates
+    # System Center of Geometry
+    cog = np.mean(coords, axis=0)
+    # System box vectors
+    box_v = structure.box_vectors.in_units_of(unit.angstrom)/unit.angstrom
+    box_v = np.array([box_v[0][0], box_v[1][1], box_v[2][2]])
+    # Translation vector
+    delta = box_v/2 - cog
+    # New Coordinates
+    new_coords = coords + delta
+    structure.coordinates = new_coords
+
+    return structure.positions
+
+
+def _restraint_release(**opt):
+    """
+    This supporting function returns the restraint weight scale factors
+    of the minimization stages, e.g. 1.0, 0.1, 0.0 for a strong, weak
+    and unrestrained minimization
+    """
+    release = opt.get('restraint_release', '1.0')
+    if isinstance(release, str):
+        release = [r for r in release.replace(',', ' ').split()]
+    try:
+        factors = [float(r) for r in release]
+    except ValueError:
+        oechem.OEThrow.Fatal("The restraint release factors are not valid: {}".format(release))
+
+    return factors or [1.0]
+
+
+def _minimize(simulation, printfile, restraint_k=None, prefix='Minimization', **opt):
+    """
+    This supporting function minimizes the system in the current Context.
+    If restraint_k is set, the restraint weight in kJ/(mol nm^2), the
+    minimization is staged by scaling the k_restr global parameter with
+    the restraint release factors. Each stage is a single minimizeEnergy
+    call, so L-BFGS keeps its curvature history along the whole stage,
+    which stops on the OpenMM tolerance criterion or after steps iterations
+    (if not 0). The starting and final energy, the maximum and RMS force on
+    the mobile atoms, the convergence flag, the iteration limit and the wall
+    time of each stage are attached as SD data with tags starting with the
+    passed prefix. OpenMM does not report the iterations actually run
+    """
+    tolerance = opt.get('tolerance', 10.0)
+    max_iterations = opt['steps']
+    factors = _restraint_release(**opt) if restraint_k is not None else [1.0]
+
+    system = simulation.system
+    mobile = np.array([system.getParticleMass(i).value_in_unit(unit.dalton) > 0.0
+                       for i in range(system.getNumParticles())])
+    kj_to_kcal = unit.kilojoules_per_mole.conversion_factor_to(unit.kilocalories_per_mole)
+
+    state = simulation.context.getState(getEnergy=True)
+    print('Initial energy = {}'.format(state.getPotentialEnergy().in_units_of(unit.kilocalorie_per_mole)),
+          file=printfile)
+
+    for n, factor in enumerate(factors):
+        if restraint_k is not None:
+            simulation.context.setParameter('k_restr', restraint_k * factor)
+
+        # The starting energy of the stage, with its restraint weight
+        state = simulation.context.getState(getEnergy=True)
+        initial_energy = state.getPotentialEnergy().value_in_unit(unit.kilojoules_per_mole)
+
+        start = time.perf_counter()
+        simulation.minimizeEnergy(tolerance=tolerance*unit.kilojoules_per_mole/unit.nanometers,
+                                  maxIterations=max_iterations)
+        wall_time = time.perf_counter() - start
+
+        state = simulation.context.getState(getEnergy=True, getForces=True)
+        energy = state.getPotentialEnergy().value_in_unit(unit.kilojoules_per_mole)
+        forces = state.getForces(asNumpy=True).value_in_unit(unit.kilojoules_per_mole/unit.nanometers)[mobile]
+        max_force = np.sqrt((forces**2).sum(axis=1)).max(initial=0.0)
+        rms_force = np.sqrt((forces**2).mean()) if len(forces) else 0.0
+        # OpenMM stops when the root-mean-square of the force components reaches the tolerance
+        converged = rms_force <= tolerance
+
+        restraintWt = opt.get('restraintWt', 0.0) * factor if restraint_k is not None else 0.0
+
+        opt['Logger'].info('Minimization stage {}: restraintWt {} kcal/(mol A^2), iteration limit {}, {:.2f} s, '
+                           'energy {:.3f} -> {:.3f} kcal/mol, max force {:.3f} kJ/(mol nm), RMS force {:.3f} '
+                           'kJ/(mol nm), converged {}'.format(n, restraintWt, max_iterations, wall_time,
+                                                              initial_energy * kj_to_kcal, energy * kj_to_kcal,
+                                                              max_force, rms_force, converged))
+
+        tag = '{}_stage{}_'.format(prefix, n)
+        oechem.OESetSDData(opt['molecule'], tag + 'restraintWt', str(restraintWt))
+        oechem.OESetSDData(opt['molecule'], tag + 'max_iterations', str(max_iterations))
+        oechem.OESetSDData(opt['molecule'], tag + 'wall_time', '{:.4f}'.format(wall_time))
+        oechem.OESetSDData(opt['molecule'], tag + 'converged', str(converged))
+        oechem.OESetSDData(opt['molecule'], tag + 'initial_energy', '{:.4f}'.format(initial_energy * kj_to_kcal))
+        oechem.OESetSDData(opt['molecule'], tag + 'energy', '{:.4f}'.format(energy * kj_to_kcal))
+        oechem.OESetSDData(opt['molecule'], tag + 'max_force', '{:.4f}'.format(max_force))
+        oechem.OESetSDData(opt['molecule'], tag + 'rms_force', '{:.4f}'.format(rms_force))
+
+    # The restraint weight of the calling stage is restored
+    if restraint_k is not None:
+        simulation.context.setParameter('k_restr', restraint_k)
+
+    state = simulation.context.getState(getPositions=True, getEnergy=True)
+    print('Minimized energy = {}'.format(state.getPotentialEnergy().in_units_of(unit.kilocalorie_per_mole)),
+          file=printfile)
+
+    return state
+
+
+def _adaptive_equilibration(simulation, stepLen, **opt):
+    """
+    This supporting function runs the NPT equilibration in chunks of
+    adaptive_chunk ps and stops as soon as the density, volume and
+    potential energy sampled every adaptive_interval steps are detected
+    as equilibrated. The selected simulation time is the maximum time.
+    The detected equilibration time is attached to the molecule as SD data
+    """
+    if opt['SimType'] != 'npt':
+        oechem.OEThrow.Fatal('The adaptive equilibration is only supported for NPT simulations')
+    if opt.get('segment') is not None:
+        oechem.OEThrow.Fatal('The adaptive equilibration cannot be used by segmented production runs')
+
+    step_ps = stepLen.value_in_unit(unit.picoseconds)
+    chunk = max(1, int(round(opt.get('adaptive_chunk', 20.0) / step_ps)))
+    interval = opt.get('adaptive_interval', 100)
+
+    # Dedicated sampler: its records are not attached to the molecule. A
+    # resumed simulation restarts the sampling from the checkpoint
+    sampler = EnergyReporter(interval, totalSteps=opt['steps'] - simulation.currentStep)
+    simulation.reporters.insert(0, sampler)
+
+    first_step = simulation.currentStep
+    t0 = None
+    while simulation.currentStep < opt['steps']:
+        simulation.step(min(chunk, opt['steps'] - simulation.currentStep))
+
+        t0 = equilibration.equilibrated(sampler.table())
+        if t0 is not None:
+            break
+
+    simulation.reporters.remove(sampler)
+
+    run_time = (simulation.currentStep - first_step) * step_ps
+
+    if t0 is not None:
+        eq_time = (sampler.table()['step'][t0] - first_step) * step_ps
+        opt['Logger'].info('Equilibration detected at {:.2f} ps: stopping after {:.2f} ps of {} ps'.format(
+            eq_time, run_time, opt['time']))
+        oechem.OESetSDData(opt['molecule'], 'Equilibration_time', '{:.2f}'.format(eq_time))
+    else:
+        opt['Logger'].warn('Equilibration not detected in {} ps'.format(opt['time']))
+
+    oechem.OESetSDData(opt['molecule'], 'Equilibration_converged', str(t0 is not None))
+    oechem.OESetSDData(opt['molecule'], 'Equilibration_run_time', '{:.2f}'.format(run_time))
+
+    return
+
+
+def _record_throughput(simulation, start, stepLen, append=False, **opt):
+    """
+    This supporting function attaches to the molecule the throughput of the
+    MD stage started at the passed (step, wall time, cpu time): simulated
+    ns, steps, wall and cpu time, atoms, platform, ns/day and steps/s. The
+    SD tags are prefixed by the stage name
+    """
+    steps = simulation.currentStep - start[0]
+    ns = steps * stepLen.value_in_unit(unit.nanoseconds) if opt['SimType'] in ['nvt', 'npt'] else 0.0
+
+    record = throughput.set_throughput(opt['molecule'], opt.get('stage_name', opt['SimType']),
+                                       steps=steps,
+                                       ns=ns,
+                                       wall_time=time.perf_counter() - start[1],
+                                       cpu_time=time.process_time() - start[2],
+                                       atoms=simulation.system.getNumParticles(),
+                                       platform=simulation.context.getPlatform().getName(),
+                                       append=append)
+
+    if ns:
+        opt['Logger'].info('Throughput: {ns_per_day:.2f} ns/day, {steps_per_s:.1f} steps/s, '
+                           '{wall_time:.1f} s wall time'.format(**record))
+
+    return
+
+
+def _attach_energies(simulation, append=False, **opt):
+    """
+    This supporting function attaches to the molecule the energy table
+    recorded by the EnergyReporter of the simulation. If append is True
+    the table is appended to the one already attached
+    """
+    for rep in simulation.reporters:
+        if isinstance(rep, EnergyReporter):
+            table = rep.table()
+            if append:
+                table = concatenate_energies([utils.PackageOEMol.getEnergies(opt['molecule']), table])
+            utils.PackageOEMol.packEnergies(opt['molecule'], table, codec=opt.get('codec'))
+            opt['Logger'].info('Energy table attached: {} records'.format(len(table['step'])))
+
+    return
+
+
+def _freeze_atoms(system, **opt):
+    """
+    This supporting function freezes the atoms selected by the
+    freeze mask by setting their masses to zero
+    """
+    opt['Logger'].info("FREEZE mask applied to: {}".format(opt['freeze']))
+
+    freeze_atoms = masks.select_atoms(opt['molecule'], opt['freeze'])
+    opt['Logger'].info("Number of frozen atoms: {}".format(len(freeze_atoms)))
+    # Set atom masses to zero
+    for idx in freeze_atoms.tolist():
+        system.setParticleMass(idx, 0.0)
+
+    return
+
+
+def _add_particles(force, atom_indices, params):
+    """
+    This supporting function adds the selected atoms to the passed
+    CustomExternalForce with the per-particle parameter array rows
+    """
+    for idx, p in zip(np.asarray(atom_indices).tolist(), np.asarray(params, dtype=np.float64).tolist()):
+        force.addParticle(idx, p)
+
+    return
+
+
+def _create_simulation(topology, system, integrator, positions=None, box=None, **opt):
+    """
+    This supporting function creates the OpenMM Simulation
+    on the selected platform. On the CPU platform the number of
+    threads is set from the co-resident workers or the host
+    calibration. Auto-Benchmarked selects the fastest validated
+    platform from the host benchmarks, see the platforms module
+    """
+    if opt['platform'] == 'Auto-Benchmarked':
+        # Fastest validated platform from the host benchmark cache
+        name, properties = platforms.select_platform(system, positions=positions, box=box, **opt)
+        simulation = app.Simulation(topology, system, integrator,
+                                    platform=openmm.Platform.getPlatformByName(name),
+                                    platformProperties=properties)
+    elif opt['platform'] == 'Auto':
+        # OpenMM selects the fastest platform. The CPU threads are set
+        # to avoid the oversubscription of the host
+        if platforms.fastest_platform() == 'CPU':
+            properties = platforms.platform_properties('CPU', system=system, positions=positions, box=box, **opt)
+            simulation = app.Simulation(topology, system, integrator,
+                                        platform=openmm.Platform.getPlatformByName('CPU'),
+                                        platformProperties=properties)
+        else:
+            simulation = app.Simulation(topology, system, integrator)
     else:
         try:
             platform = openmm.Platform.getPlatformByName(opt['platform'])
@@ -122,7 +1139,7 @@ def simulation(mdData, **opt):
         if opt['platform'] in ['CUDA', 'OpenCL']:
             try:
                 # Set platform CUDA or OpenCL precision
-                properties = {'Precision': opt['cuda_opencl_precision']}
+                properties = platforms.platform_properties(opt['platform'], **opt)
 
                 simulation = app.Simulation(topology, system, integrator,
                                             platform=platform,
@@ -131,50 +1148,18 @@ def simulation(mdData, **opt):
                 oechem.OEThrow.Fatal('It was not possible to set the {} precision for the {} platform'
                                      .format(opt['cuda_opencl_precision'], opt['platform']))
         else:
-            simulation = app.Simulation(topology, system, integrator, platform=platform)
-
-    # Set starting positions and velocities
-    simulation.context.setPositions(positions)
-
-    # Set Box dimensions
-    if box is not None:
-        simulation.context.setPeriodicBoxVectors(box[0], box[1], box[2])
+            properties = platforms.platform_properties(opt['platform'], system=system, positions=positions,
+                                                       box=box, **opt)
+            simulation = app.Simulation(topology, system, integrator, platform=platform,
+                                        platformProperties=properties)
 
-    # If the velocities are not present in the Parmed structure
-    # new velocity vectors are generated otherwise the system is
-    # restarted from the previous State
-    if opt['SimType'] in ['nvt', 'npt']:
-
-        if opt['trajectory_interval']:
-            structure.save(opt['outfname']+'.pdb', overwrite=True)
-            # GAC ADDED - TESTING
-            # Preserve original pdb file residue numbers
-            pdbfname_test = opt['outfname'] + '_ordering_test' + '.pdb'
-            ofs = oechem.oemolostream(pdbfname_test)
-            flavor = ofs.GetFlavor(oechem.OEFormat_PDB) ^ oechem.OEOFlavor_PDB_OrderAtoms
-            ofs.SetFlavor(oechem.OEFormat_PDB, flavor)
-
-            new_temp_mol = oeommutils.openmmTop_to_oemol(structure.topology, structure.positions, verbose=False)
-            new_pos = new_temp_mol.GetCoords()
-            opt['molecule'].SetCoords(new_pos)
-            oechem.OEWriteConstMolecule(ofs, opt['molecule'])
+    return simulation
 
-        if velocities is not None:
-            opt['Logger'].info('RESTARTING simulation from a previous State')
-            simulation.context.setVelocities(velocities)
-        else:
-            # Set the velocities drawing from the Boltzmann distribution at the selected temperature
-            opt['Logger'].info('GENERATING a new starting State')
-            simulation.context.setVelocitiesToTemperature(opt['temperature']*unit.kelvin)
 
-        # Convert simulation time in steps
-        opt['steps'] = int(round(opt['time']/(stepLen.in_units_of(unit.picoseconds)/unit.picoseconds)))
-        
-        # Set Reporters
-        for rep in getReporters(**opt):
-            simulation.reporters.append(rep)
-            
-    # OpenMM platform information
+def _print_platform_info(simulation, printfile, **opt):
+    """
+    This supporting function prints the host and OpenMM platform information
+    """
     mmver = openmm.version.version
     mmplat = simulation.context.getPlatform()
 
@@ -187,56 +1172,210 @@ def simulation(mdData, **opt):
         for prop in mmplat.getPropertyNames():
             val = mmplat.getPropertyValue(simulation.context, prop)
             print(prop, ':', val, file=printfile)
-            
+
     print('OpenMM({}) simulation generated for {} platform'.format(mmver, mmplat.getName()), file=printfile)
 
-    if opt['SimType'] in ['nvt', 'npt']:
+    return
 
-        opt['Logger'].info('Running {time} ps = {steps} steps of {SimType} at {temperature} K'.format(**opt))
-        
-        # Start Simulation
-        simulation.step(opt['steps'])
 
-        if box is not None:
-            state = simulation.context.getState(getPositions=True, getVelocities=True,
-                                                getEnergy=True, enforcePeriodicBox=True)
-        else:
-            state = simulation.context.getState(getPositions=True, getVelocities=True,
-                                                getEnergy=True, enforcePeriodicBox=False)
-        
-    elif opt['SimType'] == 'min':
-        # Start Simulation
-        opt['Logger'].info('Minimization steps: {steps}'.format(**opt))
+def _trajectory_subset(topology, **opt):
+    """
+    This supporting function selects the atoms written in the trajectory
+    by using the trajectory_subset mask
 
-        state = simulation.context.getState(getEnergy=True)
+    Returns
+    -------
+    atom_indices : numpy array or None
+        The sorted indices of the selected atoms. None if no subset is selected
+    sub_topology : OpenMM Topology
+        The topology of the selected atoms
+    """
+    mask = opt.get('trajectory_subset', '')
+    if not mask:
+        return None, topology
 
-        print('Initial energy = {}'.format(state.getPotentialEnergy().in_units_of(unit.kilocalorie_per_mole)),
-              file=printfile)
+    atom_indices = masks.select_atoms(opt['molecule'], mask)
+    if not len(atom_indices):
+        oechem.OEThrow.Fatal("The trajectory subset mask {} does not select any atom".format(mask))
 
-        simulation.minimizeEnergy(maxIterations=opt['steps'])
+    sub_topology = mdtraj.Topology.from_openmm(topology).subset(atom_indices).to_openmm()
+    sub_topology.setPeriodicBoxVectors(topology.getPeriodicBoxVectors())
 
-        state = simulation.context.getState(getPositions=True, getEnergy=True)
-        print('Minimized energy = {}'.format(state.getPotentialEnergy().in_units_of(unit.kilocalorie_per_mole)),
-              file=printfile)
+    return atom_indices, sub_topology
 
-    # OpenMM Quantity object
-    structure.positions = state.getPositions(asNumpy=False)
-    # OpenMM Quantity object
-    if box is not None:
-        structure.box_vectors = state.getPeriodicBoxVectors()
 
-    if opt['SimType'] in ['nvt', 'npt']:
-        # numpy array in units of angstrom/picosecond
-        structure.velocities = state.getVelocities(asNumpy=False)
+def _save_topology_pdb(structure, **opt):
+    """
+    This supporting function saves the pdb files used as
+    topology for the trajectory files. If a trajectory subset
+    is selected only the selected atoms are saved
+    """
+    atom_indices, sub_topology = _trajectory_subset(structure.topology, **opt)
 
-        # If required uploading files to Orion
-        _file_processing(**opt)
+    if atom_indices is None:
+        structure.save(opt['outfname']+'.pdb', overwrite=True)
+    else:
+        positions = structure.coordinates[atom_indices] * unit.angstroms
+        with open(opt['outfname']+'.pdb', 'w') as f:
+            app.PDBFile.writeFile(sub_topology, positions, f)
 
-    # Update the OEMol complex positions to match the new
-    # Parmed structure after the simulation
-    new_temp_mol = oeommutils.openmmTop_to_oemol(structure.topology, structure.positions, verbose=False)
-    new_pos = new_temp_mol.GetCoords()
-    opt['molecule'].SetCoords(new_pos)
+    # GAC ADDED - TESTING
+    # Preserve original pdb file residue numbers
+    pdbfname_test = opt['outfname'] + '_ordering_test' + '.pdb'
+    ofs = oechem.oemolostream(pdbfname_test)
+    flavor = ofs.GetFlavor(oechem.OEFormat_PDB) ^ oechem.OEOFlavor_PDB_OrderAtoms
+    ofs.SetFlavor(oechem.OEFormat_PDB, flavor)
+
+    utils.set_oemol_coords(opt['molecule'], structure.coordinates)
+
+    if atom_indices is None:
+        oechem.OEWriteConstMolecule(ofs, opt['molecule'])
+    else:
+        # The subset atoms are selected by their index in the original molecule
+        bv = oechem.OEBitVector(opt['molecule'].GetMaxAtomIdx())
+        for idx in atom_indices:
+            bv.SetBitOn(int(idx))
+        submol = oechem.OEMol()
+        oechem.OESubsetMol(submol, opt['molecule'], oechem.OEAtomIdxSelected(bv))
+        oechem.OEWriteConstMolecule(ofs, submol)
+
+    ofs.close()
+
+    return
+
+
+def _dcd_header_size(f):
+    """
+    This supporting function returns the size in bytes of the DCD
+    file header: the CORD, title and number of atoms records
+    """
+    f.seek(0)
+    size = 0
+    for i in range(3):
+        nbytes, = struct.unpack('<i', f.read(4))
+        f.seek(nbytes + 4, os.SEEK_CUR)
+        size += nbytes + 8
+    return size
+
+
+def _segment_filenames(outfname, **opt):
+    """
+    This supporting function returns the output file names of a
+    production segment: trajectory, topology pdb files and log
+    """
+    return [outfname + TRAJECTORY_EXTENSIONS[opt['trajectory_filetype']],
+            outfname + '.pdb',
+            outfname + '_ordering_test.pdb',
+            outfname + '.log']
+
+
+def store_segment_files(**opt):
+    """
+    This function saves the output files of a completed production segment
+    in the segment store, shared by the workers, as soon as the segment
+    completes. Only the file references travel with the molecule to the
+    worker running the next segment. The local copies are removed
+
+    Parameters
+    ----------
+    opt: python dictionary
+        A dictionary containing all the MD setting info
+    """
+    fnames = [fn for fn in _segment_filenames(opt['outfname'], **opt) if os.path.isfile(fn)]
+
+    # The merged trajectory uses the topology files of the first segment
+    stored = [fn for fn in fnames if not (fn.endswith('.pdb') and opt.get('segment', 0) > 0)]
+
+    utils.PackageOEMol.packSegmentFiles(opt['molecule'], stored, store_path=opt.get('segment_store'))
+
+    for fn in fnames:
+        os.remove(fn)
+
+    return
+
+
+def merge_segments(nsegments, **opt):
+    """
+    This function merges the log and trajectory files produced by the
+    segments of a segmented production run. The segment files are named
+    <outfname>_seg<index>. The files of the previous segments, which may
+    have run on other workers, are copied from the segment store. The merged
+    files are named after outfname and are eventually tarred and uploaded
+    to Orion
+
+    Parameters
+    ----------
+    nsegments : int
+        The number of production segments
+    opt: python dictionary
+        A dictionary containing all the MD setting info
+    """
+    outfname = opt['outfname']
+    seg_fnames = ['{}_seg{}'.format(outfname, idx) for idx in range(nsegments)]
+
+    opt['Logger'].info('Merging {} production segments in {}'.format(nsegments, outfname))
+
+    utils.PackageOEMol.restoreSegmentFiles(opt['molecule'])
+
+    if opt['reporter_interval'] and opt.get('text_log', False):
+        with open(outfname + '.log', 'w') as out:
+            for idx, fn in enumerate(seg_fnames):
+                with open(fn + '.log', 'r') as f:
+                    for line in f:
+                        # The header line is only taken from the first segment
+                        if idx and line.startswith('#'):
+                            continue
+                        out.write(line)
+                os.remove(fn + '.log')
+
+    if opt['trajectory_interval']:
+        # The topology files of the first segment are used for the merged trajectory
+        os.replace(seg_fnames[0] + '.pdb', outfname + '.pdb')
+        os.replace(seg_fnames[0] + '_ordering_test.pdb', outfname + '_ordering_test.pdb')
+        for fn in seg_fnames[1:]:
+            for ext in ['.pdb', '_ordering_test.pdb']:
+                if os.path.isfile(fn + ext):
+                    os.remove(fn + ext)
+
+        ext = TRAJECTORY_EXTENSIONS[opt['trajectory_filetype']]
+
+        if opt['trajectory_filetype'] in ['DCD', 'QTRJ']:
+            # The frames are concatenated without decoding them
+            nframes = 0
+            with open(outfname + ext, 'wb') as out:
+                for idx, fn in enumerate(seg_fnames):
+                    with open(fn + ext, 'rb') as f:
+                        if ext == '.dcd':
+                            header_size = _dcd_header_size(f)
+                            f.seek(8)
+                            nframes += struct.unpack('<i', f.read(4))[0]
+                        else:
+                            header_size = qtrj_header_size(fn + ext)
+                        f.seek(0 if idx == 0 else header_size)
+                        while True:
+                            chunk = f.read(1 << 24)
+                            if not chunk:
+                                break
+                            out.write(chunk)
+                    os.remove(fn + ext)
+                if ext == '.dcd':
+                    # Update the number of frames in the header
+                    out.seek(8)
+                    out.write(struct.pack('<i', nframes))
+        else:
+            if opt['trajectory_filetype'] == 'NetCDF':
+                trj = mdtraj.join([mdtraj.load_netcdf(fn + ext, top=outfname + '.pdb') for fn in seg_fnames])
+                trj.save_netcdf(outfname + ext)
+            else:
+                trj = mdtraj.join([mdtraj.load_hdf5(fn + ext) for fn in seg_fnames])
+                trj.save_hdf5(outfname + ext)
+            for fn in seg_fnames:
+                os.remove(fn + ext)
+
+        opt['molecule'].SetData(oechem.OEGetTag("Trj_fname"), outfname + ext)
+
+    # If required uploading files to Orion
+    _file_processing(**opt)
 
     return
 
@@ -255,15 +1394,10 @@ def _file_processing(**opt):
     """
 
     # Set the trajectory file name
-    if opt['trajectory_filetype'] == 'NetCDF':
-        trj_fn = opt['outfname'] +'.nc'
-    elif opt['trajectory_filetype'] == 'DCD':
-        trj_fn = opt['outfname'] +'.dcd'
-    elif opt['trajectory_filetype'] == 'HDF5':
-        trj_fn = opt['outfname'] + '.hdf5'
-    else:
+    if opt['trajectory_filetype'] not in TRAJECTORY_EXTENSIONS:
         oechem.OEThrow.Fatal("The selected trajectory filetype is not supported: {}"
                              .format(opt['trajectory_filetype']))
+    trj_fn = opt['outfname'] + TRAJECTORY_EXTENSIONS[opt['trajectory_filetype']]
     # Set .pdb file names
     pdb_fn = opt['outfname'] + '.pdb'
     pdb_order_fn = opt['outfname'] + '_ordering_test' + '.pdb'
@@ -312,9 +1446,9 @@ def _file_processing(**opt):
     return
 
 
-def getReporters(totalSteps=None, outfname=None, **opt):
+def getReporters(totalSteps=None, outfname=None, append=False, topology=None, energies=None, **opt):
     """
-    Creates 3 OpenMM Reporters for the simulation.
+    Creates the OpenMM Reporters for the simulation.
 
     Parameters
     ----------
@@ -324,13 +1458,22 @@ def getReporters(totalSteps=None, outfname=None, **opt):
         Step frequency to write to reporter file.
     outfname : str
         Specifies the filename prefix for the reporters.
+    append : bool
+        If True the log and trajectory files are appended to the existing
+        ones. Only the DCD and QTRJ trajectory formats can be appended
+    topology : OpenMM Topology
+        The simulation topology used by the asynchronous trajectory reporter
+    energies : dict or None
+        The energy table of a resumed simulation
 
     Returns
     -------
-    reporters : list of three openmm.app.simulation.reporters
-        (0) state_reporter: writes energies to '.log' file.
-        (1) progress_reporter: prints simulation progress to 'sys.stdout'
-        (2) traj_reporter: writes trajectory to file. Supported format .nc, .dcd, .hdf5
+    reporters : list of openmm.app.simulation.reporters
+        (0) energy_reporter: records the energies in memory
+        (1) state_reporter: writes energies to '.log' file, if text_log is selected
+        (2) progress_reporter: prints the simulation progress to 'sys.stdout' at
+            most every progress_interval seconds
+        (3) traj_reporter: writes trajectory to file. Supported format .nc, .dcd, .hdf5, .qtrj
     """
     if totalSteps is None:
         totalSteps = opt['steps']
@@ -340,39 +1483,62 @@ def getReporters(totalSteps=None, outfname=None, **opt):
     reporters = []
 
     if opt['reporter_interval']:
-        state_reporter = app.StateDataReporter(outfname+'.log', separator="\t",
-                                               reportInterval=opt['reporter_interval'],
-                                               step=True,
-                                               potentialEnergy=True, totalEnergy=True,
-                                               volume=True, density=True, temperature=True)
+        energy_reporter = EnergyReporter(opt['reporter_interval'], totalSteps=totalSteps, table=energies)
+
+        reporters.append(energy_reporter)
 
-        reporters.append(state_reporter)
+        if opt.get('text_log', False):
+            state_reporter = app.StateDataReporter(outfname+'.log', separator="\t",
+                                                   reportInterval=opt['reporter_interval'],
+                                                   step=True,
+                                                   potentialEnergy=True, totalEnergy=True,
+                                                   volume=True, density=True, temperature=True,
+                                                   append=append)
 
-        progress_reporter = app.StateDataReporter(stdout, separator="\t",
-                                                  reportInterval=opt['reporter_interval'],
-                                                  step=True, totalSteps=totalSteps,
-                                                  time=True, speed=True, progress=True,
-                                                  elapsedTime=True, remainingTime=True)
+            reporters.append(state_reporter)
 
-        reporters.append(progress_reporter)
+        if opt.get('progress_interval', 60.0) > 0:
+            progress_reporter = app.StateDataReporter(stdout, separator="\t",
+                                                      reportInterval=opt['reporter_interval'],
+                                                      step=True, totalSteps=totalSteps,
+                                                      time=True, speed=True, progress=True,
+                                                      elapsedTime=True, remainingTime=True)
+
+            reporters.append(RateLimitedReporter(progress_reporter, opt.get('progress_interval', 60.0)))
 
     if opt['trajectory_interval']:
 
-        trj_fname = outfname
-        # Trajectory file format selection
-        if opt['trajectory_filetype'] == 'NetCDF':
-            trj_fname += '.nc'
-            traj_reporter = mdtraj.reporters.NetCDFReporter(trj_fname, opt['trajectory_interval'])
-        elif opt['trajectory_filetype'] == 'DCD':
-            trj_fname += '.dcd'
-            traj_reporter = app.DCDReporter(trj_fname, opt['trajectory_interval'])
-        elif opt['trajectory_filetype'] == 'HDF5':
-            trj_fname += '.hdf5'
-            mdtraj.reporters.HDF5Reporter(trj_fname, opt['trajectory_interval'])
-        else:
+        if opt['trajectory_filetype'] not in TRAJECTORY_EXTENSIONS:
             oechem.OEThrow.Fatal("The selected trajectory file format is not supported: {}"
                                  .format(opt['trajectory_filetype']))
 
+        if append and opt['trajectory_filetype'] not in APPENDABLE_TRAJECTORIES:
+            oechem.OEThrow.Fatal("Only {} trajectories can be appended".format(APPENDABLE_TRAJECTORIES))
+
+        trj_fname = outfname + TRAJECTORY_EXTENSIONS[opt['trajectory_filetype']]
+
+        # Atoms written in the trajectory
+        atom_indices, sub_topology = _trajectory_subset(topology, **opt)
+
+        if (opt.get('async_trajectory', False) or opt['trajectory_filetype'] == 'QTRJ' or
+                (atom_indices is not None and opt['trajectory_filetype'] == 'DCD')):
+            # The frames are written from a background thread. The OpenMM DCD
+            # reporter does not support atom subsets
+            traj_reporter = AsyncTrajectoryReporter(trj_fname, opt['trajectory_interval'],
+                                                    filetype=opt['trajectory_filetype'],
+                                                    topology=sub_topology,
+                                                    atom_indices=atom_indices,
+                                                    precision=opt.get('trajectory_precision', 0.001),
+                                                    append=append)
+        elif opt['trajectory_filetype'] == 'NetCDF':
+            traj_reporter = mdtraj.reporters.NetCDFReporter(trj_fname, opt['trajectory_interval'],
+                                                            atomSubset=atom_indices)
+        elif opt['trajectory_filetype'] == 'DCD':
+            traj_reporter = app.DCDReporter(trj_fname, opt['trajectory_interval'], append=append)
+        else:
+            traj_reporter = mdtraj.reporters.HDF5Reporter(trj_fname, opt['trajectory_interval'],
+                                                          atomSubset=atom_indices)
+
         opt['molecule'].SetData(oechem.OEGetTag("Trj_fname"), trj_fname)
 
         reporters.append(traj_reporter)
@@ -0,0 +1,159 @@
+import numpy as np
+from openeye import oechem
+
+# Maximum number of grid cells along each axis
+_MAX_CELLS = 256
+
+
+class CellGrid(object):
+    """
+    Uniform cell grid spatial index over a set of points. The points are
+    binned once in cubic cells and the distance queries only compare the
+    query points with the points in the neighbouring cells, instead of
+    computing all the N*M distances
+    """
+
+    def __init__(self, xyz, cell_size):
+        """
+        Initialization function
+
+        Parameters
+        ----------
+        xyz : numpy array
+            The (N, 3) indexed points
+        cell_size : float
+            The grid cell edge. The queries are most efficient with a
+            cutoff close to the cell size
+        """
+        self.xyz = np.asarray(xyz, dtype=np.float64).reshape(-1, 3)
+
+        if len(self.xyz):
+            self.origin = self.xyz.min(axis=0)
+            extent = self.xyz.max(axis=0) - self.origin
+        else:
+            self.origin = np.zeros(3)
+            extent = np.zeros(3)
+
+        # Very small cells on large systems would make the grid too large
+        self.cell_size = max(float(cell_size), float(extent.max()) / (_MAX_CELLS - 1), 1e-6)
+
+        cells = self._cells(self.xyz)
+        self.shape = tuple(int(n) for n in cells.max(axis=0) + 1) if len(cells) else (1, 1, 1)
+
+        keys = np.ravel_multi_index(cells.T, self.shape) if len(cells) else np.empty(0, dtype=np.int64)
+        self.order = np.argsort(keys, kind='stable')
+        # Only the occupied cells are stored: the points of the cell
+        # keys[k] are order[starts[k]:starts[k+1]]
+        self.keys, starts = np.unique(keys[self.order], return_index=True)
+        self.starts = np.append(starts, len(keys))
+
+    def _cells(self, xyz):
+        return np.floor((xyz - self.origin) / self.cell_size).astype(np.int64)
+
+    def pairs(self, points, cutoff):
+        """
+        Returns the index pairs (i, j) of the query points i which
+        are within the cutoff distance from the indexed points j
+
+        Parameters
+        ----------
+        points : numpy array
+            The (M, 3) query points
+        cutoff : float
+            The cutoff distance
+
+        Returns
+        -------
+        i : numpy array
+            The query point indexes
+        j : numpy array
+            The indexed point indexes
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        cutoff2 = float(cutoff) ** 2
+        reach = int(np.ceil(float(cutoff) / self.cell_size))
+        shape = np.array(self.shape)
+
+        cells = self._cells(points)
+
+        ii, jj = [], []
+
+        offsets = np.arange(-reach, reach + 1)
+        for dx in offsets:
+            for dy in offsets:
+                for dz in offsets:
+                    nbr = cells + (dx, dy, dz)
+                    inside = np.all((nbr >= 0) & (nbr < shape), axis=1)
+                    if not inside.any():
+                        continue
+                    query = np.nonzero(inside)[0]
+                    keys = np.ravel_multi_index(nbr[inside].T, self.shape)
+
+                    k = np.searchsorted(self.keys, keys)
+                    occupied = k < len(self.keys)
+                    occupied[occupied] = self.keys[k[occupied]] == keys[occupied]
+                    query, k = query[occupied], k[occupied]
+
+                    begin = self.starts[k]
+                    counts = self.starts[k + 1] - begin
+                    total = counts.sum()
+                    if not total:
+                        continue
+
+                    # Expands the per query point [begin, begin + count) ranges
+                    i = np.repeat(query, counts)
+                    pos = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(begin, counts)
+                    j = self.order[pos]
+
+                    close = ((self.xyz[j] - points[i]) ** 2).sum(axis=1) <= cutoff2
+                    ii.append(i[close])
+                    jj.append(j[close])
+
+        if not ii:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        return np.concatenate(ii), np.concatenate(jj)
+
+    def within(self, points, cutoff):
+        """
+        Returns a boolean array marking the indexed points which are
+        within the cutoff distance from any of the query points
+        """
+        selected = np.zeros(len(self.xyz), dtype=bool)
+        selected[self.pairs(points, cutoff)[1]] = True
+        return selected
+
+
+def coords_by_idx(molecule):
+    """
+    Returns the (GetMaxAtomIdx(), 3) coordinate array of the
+    passed OEMol indexed by atom index
+    """
+    coords = oechem.OEFloatArray(3 * molecule.GetMaxAtomIdx())
+    molecule.GetCoords(coords)
+    return np.fromiter(coords, dtype=np.float64, count=3 * molecule.GetMaxAtomIdx()).reshape(-1, 3)
+
+
+def atom_coords(molecule):
+    """
+    Returns the atom indexes and the (N, 3) coordinate array
+    of the atoms of the passed OEMol
+    """
+    atoms = np.array([at.GetIdx() for at in molecule.GetAtoms()], dtype=np.int64)
+    return atoms, coords_by_idx(molecule)[atoms]
+
+
+def residue_index(molecule):
+    """
+    Returns the array of residue numbers of the passed OEMol indexed by
+    atom index. The residues are numbered in order of appearance and the
+    indexes which do not correspond to an atom are set to -1
+    """
+    residues = np.full(molecule.GetMaxAtomIdx(), -1, dtype=np.int64)
+    numbers = {}
+    for at in molecule.GetAtoms():
+        res = oechem.OEAtomGetResidue(at)
+        key = (res.GetChainID(), res.GetResidueNumber(), res.GetName(), res.GetInsertCode(), res.GetFragmentNumber())
+        residues[at.GetIdx()] = numbers.setdefault(key, len(numbers))
+
+    return residues
@@ -0,0 +1,173 @@
+import os
+import shutil
+import hashlib
+import tempfile
+
+# Environment variable used to select the default store location
+STORE_ENV = 'OPENMM_ORION_STORE'
+
+
+def default_store_path():
+    """
+    Returns the default local store directory. The location can be
+    overridden by setting the OPENMM_ORION_STORE environment variable
+    """
+    return os.environ.get(STORE_ENV, os.path.join(tempfile.gettempdir(), 'openmm_orion_store'))
+
+
+def digest(data):
+    """
+    Returns the SHA1 hex digest of the passed bytes
+    """
+    return hashlib.sha1(data).hexdigest()
+
+
+def file_digest(fname, chunk_size=1 << 24):
+    """
+    Returns the SHA1 hex digest of the passed file content
+    """
+    sha1 = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class ContentStore(object):
+    """
+    Local content-addressed store. Each object is saved in a file
+    named after its key, by default the SHA1 digest of its content.
+    Objects are immutable: storing an existing key is a no-op
+
+    Examples
+    --------
+        store = ContentStore('/scratch/store')
+        key = store.put(data)
+        data = store.get(key)
+    """
+
+    def __init__(self, path=None):
+        """
+        Initialization function
+
+        Parameters
+        ----------
+        path : str or None
+            The store directory. If None the default store path is used
+        """
+        if not path:
+            path = default_store_path()
+        self.path = os.path.abspath(path)
+        os.makedirs(self.path, exist_ok=True)
+
+    def _fname(self, key):
+        return os.path.join(self.path, key)
+
+    def __contains__(self, key):
+        return os.path.isfile(self._fname(key))
+
+    def put(self, data, key=None):
+        """
+        This method saves the passed bytes in the store
+
+        Parameters
+        ----------
+        data : bytes
+            The object to store
+        key : str or None
+            The key used to save the object. If None the content digest is used
+
+        Returns
+        -------
+        key : str
+            The object key
+        """
+        if key is None:
+            key = digest(data)
+
+        if key not in self:
+            # Write to a temporary file first, parallel workers
+            # must never read a partially written object
+            fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp-')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self._fname(key))
+
+        return key
+
+    def get(self, key):
+        """
+        This method retrieves an object from the store
+
+        Parameters
+        ----------
+        key : str
+            The object key
+
+        Returns
+        -------
+        data : bytes
+            The stored object
+        """
+        try:
+            with open(self._fname(key), 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            raise KeyError('The object {} is not present in the store {}'.format(key, self.path))
+
+    def put_file(self, fname, key=None):
+        """
+        This method copies the passed file in the store without
+        reading it in memory
+
+        Parameters
+        ----------
+        fname : str
+            The file name
+        key : str or None
+            The key used to save the file. If None the content digest is used
+
+        Returns
+        -------
+        key : str
+            The object key
+        """
+        if key is None:
+            key = file_digest(fname)
+
+        if key not in self:
+            fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp-')
+            with os.fdopen(fd, 'wb') as out, open(fname, 'rb') as f:
+                shutil.copyfileobj(f, out)
+            os.replace(tmp, self._fname(key))
+
+        return key
+
+    def get_file(self, key, fname):
+        """
+        This method copies a stored object to the passed file name
+
+        Parameters
+        ----------
+        key : str
+            The object key
+        fname : str
+            The file name
+        """
+        if key not in self:
+            raise KeyError('The object {} is not present in the store {}'.format(key, self.path))
+        shutil.copyfile(self._fname(key), fname)
+
+    def remove(self, key):
+        """
+        This method removes an object from the store, if present
+
+        Parameters
+        ----------
+        key : str
+            The object key
+        """
+        try:
+            os.remove(self._fname(key))
+        except (IOError, OSError):
+            pass
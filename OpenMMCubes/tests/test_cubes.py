@@ -1,9 +1,19 @@
+import os
+import json
+import types
+import logging
+import struct
+import tempfile
 import unittest
 import pytest
+import numpy as np
+import mdtraj
 from floe.test import CubeTestRunner
 from openeye import oechem
 import OpenMMCubes.utils as utils
-from OpenMMCubes.cubes import OpenMMminimizeCube, OpenMMnvtCube, OpenMMnptCube
+import OpenMMCubes.simtools as simtools
+import OpenMMCubes.store as store
+from OpenMMCubes.cubes import OpenMMminimizeCube, OpenMMnvtCube, OpenMMnptCube, OpenMMprotocolCube
 from simtk import unit, openmm
 from simtk.openmm import app
 
@@ -78,11 +88,27 @@ class MinimizationCubeTester(unittest.TestCase):
 
         self.assertLess(eng_f, eng_i)
 
+        return outmol
+
     @pytest.mark.slow
     def test_success(self):
         self.cube.args.steps = 100000
         self._test_success()
 
+    def test_staged(self):
+        self.cube.args.steps = 500
+        self.cube.args.restraints = 'noh protein'
+        self.cube.args.restraint_release = '1.0, 0.0'
+        outmol = self._test_success()
+
+        for n in range(2):
+            self.assertTrue(oechem.OEHasSDData(outmol, 'Minimization_stage{}_energy'.format(n)))
+            self.assertEqual(int(oechem.OEGetSDData(outmol, 'Minimization_stage{}_max_iterations'.format(n))), 500)
+            # Each stage does not raise the energy it starts from
+            self.assertLessEqual(float(oechem.OEGetSDData(outmol, 'Minimization_stage{}_energy'.format(n))),
+                                 float(oechem.OEGetSDData(outmol, 'Minimization_stage{}_initial_energy'.format(n))))
+        self.assertEqual(float(oechem.OEGetSDData(outmol, 'Minimization_stage1_restraintWt')), 0.0)
+
     def test_failure(self):
         pass
 
@@ -199,6 +225,37 @@ class NVTCubeTester(unittest.TestCase):
         self.cube.args.time = 50.0  # in picoseconds
         self._test_success()
 
+    @pytest.mark.slow
+    def test_checkpoint(self):
+        with tempfile.TemporaryDirectory() as chk_dir:
+            self.cube.args.time = 2.0  # in picoseconds
+            self.cube.args.checkpoint_interval = 250
+            self.cube.args.checkpoint_dir = chk_dir
+            self.cube.begin()
+            self._test_success()
+            # The checkpoint is removed at the end of a completed run
+            self.assertEqual(os.listdir(chk_dir), [])
+
+    def test_context_cache(self):
+        complex_fname = utils.get_data_filename('examples', 'data/pP38_lp38a_2x_complex.oeb.gz')
+
+        self.cube.args.time = 0.1  # in picoseconds
+        self.cube.args.context_cache = True
+        self.cube.begin()
+
+        hits = simtools._SIMULATION_CACHE_STATS['hits']
+
+        # Two copies of the same system: the second one reuses the Context
+        for i in range(2):
+            mol = oechem.OEMol()
+            with oechem.oemolistream(complex_fname) as ifs:
+                oechem.OEReadMolecule(ifs, mol)
+            utils.PackageOEMol.pack(mol, utils.MDData(mol).structure)
+            self.cube.process(mol, self.cube.intake.name)
+
+        self.assertEqual(self.runner.outputs['success'].qsize(), 2)
+        self.assertEqual(simtools._SIMULATION_CACHE_STATS['hits'], hits + 1)
+
     def test_failure(self):
         pass
 
@@ -320,6 +377,110 @@ class NPTCubeTester(unittest.TestCase):
         self.cube.args.time = 50.0  # in picoseconds
         self._test_success()
 
+    @pytest.mark.slow
+    def test_segments(self):
+        self.cube.args.time = 2.0  # in picoseconds
+        self.cube.args.segments = 2
+        self.cube.args.segment_store = tempfile.mkdtemp()
+        self.cube.args.reporter_interval = 100
+        self.cube.args.trajectory_interval = 100
+        self.cube.begin()
+
+        complex_fname = utils.get_data_filename('examples', 'data/pP38_lp38a_2x_complex.oeb.gz')
+        mol = oechem.OEMol()
+        with oechem.oemolistream(complex_fname) as ifs:
+            oechem.OEReadMolecule(ifs, mol)
+
+        # The first segment is re-queued
+        self.cube.process(mol, self.cube.intake.name)
+        self.assertEqual(self.runner.outputs['segment'].qsize(), 1)
+        self.assertEqual(self.runner.outputs['success'].qsize(), 0)
+
+        # The segment output files are saved in the segment store and only their
+        # references travel with the molecule. Nothing is left on the local disk
+        segmol = self.runner.outputs['segment'].get()
+        seg_files = utils.PackageOEMol.getSegmentFiles(segmol)
+        self.assertTrue(any(fn.endswith('.dcd') for fn in seg_files))
+        content_store = store.ContentStore(self.cube.args.segment_store)
+        for fn, key in seg_files.items():
+            self.assertFalse(os.path.isfile(fn))
+            self.assertIn(key, content_store)
+
+        # The last segment is emitted on the success port with the merged files
+        self.cube.process(segmol, self.cube.intake.name)
+        self.assertEqual(self.runner.outputs['segment'].qsize(), 0)
+        self.assertEqual(self.runner.outputs['success'].qsize(), 1)
+        self.assertEqual(self.runner.outputs['failure'].qsize(), 0)
+
+        outmol = self.runner.outputs['success'].get()
+        self.assertFalse(outmol.HasData(oechem.OEGetTag('MDSegment')))
+        self.assertFalse(outmol.HasData(oechem.OEGetTag(utils.PackageOEMol.SEGMENT_FILES_TAG)))
+        # The merged segment files are removed from the store
+        for key in seg_files.values():
+            self.assertNotIn(key, content_store)
+        trj_fname = outmol.GetData(oechem.OEGetTag('Trj_fname'))
+        self.assertTrue(os.path.isfile(trj_fname))
+
+        # The energies of the two segments are concatenated
+        energies = utils.PackageOEMol.getEnergies(outmol)
+        # Recorded at the steps 100..500 of the first segment and 600..1000 of the second one
+        self.assertEqual(len(energies['step']), 10)
+        self.assertTrue(np.all(np.diff(energies['step']) == 100))
+        self.assertTrue(np.all(energies['temperature'] > 0.0))
+
+    def test_failure(self):
+        pass
+
+    def tearDown(self):
+        self.runner.finalize()
+
+class ProtocolCubeTester(unittest.TestCase):
+    """
+    Test the OpenMM multi-stage protocol cube
+    Example inputs from `openmm_orion/examples/data`
+    """
+
+    def setUp(self):
+        self.cube = OpenMMprotocolCube('protocol')
+        self.runner = CubeTestRunner(self.cube)
+        self.runner.start()
+
+    def _test_success(self):
+        print('Testing cube:', self.cube.name)
+        # Complex file name
+        complex_fname = utils.get_data_filename('examples', 'data/pbace_lcat13a_complex.oeb.gz')
+
+        # Read OEMol molecule
+        mol = oechem.OEMol()
+        with oechem.oemolistream(complex_fname) as ifs:
+            oechem.OEReadMolecule(ifs, mol)
+
+        # Process the molecules
+        self.cube.process(mol, self.cube.intake.name)
+        # Assert that one molecule was emitted on the success port
+        self.assertEqual(self.runner.outputs['success'].qsize(), 1)
+        # Assert that zero molecules were emitted on the failure port
+        self.assertEqual(self.runner.outputs['failure'].qsize(), 0)
+        # Assert that the intermediate stages have been emitted
+        self.assertEqual(self.runner.outputs['minimization'].qsize(), 1)
+        self.assertEqual(self.runner.outputs['equilibration'].qsize(), 1)
+
+        outmol = self.runner.outputs["success"].get()
+        self.assertIsNotNone(utils.MDData(outmol).velocities)
+
+    @pytest.mark.slow
+    def test_success(self):
+        self.cube.args.stages = json.dumps([
+            {"name": "min", "type": "min", "steps": 100,
+             "restraints": "noh (ligand or protein)", "restraintWt": 5.0, "emit": "minimization"},
+            {"name": "warmup", "type": "nvt", "time": 1.0,
+             "restraints": "noh (ligand or protein)", "restraintWt": 2.0},
+            {"name": "equil", "type": "npt", "time": 1.0,
+             "restraints": "ca_protein or (noh ligand)", "restraintWt": 0.1, "emit": "equilibration"},
+            {"name": "prod", "type": "npt", "time": 1.0}])
+        self.cube.begin()
+        self._test_success()
+
     def test_failure(self):
         pass
 
@@ -327,5 +488,186 @@ class NPTCubeTester(unittest.TestCase):
         self.runner.finalize()
 
 
+class CheckpointTester(unittest.TestCase):
+    """
+    Test the checkpoint validation and the output truncation of a resumed simulation
+    """
+
+    def test_checkpoint_key(self):
+        system = openmm.System()
+        system.addParticle(1.0)
+        integrator = openmm.VerletIntegrator(0.001)
+        context = openmm.Context(system, integrator, openmm.Platform.getPlatformByName('Reference'))
+        context.setPositions([(0.0, 0.0, 0.0)] * unit.nanometers)
+        state = context.getState(getPositions=True, getVelocities=True, getEnergy=True)
+
+        opt = {'Logger': logging.getLogger(__name__), 'steps': 1000,
+               'trajectory_interval': 0, 'reporter_interval': 0}
+
+        with tempfile.TemporaryDirectory() as path:
+            fname = os.path.join(path, 'prod.chk')
+            reporter = simtools.CheckpointReporter(fname, 100, key='a')
+            reporter.report(types.SimpleNamespace(reporters=[], currentStep=500), state)
+
+            self.assertEqual(simtools.loadCheckpoint(fname, key='a', **opt)[1], 500)
+            # A stale checkpoint of a different system or settings is not resumed
+            self.assertIsNone(simtools.loadCheckpoint(fname, key='b', **opt))
+
+    def test_truncate_segment_dcd(self):
+        topology = app.Topology()
+        residue = topology.addResidue('HOH', topology.addChain())
+        for name in ['O', 'H1', 'H2']:
+            topology.addAtom(name, app.element.get_by_symbol(name[0]), residue)
+        positions = np.random.random((3, 3)) * unit.nanometers
+
+        # Second production segment: the frames are written from step 1000 on
+        first_step, interval = 1000, 100
+
+        with tempfile.TemporaryDirectory() as path:
+            fname = os.path.join(path, 'prod_seg1.dcd')
+            with open(fname, 'wb') as f:
+                dcd = app.DCDFile(f, topology, 0.002 * unit.picoseconds, firstStep=first_step, interval=interval)
+                for i in range(10):
+                    dcd.writeModel(positions)
+                    if i == 4:
+                        # Checkpoint at step 1500
+                        f.flush()
+                        offset = os.path.getsize(fname)
+
+            # The simulation is resumed from the checkpoint
+            simtools._truncate_outputs({fname: offset}, first_step + 5 * interval, first_step=first_step,
+                                       trajectory_interval=interval)
+
+            trj = mdtraj.load_dcd(fname, top=mdtraj.Topology.from_openmm(topology))
+            self.assertEqual(trj.n_frames, 5)
+            with open(fname, 'rb') as f:
+                f.seek(8)
+                self.assertEqual(struct.unpack('<i', f.read(4))[0], 5)
+
+
+class TrajectorySubsetTester(unittest.TestCase):
+    """
+    Test the topology files of an atom subset trajectory
+    """
+
+    def test_subset_pdb(self):
+        complex_fname = utils.get_data_filename('examples', 'data/pP38_lp38a_2x_complex.oeb.gz')
+        mol = oechem.OEMol()
+        with oechem.oemolistream(complex_fname) as ifs:
+            oechem.OEReadMolecule(ifs, mol)
+        structure = utils.MDData(mol).structure
+
+        with tempfile.TemporaryDirectory() as path:
+            opt = {'trajectory_subset': 'ligand or protein', 'molecule': mol,
+                   'outfname': os.path.join(path, 'prod')}
+
+            atom_indices, sub_topology = simtools._trajectory_subset(structure.topology, **opt)
+            simtools._save_topology_pdb(structure, **opt)
+
+            elements = [structure.atoms[idx].element for idx in atom_indices]
+
+            # The subset pdb files hold the trajectory atoms in the trajectory order
+            pdb = app.PDBFile(opt['outfname'] + '.pdb')
+            self.assertEqual([at.element.atomic_number for at in pdb.topology.atoms()], elements)
+
+            submol = oechem.OEMol()
+            with oechem.oemolistream(opt['outfname'] + '_ordering_test.pdb') as ifs:
+                oechem.OEReadMolecule(ifs, submol)
+            self.assertEqual([at.GetAtomicNum() for at in submol.GetAtoms()], elements)
+
+
+class SystemCacheTester(unittest.TestCase):
+    """
+    Test the serialized OpenMM System cache attached to the OEMols
+    """
+
+    def test_cache(self):
+        complex_fname = utils.get_data_filename('examples', 'data/pbace_lcat13a_complex.oeb.gz')
+
+        mol = oechem.OEMol()
+        with oechem.oemolistream(complex_fname) as ifs:
+            oechem.OEReadMolecule(ifs, mol)
+
+        structure = utils.MDData(mol).structure
+        utils.PackageOEMol.pack(mol, structure)
+
+        system = utils.create_system(structure, molecule=mol)
+        self.assertTrue(mol.HasData(oechem.OEGetTag(utils.PackageOEMol.SYSTEM_TAG)))
+
+        key = utils.system_key(utils.PackageOEMol.getTopologyHash(mol),
+                               nonbondedMethod='PME', nonbondedCutoff=10.0, constraints='HBonds',
+                               hydrogenMass=None, rigidWater=True)
+        self.assertIsNotNone(utils.PackageOEMol.getSystem(mol, key))
+
+        cached = utils.create_system(structure, molecule=mol)
+        self.assertEqual(openmm.XmlSerializer.serialize(system), openmm.XmlSerializer.serialize(cached))
+
+        # Different settings must not hit the cache
+        key = utils.system_key(utils.PackageOEMol.getTopologyHash(mol),
+                               nonbondedMethod='PME', nonbondedCutoff=9.0, constraints='HBonds',
+                               hydrogenMass=None, rigidWater=True)
+        self.assertIsNone(utils.PackageOEMol.getSystem(mol, key))
+
+
+class CoordinateSyncTester(unittest.TestCase):
+    """
+    Test the array based coordinate transfer between the ParmEd Structure and the OEMol
+    """
+
+    def test_roundtrip(self):
+        complex_fname = utils.get_data_filename('examples', 'data/pbace_lcat13a_complex.oeb.gz')
+
+        mol = oechem.OEMol()
+        with oechem.oemolistream(complex_fname) as ifs:
+            oechem.OEReadMolecule(ifs, mol)
+
+        structure = utils.MDData(mol).structure
+        utils.PackageOEMol.pack(mol, structure)
+
+        xyz = utils.get_oemol_coords(mol)
+        self.assertEqual(xyz.shape, (mol.NumAtoms(), 3))
+        self.assertTrue(np.allclose(xyz, structure.coordinates, atol=1e-3))
+
+        shifted = structure.coordinates + 1.5
+        utils.set_oemol_coords(mol, shifted)
+        self.assertTrue(np.allclose(utils.get_oemol_coords(mol), shifted, atol=1e-3))
+
+        self.assertRaises(ValueError, utils.set_oemol_coords, mol, shifted[:-1])
+
+
+class PackSimulationTester(unittest.TestCase):
+    """
+    Test the Structure attached from an OpenMM Simulation
+    """
+
+    def test_roundtrip(self):
+        complex_fname = utils.get_data_filename('examples', 'data/pbace_lcat13a_complex.oeb.gz')
+
+        mol = oechem.OEMol()
+        with oechem.oemolistream(complex_fname) as ifs:
+            oechem.OEReadMolecule(ifs, mol)
+
+        # The molecule carries the split topology and coordinates
+        structure = utils.MDData(mol).structure
+        utils.PackageOEMol.pack(mol, structure)
+        self.assertTrue(mol.HasData(oechem.OEGetTag(utils.PackageOEMol.COORDS_TAG)))
+
+        system = structure.createSystem(nonbondedMethod=app.NoCutoff)
+        integrator = openmm.VerletIntegrator(0.001 * unit.picoseconds)
+        simulation = app.Simulation(structure.topology, system, integrator,
+                                    openmm.Platform.getPlatformByName('Reference'))
+        shifted = structure.coordinates + 1.5
+        simulation.context.setPositions(shifted * unit.angstroms)
+
+        utils.PackageOEMol.pack(mol, simulation)
+        for tag in utils.PackageOEMol.SPLIT_TAGS:
+            self.assertFalse(mol.HasData(oechem.OEGetTag(tag)))
+
+        # The Simulation coordinates are returned, not the stale split ones
+        packed = utils.PackageOEMol.getStructure(mol)
+        self.assertEqual(len(packed.atoms), len(structure.atoms))
+        self.assertTrue(np.allclose(packed.coordinates, shifted, atol=1e-4))
+
+
 if __name__ == "__main__":
         unittest.main()
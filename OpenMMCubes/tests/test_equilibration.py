@@ -0,0 +1,38 @@
+import unittest
+import numpy as np
+from OpenMMCubes import equilibration
+
+
+class EquilibrationTester(unittest.TestCase):
+    """
+    Test the equilibration detection on synthetic time series
+    """
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        # Exponential relaxation followed by stationary noise
+        self.relaxing = 10.0 * np.exp(-np.arange(400) / 20.0) + rng.normal(size=400)
+        # Steady drift: never equilibrated
+        self.drifting = np.linspace(0.0, 50.0, 400) + rng.normal(size=400)
+
+    def test_detect_equilibration(self):
+        t0, g, neff = equilibration.detect_equilibration(self.relaxing)
+        self.assertTrue(20 < t0 < 200)
+        self.assertGreaterEqual(g, 1.0)
+        self.assertGreater(neff, 0.0)
+
+    def test_equilibrated(self):
+        table = {'step': np.arange(400), 'density': self.relaxing,
+                 'volume': self.relaxing, 'potential': self.relaxing}
+        self.assertIsNotNone(equilibration.equilibrated(table))
+
+        table['potential'] = self.drifting
+        self.assertIsNone(equilibration.equilibrated(table))
+
+        # Too few samples
+        short = dict((name, values[:10]) for name, values in table.items())
+        self.assertIsNone(equilibration.equilibrated(short))
+
+
+if __name__ == "__main__":
+        unittest.main()
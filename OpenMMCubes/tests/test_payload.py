@@ -0,0 +1,98 @@
+import os
+import unittest
+import base64
+import pickle
+import tempfile
+import numpy as np
+from OpenMMCubes import payload, store, compression
+
+
+class PayloadTester(unittest.TestCase):
+    """
+    Test the binary payload format used to attach MD data to the OEMols
+    """
+
+    def test_roundtrip(self):
+        coords = np.random.random((3, 100, 3))
+        box = np.array([50.0, 50.0, 50.0, 90.0, 90.0, 90.0])
+        blob = b'\x00parameters\xff'
+
+        data = payload.encode([('structure', blob), ('coordinates', coords), ('box', box), ('velocities', None)])
+
+        self.assertTrue(payload.is_payload(data))
+
+        blocks = payload.decode(data)
+
+        self.assertEqual(list(blocks.keys()), ['structure', 'coordinates', 'box'])
+        self.assertEqual(blocks['structure'], blob)
+        self.assertTrue(np.array_equal(blocks['coordinates'], coords))
+        self.assertEqual(blocks['coordinates'].shape, (3, 100, 3))
+        self.assertTrue(np.array_equal(blocks['box'], box))
+
+    def test_dtype_preserved(self):
+        data = payload.encode({'pos': np.arange(12, dtype=np.float32).reshape(4, 3)})
+        pos = payload.decode(data)['pos']
+        self.assertEqual(pos.dtype, np.float32)
+        self.assertEqual(pos.shape, (4, 3))
+
+    def test_codecs(self):
+        coords = np.random.random((1000, 3))
+        for spec in compression.CODEC_NAMES + ['gzip:9']:
+            data = payload.encode([('coordinates', coords)], codec=spec)
+            self.assertTrue(payload.is_payload(data))
+            self.assertEqual(payload.get_codec(data).name, compression.get_codec(spec).name)
+            self.assertTrue(np.array_equal(payload.decode(data)['coordinates'], coords))
+
+    def test_codec_fallback(self):
+        for cls in compression.CODECS:
+            codec = compression.get_codec(cls.name)
+            if cls.available():
+                self.assertEqual(codec.name, cls.name)
+            else:
+                self.assertEqual(codec.name, compression.GzipCodec.name)
+        self.assertRaises(ValueError, compression.get_codec, 'unknown')
+
+    def test_legacy_detection(self):
+        legacy = base64.b64encode(pickle.dumps({'a': 1}))
+        self.assertFalse(payload.is_payload(legacy))
+        self.assertRaises(ValueError, payload.decode, legacy)
+
+
+class ContentStoreTester(unittest.TestCase):
+    """
+    Test the local content-addressed store
+    """
+
+    def test_put_get(self):
+        with tempfile.TemporaryDirectory() as path:
+            cs = store.ContentStore(path)
+            key = cs.put(b'topology')
+            self.assertEqual(key, store.digest(b'topology'))
+            self.assertIn(key, cs)
+            self.assertEqual(cs.get(key), b'topology')
+            # Storing the same content twice returns the same key
+            self.assertEqual(cs.put(b'topology'), key)
+            self.assertRaises(KeyError, cs.get, store.digest(b'missing'))
+
+    def test_files(self):
+        with tempfile.TemporaryDirectory() as path:
+            cs = store.ContentStore(os.path.join(path, 'store'))
+            fname = os.path.join(path, 'segment.dcd')
+            with open(fname, 'wb') as f:
+                f.write(b'trajectory')
+
+            key = cs.put_file(fname)
+            self.assertEqual(key, store.digest(b'trajectory'))
+            self.assertEqual(cs.get(key), b'trajectory')
+
+            cs.get_file(key, fname + '.copy')
+            with open(fname + '.copy', 'rb') as f:
+                self.assertEqual(f.read(), b'trajectory')
+
+            cs.remove(key)
+            self.assertNotIn(key, cs)
+            self.assertRaises(KeyError, cs.get_file, key, fname)
+
+
+if __name__ == "__main__":
+        unittest.main()
@@ -0,0 +1,91 @@
+import os
+import unittest
+import tempfile
+from unittest import mock
+from simtk import openmm, unit
+from OpenMMCubes import platforms
+from PlatformTestCubes.testInstallation import median_force_error
+
+
+class PlatformsTester(unittest.TestCase):
+    """
+    Test the host platform configuration helpers
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.env = os.environ.get('OPENMM_CUBES_CACHE')
+        os.environ['OPENMM_CUBES_CACHE'] = self.tmp.name
+
+    def tearDown(self):
+        if self.env is None:
+            del os.environ['OPENMM_CUBES_CACHE']
+        else:
+            os.environ['OPENMM_CUBES_CACHE'] = self.env
+        self.tmp.cleanup()
+
+    def test_atom_bucket(self):
+        self.assertEqual(platforms.atom_bucket(1), 1)
+        self.assertEqual(platforms.atom_bucket(3000), 4096)
+        self.assertEqual(platforms.atom_bucket(4096), 4096)
+
+    def test_host_data(self):
+        self.assertEqual(platforms.load_host_data('test.json'), {})
+        platforms.save_host_data('test.json', 'a', {'threads': 4})
+        platforms.save_host_data('test.json', 'b', {'threads': 2})
+        self.assertEqual(platforms.load_host_data('test.json'), {'a': {'threads': 4}, 'b': {'threads': 2}})
+
+    def test_cpu_threads(self):
+        ncpus = len(platforms.available_cpus())
+        self.assertEqual(platforms.cpu_threads(cpu_threads=3), 3)
+        self.assertEqual(platforms.cpu_threads(cpu_workers=1), ncpus)
+        self.assertEqual(platforms.cpu_threads(cpu_workers=2 * ncpus), 1)
+
+    def test_select_platform(self):
+        system = openmm.System()
+        force = openmm.NonbondedForce()
+        for i in range(10):
+            system.addParticle(1.0)
+            force.addParticle(0.0, 0.3, 0.5)
+        system.addForce(force)
+
+        self.assertEqual(platforms.nonbonded_method(system), 'NoCutoff')
+
+        # Faster but not validated entries are never selected
+        platforms.save_host_data(platforms.BENCHMARK_FNAME, platforms.benchmark_key(system),
+                                 {'CPU': {'ns_per_day': 10.0, 'force_error': 1e-6, 'valid': True},
+                                  'CUDA:single': {'ns_per_day': 100.0, 'force_error': 0.1, 'valid': False}})
+
+        name, properties = platforms.select_platform(system, cpu_threads=2)
+        self.assertEqual(name, 'CPU')
+        self.assertEqual(properties, {'Threads': '2'})
+
+        self.assertLess(median_force_error([(1.0, 0.0, 0.0)] * 3, [(1.0, 0.0, 0.0)] * 3), 1e-12)
+
+    def test_select_platform_benchmark(self):
+        system = openmm.System()
+        force = openmm.NonbondedForce()
+        for i in range(10):
+            system.addParticle(1.0)
+            force.addParticle(0.0, 0.3, 0.5)
+        system.addForce(force)
+        positions = [(0.5 * i, 0.0, 0.0) for i in range(10)] * unit.nanometers
+
+        calls = []
+
+        def ns_per_day(system, positions, box, properties, platform_name='CPU', steps=0):
+            calls.append(steps)
+            return 1.0
+
+        # The cube steps option, e.g. the minimization steps, must not change the quick benchmark length
+        with mock.patch.object(platforms, '_ns_per_day', side_effect=ns_per_day):
+            name, properties = platforms.select_platform(system, positions=positions, steps=0, cpu_threads=1)
+
+        self.assertTrue(calls)
+        self.assertTrue(all(steps == platforms.CALIBRATION_STEPS for steps in calls))
+        available = [openmm.Platform.getPlatform(i).getName() for i in range(openmm.Platform.getNumPlatforms())]
+        self.assertIn(name, available)
+
+
+if __name__ == "__main__":
+        unittest.main()
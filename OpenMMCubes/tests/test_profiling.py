@@ -0,0 +1,59 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from openeye import oechem
+from OpenMMCubes import profiling
+
+
+class ProfilerTester(unittest.TestCase):
+    """
+    Test the per item timing records
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.tmpdir, 'timings.jsonl')
+        self.profile_dir = os.path.join(self.tmpdir, 'profiles')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_record(self):
+        profiler = profiling.Profiler('cube', log_file=self.log_file, profile_dir='')
+        mol = oechem.OEMol()
+
+        profiler.start('item')
+        with profiler.phase('decode'):
+            pass
+        # The module level phase records in the active profiler
+        with profiling.phase('step'):
+            sum(range(1000))
+        record = profiler.finish(mol)
+
+        self.assertEqual(list(record['phases'].keys()), ['decode', 'step'])
+        self.assertTrue(oechem.OEHasSDData(mol, profiling.PROFILE_TAG.format('cube')))
+
+        with open(self.log_file) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(lines[0]['item'], 'item')
+
+        # Nothing is recorded without an active profiler
+        with profiling.phase('step'):
+            pass
+        self.assertIsNone(profiler.finish())
+
+    def test_slowest(self):
+        profiler = profiling.Profiler('cube', log_file='', profile_dir=self.profile_dir, slowest=2)
+
+        for idx in range(4):
+            profiler.start('item{}'.format(idx))
+            profiler.finish()
+
+        self.assertEqual(len(os.listdir(self.profile_dir)), 2)
+
+
+if __name__ == "__main__":
+        unittest.main()
@@ -0,0 +1,108 @@
+import os
+import io
+import unittest
+import tempfile
+import numpy as np
+from simtk import openmm, unit
+from simtk.openmm import app
+from OpenMMCubes import reporters
+
+
+class QTRJTester(unittest.TestCase):
+    """
+    Test the lossy quantized trajectory format
+    """
+
+    def setUp(self):
+        self.xyz = np.random.random((5, 200, 3)) * 5.0
+        self.box = np.diag([5.0, 5.0, 5.0])
+
+    def test_roundtrip(self):
+        with tempfile.TemporaryDirectory() as path:
+            fname = os.path.join(path, 'trj.qtrj')
+            writer = reporters.QTRJWriter(fname, 200, precision=0.001)
+            for idx, frame in enumerate(self.xyz):
+                writer.write(idx * 1000, idx * 2.0, frame, self.box)
+            writer.close()
+
+            xyz, box, steps, times = reporters.read_qtrj(fname)
+
+            self.assertEqual(xyz.shape, (5, 200, 3))
+            self.assertLessEqual(np.abs(xyz - self.xyz).max(), 0.0005 + 1e-6)
+            self.assertTrue(np.allclose(box[0], self.box))
+            self.assertEqual(list(steps), [0, 1000, 2000, 3000, 4000])
+            # The lossy format must be smaller than the raw single precision coordinates
+            self.assertLess(os.path.getsize(fname), self.xyz.astype(np.float32).nbytes)
+
+    def test_append(self):
+        with tempfile.TemporaryDirectory() as path:
+            fname = os.path.join(path, 'trj.qtrj')
+            writer = reporters.QTRJWriter(fname, 200, precision=0.01)
+            writer.write(0, 0.0, self.xyz[0])
+            writer.close()
+
+            # The precision is taken from the existing file
+            writer = reporters.QTRJWriter(fname, 200, precision=0.001, append=True)
+            writer.write(1, 1.0, self.xyz[1])
+            writer.close()
+
+            xyz, box, steps, times = reporters.read_qtrj(fname)
+            self.assertEqual(xyz.shape, (2, 200, 3))
+            self.assertIsNone(box)
+            self.assertLessEqual(np.abs(xyz - self.xyz[:2]).max(), 0.005 + 1e-6)
+
+
+class EnergyReporterTester(unittest.TestCase):
+    """
+    Test the in-memory energy reporter
+    """
+
+    def setUp(self):
+        # 216 water-like Lennard-Jones particles in a 1.862 nm box: about 1 g/mL
+        self.nparticles = 216
+        self.mass = 18.015
+        self.side = 1.862
+
+        system = openmm.System()
+        nonbonded = openmm.NonbondedForce()
+        nonbonded.setNonbondedMethod(openmm.NonbondedForce.CutoffPeriodic)
+        nonbonded.setCutoffDistance(0.8 * unit.nanometers)
+        for i in range(self.nparticles):
+            system.addParticle(self.mass * unit.dalton)
+            nonbonded.addParticle(0.0, 0.315, 0.636)
+        system.addForce(nonbonded)
+        system.setDefaultPeriodicBoxVectors(*np.diag([self.side] * 3) * unit.nanometers)
+
+        topology = app.Topology()
+        chain = topology.addChain()
+        for i in range(self.nparticles):
+            topology.addAtom('O', app.element.oxygen, topology.addResidue('HOH', chain))
+
+        grid = (np.indices((6, 6, 6)).reshape(3, -1).T + 0.5) * self.side / 6.0
+        integrator = openmm.LangevinIntegrator(300 * unit.kelvin, 1 / unit.picoseconds, 0.002 * unit.picoseconds)
+        self.simulation = app.Simulation(topology, system, integrator, openmm.Platform.getPlatformByName('Reference'))
+        self.simulation.context.setPositions(grid * unit.nanometers)
+        self.simulation.context.setVelocitiesToTemperature(300 * unit.kelvin)
+
+    def test_density(self):
+        reporter = reporters.EnergyReporter(5, totalSteps=20)
+        log = io.StringIO()
+        self.simulation.reporters.append(reporter)
+        self.simulation.reporters.append(app.StateDataReporter(log, 5, step=True, volume=True, density=True))
+        self.simulation.step(20)
+
+        table = reporter.table()
+        self.assertEqual(len(table['step']), 4)
+
+        # Hand computed density of the box in g/mL
+        expected = self.nparticles * self.mass / (6.02214076e23 * (self.side * 1e-7)**3)
+        self.assertTrue(np.allclose(table['density'], expected, rtol=1e-6))
+        self.assertTrue(np.allclose(table['volume'], self.side**3, rtol=1e-6))
+
+        # Same density of the OpenMM StateDataReporter
+        rows = [line.split(',') for line in log.getvalue().splitlines() if not line.startswith('#')]
+        self.assertTrue(np.allclose(table['density'], [float(row[2]) for row in rows], rtol=1e-4))
+
+
+if __name__ == "__main__":
+        unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+import numpy as np
+from openeye import oechem
+from OpenMMCubes.spatial import CellGrid, atom_coords, coords_by_idx, residue_index
+
+
+class CellGridTester(unittest.TestCase):
+    """
+    Test the cell grid spatial index against the brute force distances
+    """
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.xyz = rng.random_sample((3000, 3)) * 50.0
+        self.points = rng.random_sample((100, 3)) * 50.0
+
+    def test_pairs(self):
+        dist2 = ((self.points[:, np.newaxis] - self.xyz[np.newaxis]) ** 2).sum(axis=-1)
+        for cutoff, cell_size in [(5.0, 5.0), (3.0, 5.0), (6.0, 2.0)]:
+            grid = CellGrid(self.xyz, cell_size)
+            i, j = grid.pairs(self.points, cutoff)
+            expected = set(zip(*np.nonzero(dist2 <= cutoff ** 2)))
+            self.assertEqual(set(zip(i.tolist(), j.tolist())), expected)
+            self.assertTrue(np.array_equal(grid.within(self.points, cutoff), (dist2 <= cutoff ** 2).any(axis=0)))
+
+    def test_empty(self):
+        grid = CellGrid(np.empty((0, 3)), 3.0)
+        i, j = grid.pairs(self.points, 3.0)
+        self.assertEqual(len(i), 0)
+        self.assertEqual(len(grid.within(self.points, 3.0)), 0)
+
+
+class MoleculeHelpersTester(unittest.TestCase):
+    """
+    Test the OEMol coordinate and residue helpers
+    """
+
+    def test_deleted_atoms(self):
+        mol = oechem.OEMol()
+        oechem.OESmilesToMol(mol, 'CCO')
+        mol.SetCoords(oechem.OEFloatArray([float(i) for i in range(3 * mol.GetMaxAtomIdx())]))
+        mol.DeleteAtom(mol.GetAtom(oechem.OEHasAtomIdx(1)))
+
+        atoms, xyz = atom_coords(mol)
+        self.assertEqual(atoms.tolist(), [0, 2])
+        self.assertTrue(np.array_equal(xyz, coords_by_idx(mol)[[0, 2]]))
+        self.assertEqual(xyz[1].tolist(), [6.0, 7.0, 8.0])
+
+        residues = residue_index(mol)
+        self.assertEqual(residues[1], -1)
+        self.assertTrue(np.all(residues[[0, 2]] >= 0))
+
+
+if __name__ == "__main__":
+        unittest.main()
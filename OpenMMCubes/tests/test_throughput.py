@@ -0,0 +1,48 @@
+import io
+import unittest
+from openeye import oechem
+from OpenMMCubes import throughput
+
+
+class ThroughputTester(unittest.TestCase):
+    """
+    Test the throughput SD data and the run report
+    """
+
+    def test_set_throughput(self):
+        mol = oechem.OEMol()
+
+        throughput.set_throughput(mol, 'prod', steps=5000, ns=0.01, wall_time=10.0, cpu_time=40.0,
+                                  atoms=30000, platform='CPU')
+        record = throughput.get_throughput(mol)['prod']
+        self.assertEqual(record['steps'], 5000)
+        self.assertAlmostEqual(record['ns_per_day'], 86.4)
+        self.assertEqual(record['platform'], 'CPU')
+
+        # The following production segment is appended
+        throughput.set_throughput(mol, 'prod', steps=5000, ns=0.01, wall_time=30.0, cpu_time=120.0,
+                                  atoms=30000, platform='CPU', append=True)
+        record = throughput.get_throughput(mol)['prod']
+        self.assertEqual(record['steps'], 10000)
+        self.assertAlmostEqual(record['ns_per_day'], 43.2)
+
+    def test_report(self):
+        stages = {'min': [], 'prod': []}
+        for idx in range(3):
+            mol = oechem.OEMol()
+            throughput.set_throughput(mol, 'min', steps=0, ns=0.0, wall_time=36.0, cpu_time=72.0,
+                                      atoms=30000, platform='CUDA')
+            throughput.set_throughput(mol, 'prod', steps=5000, ns=0.01, wall_time=360.0 * (idx + 1),
+                                      cpu_time=360.0, atoms=30000, platform='CUDA')
+            for stage, record in throughput.get_throughput(mol).items():
+                stages[stage].append(record)
+
+        stream = io.StringIO()
+        total_wall, total_cpu = throughput.report(stages, stream=stream)
+        self.assertAlmostEqual(total_wall, 0.03 + 0.6)
+        self.assertAlmostEqual(total_cpu, 0.06 + 0.3)
+        self.assertIn('prod', stream.getvalue())
+
+
+if __name__ == "__main__":
+        unittest.main()
@@ -0,0 +1,188 @@
+"""
+Report of the MD throughput and cost of a floe run. The MD cubes attach
+to each molecule the throughput of each stage as <stage>_<quantity> SD
+data: simulated ns, steps, wall and cpu time in seconds, atoms, platform,
+ns/day and steps/s. This tool reads the output molecules and prints the
+per stage throughput distributions and the total core hours
+
+Ex: python -m OpenMMCubes.throughput output.oeb.gz
+"""
+from __future__ import print_function
+import sys
+import argparse
+import numpy as np
+from collections import OrderedDict
+from openeye import oechem
+
+# Throughput quantities and their types
+QUANTITIES = OrderedDict([('ns', float),
+                          ('steps', int),
+                          ('wall_time', float),
+                          ('cpu_time', float),
+                          ('atoms', int),
+                          ('platform', str),
+                          ('ns_per_day', float),
+                          ('steps_per_s', float)])
+
+# Quantities summed up by the consecutive runs of the same stage
+_ADDITIVE = ['ns', 'steps', 'wall_time', 'cpu_time']
+
+
+def get_throughput(molecule):
+    """
+    Returns the throughput records attached to the molecule
+
+    Parameters
+    ----------
+    molecule : OEMol
+        The molecule
+
+    Returns
+    -------
+    records : OrderedDict
+        The stage name: quantity dictionary records
+    """
+    tags = dict((dp.GetTag(), dp.GetValue()) for dp in oechem.OEGetSDDataPairs(molecule))
+
+    records = OrderedDict()
+    for tag in tags:
+        if not tag.endswith('_wall_time'):
+            continue
+        stage = tag[:-len('_wall_time')]
+        try:
+            records[stage] = OrderedDict((name, cast(tags[stage + '_' + name]))
+                                         for name, cast in QUANTITIES.items())
+        except (KeyError, ValueError):
+            continue
+
+    return records
+
+
+def set_throughput(molecule, stage, steps, ns, wall_time, cpu_time, atoms, platform, append=False):
+    """
+    Attaches the throughput of an MD stage to the molecule as SD data
+
+    Parameters
+    ----------
+    molecule : OEMol
+        The molecule
+    stage : str
+        The stage name used as SD tag prefix
+    steps : int
+        The number of integration steps
+    ns : float
+        The simulated time in ns
+    wall_time : float
+        The wall time in seconds
+    cpu_time : float
+        The cpu time of the process in seconds
+    atoms : int
+        The number of atoms
+    platform : str
+        The OpenMM platform name
+    append : bool
+        If True the run is added to the throughput already attached,
+        e.g. by the previous production segments
+
+    Returns
+    -------
+    record : OrderedDict
+        The attached throughput record
+    """
+    record = OrderedDict([('ns', ns), ('steps', steps), ('wall_time', wall_time), ('cpu_time', cpu_time),
+                          ('atoms', atoms), ('platform', platform)])
+
+    previous = get_throughput(molecule).get(stage) if append else None
+    if previous is not None:
+        for name in _ADDITIVE:
+            record[name] += previous[name]
+
+    wall_time = max(record['wall_time'], 1e-9)
+    record['ns_per_day'] = record['ns'] * 86400.0 / wall_time
+    record['steps_per_s'] = record['steps'] / wall_time
+
+    for name, value in record.items():
+        if QUANTITIES[name] is float:
+            value = '{:.4f}'.format(value)
+        oechem.OESetSDData(molecule, '{}_{}'.format(stage, name), str(value))
+
+    return record
+
+
+def collect(fnames):
+    """
+    Collects the throughput records of the molecules in the passed files
+
+    Returns
+    -------
+    stages : OrderedDict
+        The stage name: list of records dictionary
+    """
+    stages = OrderedDict()
+
+    for fname in fnames:
+        ifs = oechem.oemolistream()
+        if not ifs.open(fname):
+            oechem.OEThrow.Fatal('Unable to open the file {}'.format(fname))
+        for mol in ifs.GetOEMols():
+            for stage, record in get_throughput(mol).items():
+                stages.setdefault(stage, []).append(record)
+        ifs.close()
+
+    return stages
+
+
+def report(stages, stream=None):
+    """
+    Writes the per stage throughput distributions and the
+    total wall and cpu hours to the selected stream
+    """
+    if stream is None:
+        stream = sys.stdout
+
+    stream.write('{:<16} {:>6} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9} {:>10} {:>10}  {}\n'.format(
+        'stage', 'items', 'atoms', 'min', 'median', 'mean', 'p90', 'max', 'wall (h)', 'cpu (h)', 'platforms'))
+    stream.write('{:<16} {:>6} {:>8} {:^49}\n'.format('', '', '', 'ns/day'))
+
+    total_wall = total_cpu = 0.0
+
+    for stage, records in stages.items():
+        wall = sum(r['wall_time'] for r in records) / 3600.0
+        cpu = sum(r['cpu_time'] for r in records) / 3600.0
+        total_wall += wall
+        total_cpu += cpu
+
+        atoms = int(np.median([r['atoms'] for r in records]))
+        platforms = sorted(set(r['platform'] for r in records))
+
+        rates = np.array([r['ns_per_day'] for r in records if r['ns'] > 0.0])
+        if len(rates):
+            stats = '{:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(rates.min(), np.median(rates), rates.mean(),
+                                                                         np.percentile(rates, 90), rates.max())
+        else:
+            stats = '{:>9} {:>9} {:>9} {:>9} {:>9}'.format(*['-'] * 5)
+
+        stream.write('{:<16} {:>6} {:>8} {} {:>10.3f} {:>10.3f}  {}\n'.format(stage[:16], len(records), atoms, stats,
+                                                                         wall, cpu, ','.join(platforms)))
+
+    stream.write('\nTotal wall hours: {:.3f}\n'.format(total_wall))
+    stream.write('Total core hours: {:.3f}\n'.format(total_cpu))
+    stream.flush()
+
+    return total_wall, total_cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report the MD throughput of a floe run')
+    parser.add_argument('files', nargs='+', help='Output molecule files e.g. run.oeb.gz')
+    args = parser.parse_args()
+
+    stages = collect(args.files)
+    if not stages:
+        oechem.OEThrow.Fatal('No throughput data found in {}'.format(', '.join(args.files)))
+
+    report(stages)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,12 @@
-import io, os, base64, parmed, tarfile
+import io, os, base64, copyreg, json, time, parmed, tarfile
 import numpy as np
+from OpenMMCubes import payload, store, compression
+from OpenMMCubes.reporters import EnergyReporter
+from parmed.geometry import box_lengths_and_angles_to_vectors
 from sys import stdout
 from tempfile import NamedTemporaryFile
+from collections import OrderedDict
+from collections.abc import Mapping
 from openeye import oechem
 from floe.api.orion import in_orion, StreamingDataset, upload_file
 from simtk import unit, openmm
@@ -20,8 +25,27 @@ class PackageOEMol(object):
     OpenMM State, and the log file for the state reporter. Objects are attached
     to the OEMol as generic data. Attachment of the ParmEd Structure is required
     in order to preserve the SMIRFF parameters during complex generation.
+
+    The ParmEd Structure is attached split in two parts: the immutable topology
+    and parameters, stored once under their content hash, and a small
+    coordinates block (coordinates, velocities and box) rewritten at each stage.
     """
 
+    # Tags used to attach the split ParmEd Structure
+    TOPOLOGY_TAG = 'OEMDDataTopology'
+    TOPOLOGY_HASH_TAG = 'OEMDDataTopologyHash'
+    STORE_TAG = 'OEMDDataTopologyStore'
+    COORDS_TAG = 'OEMDDataCoords'
+    SPLIT_TAGS = [TOPOLOGY_TAG, TOPOLOGY_HASH_TAG, STORE_TAG, COORDS_TAG]
+    # Tag used to attach the cached serialized OpenMM System
+    SYSTEM_TAG = 'OEMDDataSystem'
+    # Tag used to attach the energy table recorded by the EnergyReporter
+    ENERGIES_TAG = 'OEMDDataEnergies'
+    # Tags used to carry the references to the output files of the completed
+    # production segments and the store where the files are saved
+    SEGMENT_FILES_TAG = 'OEMDDataSegmentFiles'
+    SEGMENT_STORE_TAG = 'OEMDDataSegmentStore'
+
     def getTags(molecule):
         return list(molecule.GetData().keys())
 
@@ -48,18 +72,92 @@ class PackageOEMol(object):
         decoded_obj = base64.b64decode(data)
         return pickle.loads(decoded_obj)
 
-    def encodeStruct(structure):
-        """Encode the ParmEd Structure by retrieving the current state as a dict.
-        Dict contains objects and cannot be encoded directly by pickle."""
-        struct_dict = structure.__getstate__()
-        return PackageOEMol.encodePyObj(struct_dict)
+    def encodeTopology(structure):
+        """Encode the ParmEd Structure topology and parameters to BYTES.
+        The per-atom coordinates and velocities are not included."""
+        struct_dict = dict(structure.__getstate__())
+        # Drop the coordinate cache, the coordinates are stored as array block
+        for k, v in struct_dict.items():
+            if v is not None and v is getattr(structure, '_coordinates', None):
+                struct_dict[k] = None
+
+        pkl = io.BytesIO()
+        _CoordinateFreePickler(pkl, pickle.HIGHEST_PROTOCOL).dump(struct_dict)
+        return pkl.getvalue()
+
+    def decodeTopology(data):
+        """Decode the topology and parameters into a Structure
+        object without coordinates"""
+        if payload.is_payload(data):
+            data = payload.decode(data)['topology']
+        struct = parmed.structure.Structure()
+        struct.__setstate__(pickle.loads(data))
+        return struct
+
+    def coordBlocks(structure):
+        """Returns the coordinates, velocities and box of the ParmEd Structure
+        as a list of (name, float64 array) payload blocks."""
+        blocks = []
+        if structure.atoms and structure.coordinates is not None:
+            blocks.append(('coordinates', np.asarray(structure.get_coordinates('all'), dtype=np.float64)))
+        if structure.velocities is not None:
+            blocks.append(('velocities', np.asarray(structure.velocities, dtype=np.float64)))
+        if structure.box is not None:
+            blocks.append(('box', np.asarray(structure.box, dtype=np.float64)))
+        return blocks
+
+    def setCoordBlocks(structure, blocks):
+        """Sets the coordinates, velocities and box payload blocks
+        on the ParmEd Structure"""
+        if 'coordinates' in blocks:
+            structure.coordinates = blocks['coordinates']
+        if 'velocities' in blocks:
+            structure.velocities = blocks['velocities']
+        if 'box' in blocks:
+            structure.box = blocks['box']
+        return structure
+
+    def encodeStruct(structure, codec=None):
+        """Encode the whole ParmEd Structure in a single binary payload.
+        The topology and parameters are pickled without the per-atom
+        coordinates and velocities, which are stored as raw float64 arrays
+        together with the box."""
+        blocks = [('structure', PackageOEMol.encodeTopology(structure))]
+        blocks.extend(PackageOEMol.coordBlocks(structure))
+        return payload.encode(blocks, codec=codec)
 
     def decodeStruct(data):
-        """Decode the Base64 encoded Structure dict, then
-        load into an empty Structure object."""
+        """Decode the binary payload or the legacy Base64 encoded
+        Structure dict, then load into an empty Structure object."""
         struct = parmed.structure.Structure()
-        struct.__setstate__(PackageOEMol.decodePyObj(data))
-        return struct
+
+        if not payload.is_payload(data):
+            struct.__setstate__(PackageOEMol.decodePyObj(data))
+            return struct
+
+        blocks = payload.decode(data)
+        struct.__setstate__(pickle.loads(blocks['structure']))
+        return PackageOEMol.setCoordBlocks(struct, blocks)
+
+    def encodeCoords(structure, topology_hash, codec=None):
+        """Encode the per-stage coordinates, velocities and box of the
+        ParmEd Structure together with the hash of the related topology"""
+        blocks = [('topology_hash', topology_hash.encode('ascii'))]
+        blocks.extend(PackageOEMol.coordBlocks(structure))
+        return payload.encode(blocks, codec=codec)
+
+    def encodeRefPositions(positions, codec=None):
+        """Encode the reference positions as a float64 array in angstroms"""
+        if unit.is_quantity(positions):
+            positions = positions.value_in_unit(unit.angstroms)
+        return payload.encode([('ref_positions', np.asarray(positions, dtype=np.float64))], codec=codec)
+
+    def decodeRefPositions(data):
+        """Decode the reference positions. Legacy payloads are returned
+        as pickled, a list of OpenMM Quantity objects"""
+        if not payload.is_payload(data):
+            return PackageOEMol.decodePyObj(data)
+        return unit.Quantity(payload.decode(data)['ref_positions'], unit.angstroms)
 
     def encodeSimData(simulation):
         """Pulls the OpenMM State object and log file reproting energies from the
@@ -76,9 +174,12 @@ class PackageOEMol(object):
                                             getEnergy=True,
                                             enforcePeriodicBox=True)
 
-        # Get the proper log file name from the reporters, not stdout
+        # Get the energy table or the proper log file name from the reporters, not stdout
+        logfname = None
         for rep in simulation.reporters:
-            if isinstance(rep, app.statedatareporter.StateDataReporter):
+            if isinstance(rep, EnergyReporter):
+                tag_data['Energies'] = rep.encode()
+            elif isinstance(rep, app.statedatareporter.StateDataReporter):
                 if rep._out is stdout:
                     pass
                 else:
@@ -91,8 +192,9 @@ class PackageOEMol(object):
         # Return dictionary with encoded data
         tag_data['State'] = PackageOEMol.encodeOpenMM(state)
         tag_data['Structure'] = PackageOEMol.encodeStruct(structure)
-        with open(logfname) as log:
-            tag_data['Log'] = log.read()
+        if logfname is not None:
+            with open(logfname) as log:
+                tag_data['Log'] = log.read()
         return tag_data
 
     def checkSDData(molecule):
@@ -114,25 +216,72 @@ class PackageOEMol(object):
             # print('Found tags: {}'.format(intersect))
             return True
 
+    @classmethod
+    def checkStructure(cls, molecule):
+        """ Checks if OEMol has a ParmEd Structure attached, either as a single
+        Structure tag or split in topology and coordinates """
+        oetags = cls.getTags(molecule)
+        if 'Structure' in oetags or cls.COORDS_TAG in oetags:
+            return True
+        raise RuntimeError('Missing {} in tagged data'.format(['Structure']))
+
+    @classmethod
+    def getTopologyHash(cls, molecule):
+        """ Returns the hash of the topology attached to the OEMol or
+        None if the Structure has been attached in the single tag format """
+        if not molecule.HasData(oechem.OEGetTag(cls.TOPOLOGY_HASH_TAG)):
+            return None
+        return str(cls.getData(molecule, cls.TOPOLOGY_HASH_TAG))
+
+    @classmethod
+    def getTopology(cls, molecule, topology_hash):
+        """ Returns the encoded topology attached to the OEMol or
+        retrieved from the local content-addressed store """
+        if molecule.HasData(oechem.OEGetTag(cls.TOPOLOGY_TAG)):
+            return cls.getData(molecule, cls.TOPOLOGY_TAG)
+
+        store_path = None
+        if molecule.HasData(oechem.OEGetTag(cls.STORE_TAG)):
+            store_path = str(cls.getData(molecule, cls.STORE_TAG))
+
+        return store.ContentStore(store_path).get(topology_hash)
+
+    @classmethod
+    def getStructure(cls, molecule):
+        """ Rebuilds the ParmEd Structure attached to the OEMol """
+        if not molecule.HasData(oechem.OEGetTag(cls.COORDS_TAG)):
+            return cls.decodeStruct(cls.getData(molecule, 'Structure'))
+
+        blocks = payload.decode(cls.getData(molecule, cls.COORDS_TAG))
+        topology_hash = blocks['topology_hash'].decode('ascii')
+        struct = cls.decodeTopology(cls.getTopology(molecule, topology_hash))
+        return cls.setCoordBlocks(struct, blocks)
+
+    @classmethod
+    def decodeTag(cls, molecule, tag):
+        """ Decodes a single tag attached to OEMol """
+        if 'Structure' == tag:
+            return cls.getStructure(molecule)
+        data = cls.getData(molecule, tag)
+        if 'State' == tag:
+            data = cls.decodeOpenMM(data)
+        if 'OEMDDataRefPositions' == tag:
+            data = cls.decodeRefPositions(data)
+        if 'Log' == tag:
+            data = io.StringIO(data)
+        return data
+
     @classmethod
     def unpack(cls, molecule, tags=None):
-        """ Decodes the data attached to OEMol. Return as dictionary """
-        tag_data = {}
+        """ Decodes the data attached to OEMol. Return as a read-only dictionary
+        where each tag is decoded on first access and then cached """
         # Default to decode all
         if tags is None:
             tags = cls.getTags(molecule)
-        for tag in tags:
-            data = cls.getData(molecule, tag)
-            if 'State' == tag:
-                data = cls.decodeOpenMM(data)
-            if 'Structure' == tag:
-                data = cls.decodeStruct(data)
-            if 'OEMDDataRefPositions' == tag:
-                data = cls.decodePyObj(data)
-            if 'Log' == tag:
-                data = io.StringIO(data)
-            tag_data[tag] = data
-        return tag_data
+            # The split topology and coordinates are returned as Structure
+            if cls.COORDS_TAG in tags:
+                tags = [t for t in tags if t not in cls.SPLIT_TAGS] + ['Structure']
+        return LazyTagData(cls, molecule, tags)
 
     @classmethod
     def dump(cls, molecule, tags=None, outfname=None, tarxz=True):
@@ -200,23 +349,211 @@ class PackageOEMol(object):
             cleanup(totar)
 
     @classmethod
-    def pack(cls, molecule, data):
+    def packTopology(cls, molecule, structure, store_path=None, codec=None):
+        """ Encodes the ParmEd Structure topology and parameters and attaches
+        them to the OEMol under their content hash. If a store path is provided
+        the topology is saved in the local content-addressed store and only
+        the hash is attached. Returns the topology hash."""
+        topology = cls.encodeTopology(structure)
+        # The hash does not depend on the selected codec
+        topology_hash = store.digest(topology)
+        topology = payload.encode([('topology', topology)], codec=codec)
+
+        if store_path:
+            content_store = store.ContentStore(store_path)
+            content_store.put(topology, key=topology_hash)
+            molecule.SetData(oechem.OEGetTag(cls.STORE_TAG), content_store.path)
+            molecule.DeleteData(oechem.OEGetTag(cls.TOPOLOGY_TAG))
+        else:
+            molecule.SetData(oechem.OEGetTag(cls.TOPOLOGY_TAG), topology)
+            molecule.DeleteData(oechem.OEGetTag(cls.STORE_TAG))
+
+        molecule.SetData(oechem.OEGetTag(cls.TOPOLOGY_HASH_TAG), topology_hash)
+        return topology_hash
+
+    @classmethod
+    def packCoords(cls, molecule, structure, topology_hash, codec=None):
+        """ Attaches the ParmEd Structure coordinates, velocities and box
+        to the OEMol. The topology is expected to be already attached. """
+        molecule.SetData(oechem.OEGetTag(cls.COORDS_TAG), cls.encodeCoords(structure, topology_hash, codec=codec))
+        # Remove a possible stale single tag Structure
+        molecule.DeleteData(oechem.OEGetTag('Structure'))
+        return molecule
+
+    @classmethod
+    def pack(cls, molecule, data, store_path=None, codec=None):
         """ Encodes the ParmEd Structure or if provided the OpenMM Simulation object,
         this will extract the State and the log file from the state reporter and
         attach them to the OEMol as generic data. Returns the OEMol with attached data."""
 
         tag_data = {}
-        # Attach (base64) encoded ParmEd Structure.
+        # Attach the ParmEd Structure split in topology and coordinates
         if isinstance(data, parmed.structure.Structure):
-            molecule.SetData(oechem.OEGetTag('Structure'), cls.encodeStruct(data))
+            topology_hash = cls.packTopology(molecule, data, store_path=store_path, codec=codec)
+            cls.packCoords(molecule, data, topology_hash, codec=codec)
 
         # Attach the encoded OpenMM State and log file from the Simulation.
         if isinstance(data, openmm.app.simulation.Simulation):
             tag_data = cls.encodeSimData(data)
+            # The Simulation Structure replaces a split topology and coordinates,
+            # which getStructure would otherwise prefer
+            for tag in cls.SPLIT_TAGS:
+                molecule.DeleteData(oechem.OEGetTag(tag))
             for k, v in tag_data.items():
                 molecule.SetData(oechem.OEGetTag(k), v)
         return molecule
 
+    @classmethod
+    def getSystem(cls, molecule, key):
+        """ Returns the (serialized OpenMM System XML, createSystem time) pair cached
+        under the passed key, either attached to the OEMol or saved in the local
+        content-addressed store. Returns None if the System is not cached """
+        data = None
+
+        if molecule.HasData(oechem.OEGetTag(cls.SYSTEM_TAG)):
+            data = cls.getData(molecule, cls.SYSTEM_TAG)
+        elif molecule.HasData(oechem.OEGetTag(cls.STORE_TAG)):
+            content_store = store.ContentStore(str(cls.getData(molecule, cls.STORE_TAG)))
+            if key in content_store:
+                data = content_store.get(key)
+
+        if data is None:
+            return None
+
+        blocks = payload.decode(data)
+        if blocks['key'].decode('ascii') != key:
+            return None
+
+        return blocks['system'].decode('utf-8'), float(blocks['create_time'][0])
+
+    @classmethod
+    def packSystem(cls, molecule, key, system, create_time, codec=None):
+        """ Caches the serialized OpenMM System under the passed key. The System
+        is saved in the local content-addressed store if the OEMol topology has
+        been stored there, otherwise it is attached to the OEMol """
+        data = payload.encode([('key', key.encode('ascii')),
+                               ('system', cls.encodeOpenMM(system)),
+                               ('create_time', np.array([create_time]))], codec=codec)
+
+        if molecule.HasData(oechem.OEGetTag(cls.STORE_TAG)):
+            store.ContentStore(str(cls.getData(molecule, cls.STORE_TAG))).put(data, key=key)
+        else:
+            molecule.SetData(oechem.OEGetTag(cls.SYSTEM_TAG), data)
+        return molecule
+
+    @classmethod
+    def packEnergies(cls, molecule, table, codec=None):
+        """ Attaches the energy table (column name: numpy array) recorded by
+        the EnergyReporter to the OEMol as binary payload """
+        molecule.SetData(oechem.OEGetTag(cls.ENERGIES_TAG), payload.encode(list(table.items()), codec=codec))
+        return molecule
+
+    @classmethod
+    def getEnergies(cls, molecule):
+        """ Returns the energy table attached to the OEMol as column name: numpy
+        array dictionary. Returns None if no table is attached """
+        if not molecule.HasData(oechem.OEGetTag(cls.ENERGIES_TAG)):
+            return None
+        return payload.decode(cls.getData(molecule, cls.ENERGIES_TAG))
+
+    @classmethod
+    def packSegmentFiles(cls, molecule, fnames, store_path=None):
+        """ Saves the passed output files in the content-addressed store and
+        attaches to the OEMol only their references (file name: key). The
+        references are added to the ones already attached """
+        if molecule.HasData(oechem.OEGetTag(cls.SEGMENT_STORE_TAG)):
+            store_path = str(cls.getData(molecule, cls.SEGMENT_STORE_TAG))
+        content_store = store.ContentStore(store_path)
+
+        refs = cls.getSegmentFiles(molecule)
+        for fn in fnames:
+            refs[fn] = content_store.put_file(fn)
+
+        molecule.SetData(oechem.OEGetTag(cls.SEGMENT_STORE_TAG), content_store.path)
+        molecule.SetData(oechem.OEGetTag(cls.SEGMENT_FILES_TAG),
+                         payload.encode([(fn, key.encode('ascii')) for fn, key in refs.items()]))
+        return molecule
+
+    @classmethod
+    def getSegmentFiles(cls, molecule):
+        """ Returns the references to the output files attached to the OEMol as
+        file name: store key dictionary. Returns an empty dictionary if no file
+        is attached """
+        if not molecule.HasData(oechem.OEGetTag(cls.SEGMENT_FILES_TAG)):
+            return OrderedDict()
+        blocks = payload.decode(cls.getData(molecule, cls.SEGMENT_FILES_TAG))
+        return OrderedDict([(fn, key.decode('ascii')) for fn, key in blocks.items()])
+
+    @classmethod
+    def restoreSegmentFiles(cls, molecule):
+        """ Copies the output files referenced by the OEMol from the store to the
+        local disk, removes them from the store and detaches the references """
+        refs = cls.getSegmentFiles(molecule)
+        if refs:
+            content_store = store.ContentStore(str(cls.getData(molecule, cls.SEGMENT_STORE_TAG)))
+            for fn, key in refs.items():
+                content_store.get_file(key, fn)
+            for key in refs.values():
+                content_store.remove(key)
+
+        molecule.DeleteData(oechem.OEGetTag(cls.SEGMENT_FILES_TAG))
+        molecule.DeleteData(oechem.OEGetTag(cls.SEGMENT_STORE_TAG))
+        return molecule
+
+
+class LazyTagData(Mapping):
+    """
+    Read-only dictionary returned by PackageOEMol.unpack. The data attached
+    to the OEMol is decoded only when the related tag is accessed and the
+    decoded object is cached for the following accesses
+    """
+
+    def __init__(self, packer, molecule, tags):
+        self._packer = packer
+        self._molecule = molecule
+        self._tags = list(tags)
+        self._decoded = {}
+
+    def __getitem__(self, tag):
+        if tag not in self._tags:
+            raise KeyError(tag)
+        if tag not in self._decoded:
+            self._decoded[tag] = self._packer.decodeTag(self._molecule, tag)
+        return self._decoded[tag]
+
+    def __iter__(self):
+        return iter(self._tags)
+
+    def __len__(self):
+        return len(self._tags)
+
+
+class _CoordinateFreePickler(pickle.Pickler):
+    """
+    Pickler used to serialize the ParmEd Structure state without the per-atom
+    coordinates and velocities, which are stored separately as arrays
+    """
+    dispatch_table = copyreg.dispatch_table.copy()
+
+
+def _reduce_atom(atom):
+    state = atom.__getstate__() if hasattr(atom, '__getstate__') else atom.__dict__
+    state = dict(state)
+    for key in ('xx', 'xy', 'xz', 'vx', 'vy', 'vz'):
+        state.pop(key, None)
+    return copyreg.__newobj__, (type(atom),), state
+
+
+def _atom_classes(cls=parmed.Atom):
+    yield cls
+    for sub in cls.__subclasses__():
+        for c in _atom_classes(sub):
+            yield c
+
+
+for _atom_cls in _atom_classes():
+    _CoordinateFreePickler.dispatch_table[_atom_cls] = _reduce_atom
+
 
 def cleanup(tmpfiles):
     for tmp in tmpfiles:
@@ -250,31 +587,85 @@ def get_data_filename(package_root, relative_path):
     return fn
 
 
+# Atom index maps cached by topology hash
+_ATOM_MAPS = OrderedDict()
+_ATOM_MAPS_SIZE = 32
+
+
+def oemol_atom_map(molecule):
+    """
+    Returns the array of the OEMol atom indexes in the OpenMM topology order:
+    the i-th topology atom is the OEMol atom with index atom_map[i]. The map
+    is computed once per topology when the molecule carries a topology hash
+    """
+    topology_hash = PackageOEMol.getTopologyHash(molecule)
+
+    if topology_hash is not None and topology_hash in _ATOM_MAPS:
+        atom_map = _ATOM_MAPS[topology_hash]
+        if len(atom_map) == molecule.NumAtoms():
+            _ATOM_MAPS.move_to_end(topology_hash)
+            return atom_map
+
+    atom_map = np.fromiter((at.GetIdx() for at in molecule.GetAtoms()), dtype=np.int64,
+                           count=molecule.NumAtoms())
+
+    if topology_hash is not None:
+        _ATOM_MAPS[topology_hash] = atom_map
+        if len(_ATOM_MAPS) > _ATOM_MAPS_SIZE:
+            _ATOM_MAPS.popitem(last=False)
+
+    return atom_map
+
+
+def get_oemol_coords(molecule):
+    """
+    Returns the OEMol coordinates as a (natoms, 3) numpy array
+    in angstroms ordered as the OpenMM topology
+    """
+    coords = oechem.OEFloatArray(3 * molecule.GetMaxAtomIdx())
+    molecule.GetCoords(coords)
+    xyz = np.fromiter(coords, dtype=np.float64, count=3 * molecule.GetMaxAtomIdx()).reshape(-1, 3)
+    return xyz[oemol_atom_map(molecule)]
+
+
+def set_oemol_coords(molecule, xyz):
+    """
+    Sets the OEMol coordinates from a (natoms, 3) numpy array
+    in angstroms ordered as the OpenMM topology
+
+    Parameters
+    ----------
+    molecule : OEMol
+        The molecule to update
+    xyz : numpy array or OpenMM Quantity
+        The coordinates. Quantities are converted to angstroms
+    """
+    if unit.is_quantity(xyz):
+        xyz = xyz.value_in_unit(unit.angstroms)
+    xyz = np.asarray(xyz, dtype=np.float64)
+
+    atom_map = oemol_atom_map(molecule)
+    if len(atom_map) != len(xyz):
+        raise ValueError("OEMol and coordinates mismatch atom numbers: {} vs {}".format(len(atom_map), len(xyz)))
+
+    coords = np.zeros((molecule.GetMaxAtomIdx(), 3), dtype=np.float64)
+    coords[atom_map] = xyz
+    molecule.SetCoords(oechem.OEFloatArray(coords.ravel().tolist()))
+
+    return molecule
+
+
 def getPositionsFromOEMol(molecule):
-    positions = unit.Quantity(
-        np.zeros([molecule.NumAtoms(), 3], np.float32), unit.angstroms)
-    coords = molecule.GetCoords()
-    for index in range(molecule.NumAtoms()):
-        positions[index, :] = unit.Quantity(coords[index], unit.angstroms)
-    return positions
+    return unit.Quantity(get_oemol_coords(molecule).astype(np.float32), unit.angstroms)
 
 
 def combinePositions(proteinPositions, molPositions):
     # Concatenate positions arrays (ensures same units)
     positions_unit = unit.angstroms
-    positions0_dimensionless = np.array(proteinPositions / positions_unit)
-    positions1_dimensionless = np.array(molPositions / positions_unit)
-    coordinates = np.vstack(
-        (positions0_dimensionless, positions1_dimensionless))
-    natoms = len(coordinates)
-    positions = np.zeros([natoms, 3], np.float32)
-    for index in range(natoms):
-            (x, y, z) = coordinates[index]
-            positions[index, 0] = x
-            positions[index, 1] = y
-            positions[index, 2] = z
-    positions = unit.Quantity(positions, positions_unit)
-    return positions
+    positions0_dimensionless = np.asarray(proteinPositions.value_in_unit(positions_unit))
+    positions1_dimensionless = np.asarray(molPositions.value_in_unit(positions_unit))
+    positions = np.vstack((positions0_dimensionless, positions1_dimensionless)).astype(np.float32)
+    return unit.Quantity(positions, positions_unit)
 
 
 def download_dataset_to_file(dataset_id):
@@ -310,23 +701,120 @@ def dump_query(prefix, name, qmol, receptor):
     return tag, query_file
 
 
+def system_key(topology_hash, **settings):
+    """
+    Returns the System cache key built from the topology hash
+    and the System creation settings
+    """
+    return store.digest(json.dumps([topology_hash, sorted(settings.items())]).encode('utf-8'))
+
+
+def create_system(structure, molecule=None, logger=None, cache=True, codec=None,
+                  nonbondedMethod='PME', nonbondedCutoff=10.0, constraints='HBonds',
+                  hydrogenMass=None, rigidWater=True):
+    """
+    This function creates the OpenMM System from the ParmEd Structure. If the
+    molecule carries a topology hash, the serialized System is cached under a
+    key made of the topology hash and the System settings and is deserialized
+    instead of running createSystem when the same key is requested again
+
+    Parameters
+    ----------
+    structure : Parmed structure
+        The parametrized system
+    molecule : OEMol or None
+        The molecule the structure has been extracted from. It is used to
+        retrieve and attach the cached System
+    logger : logger or None
+        The logger used to report the time spent or saved
+    cache : bool
+        If False the System is always created and never cached
+    codec : str, compression.Codec or None
+        The codec used to compress the cached System. The System XML
+        is always compressed, gzip is used if no codec is selected
+    nonbondedMethod : str
+        NoCutoff, CutoffNonPeriodic, CutoffPeriodic, PME, or Ewald
+    nonbondedCutoff : float
+        The non-bonded cutoff in angstroms
+    constraints : str
+        None, HBonds, HAngles, or AllBonds
+    hydrogenMass : float or None
+        If not None the hydrogen masses in amu used for mass repartitioning
+    rigidWater : bool
+        If True water molecules are made rigid. This is the ParmEd default
+
+    Returns
+    -------
+    system : OpenMM System
+        The OpenMM System
+    """
+    settings = dict(nonbondedMethod=nonbondedMethod,
+                    nonbondedCutoff=float(nonbondedCutoff),
+                    constraints=constraints,
+                    hydrogenMass=None if hydrogenMass is None else float(hydrogenMass),
+                    rigidWater=bool(rigidWater))
+
+    topology_hash = None
+    if cache and molecule is not None:
+        topology_hash = PackageOEMol.getTopologyHash(molecule)
+
+    key = None
+    if topology_hash is not None:
+        key = system_key(topology_hash, **settings)
+        start = time.time()
+        cached = PackageOEMol.getSystem(molecule, key)
+        if cached is not None:
+            system = PackageOEMol.decodeOpenMM(cached[0])
+            elapsed = time.time() - start
+            if logger is not None:
+                logger.info('System cache hit: System deserialized in {:.2f} s, '
+                            '{:.2f} s saved with respect to createSystem'.format(elapsed, cached[1] - elapsed))
+            return system
+
+    start = time.time()
+    system = structure.createSystem(nonbondedMethod=getattr(app, nonbondedMethod),
+                                    nonbondedCutoff=nonbondedCutoff * unit.angstroms,
+                                    constraints=None if constraints == 'None' else getattr(app, constraints),
+                                    rigidWater=rigidWater,
+                                    hydrogenMass=None if hydrogenMass is None else hydrogenMass * unit.amu,
+                                    removeCMMotion=False)
+    create_time = time.time() - start
+
+    if logger is not None:
+        logger.info('System cache {}: createSystem took {:.2f} s'.format('miss' if key else 'disabled',
+                                                                       create_time))
+    if key is not None:
+        codec = compression.get_codec(codec)
+        if not codec.id:
+            codec = compression.GzipCodec()
+        PackageOEMol.packSystem(molecule, key, system, create_time, codec=codec)
+
+    return system
+
+
 class MDData(object):
     """
     This class is used to handle the MDData recovered
     from the Parmed structure attached to the OEMol()
     passed between cubes. The class is designed to
-    track changes in the pointed Parmed structure
+    track changes in the pointed Parmed structure.
+    The Parmed structure is decoded only on first access,
+    while the positions, box, velocities and IDTag accessors
+    are served by the coordinates block and never touch
+    the topology and parameter tables
     
     Notes
     -----
     Exposed variables: 
         structure : Parmed structure
         positions : If present system atom positions otherwise None
+        positions_array : If present system atom positions as numpy array in A otherwise None
         topology : Parmed topology
         box : If present box vectors otherwise None
         parameters : Parmed force field parameters
         velocities : If present system atom velocities otherwise None
         ref_positions : If available System reference atom positions otherwise None
+        IDTag : If present the molecule IDTag otherwise None
     
     Examples
     --------
@@ -344,56 +832,97 @@ class MDData(object):
         mol : OEMol() OpenEye Molecule object
             the moleculur system
         """
-        # Initialization Reference positions
-        self.ref_positions = None
-        
-        # Try to extract the Parmed structure 
+        self.__molecule__ = mol
+        self.__parmed_structure__ = None
+        self.__parameters__ = None
+        self.__coords__ = None
+
+        self.IDTag = mol.GetData('IDTag') if mol.HasData(oechem.OEGetTag('IDTag')) else None
+
+        # Check the Parmed structure presence and decode the coordinates block
         try:
-            dic = PackageOEMol.unpack(mol, tags=['Structure'])
-            self.__parmed_structure__ = dic['Structure']
+            PackageOEMol.checkStructure(mol)
+            # Hash of the immutable topology, None for single tag Structures
+            self.__topology_hash__ = PackageOEMol.getTopologyHash(mol)
+            if self.__topology_hash__ is not None:
+                self.__coords__ = payload.decode(PackageOEMol.getData(mol, PackageOEMol.COORDS_TAG))
+            else:
+                self.__parmed_structure__ = PackageOEMol.getStructure(mol)
         except Exception as e:
             raise RuntimeError('The molecular system does not have a parmed structure attached: {}'.format(e))
 
         # Check atom positions
-        if not self.__parmed_structure__.positions:
+        if self.positions_array is None:
             raise RuntimeError('Atom positions are not defined')
-        
-        # Try to extract the Reference Positions
-        try:
-            dic = PackageOEMol.unpack(mol, tags=['OEMDDataRefPositions'])
-            # Reference Positions are a list of OpenMM Quantity objects
-            self.ref_positions = dic['OEMDDataRefPositions']
-        except:
+
+    def _structure(self):
+        if self.__parmed_structure__ is None:
+            self.__parmed_structure__ = PackageOEMol.getStructure(self.__molecule__)
+            # From now on the structure is the only source of truth
+            self.__coords__ = None
+        return self.__parmed_structure__
+
+    def _ref_positions(self):
+        mol = self.__molecule__
+        if not mol.HasData(oechem.OEGetTag('OEMDDataRefPositions')):
             RuntimeWarning('The molecular system does not have any Reference Positions attached')
-            
+            return None
+        return PackageOEMol.decodeRefPositions(PackageOEMol.getData(mol, 'OEMDDataRefPositions'))
+
     def __getattr__(self, attrname):
         if attrname == "structure":
-            return self.__parmed_structure__
+            return self._structure()
         elif attrname == "topology":
-            return self.__parmed_structure__.topology
+            return self._structure().topology
         elif attrname == "positions":
-            return self.__parmed_structure__.positions
+            return self._structure().positions
+        elif attrname == "positions_array":
+            if self.__coords__ is not None:
+                coords = self.__coords__.get('coordinates')
+                if coords is None:
+                    return None
+                # The first frame is the current one
+                return coords[0] if coords.ndim == 3 else coords
+            return self._structure().coordinates
         elif attrname == "velocities":
-            if self.__parmed_structure__.velocities is None:
+            if self.__coords__ is not None:
+                velocities = self.__coords__.get('velocities')
+            else:
+                velocities = self._structure().velocities
+            if velocities is None:
                 return None
             else:
                 # Parmed stores the velocities as a numpy array in unit of angstrom/picoseconds
-                return self.__parmed_structure__.velocities * unit.angstrom/unit.picosecond
+                return velocities * unit.angstrom/unit.picosecond
         elif attrname == "box":
-            return self.__parmed_structure__.box_vectors
+            if self.__coords__ is not None:
+                if 'box' not in self.__coords__:
+                    return None
+                return box_lengths_and_angles_to_vectors(*self.__coords__['box'])
+            return self._structure().box_vectors
         elif attrname == "parameters":
-            return parmed.ParameterSet.from_structure(self.__parmed_structure__)
+            if self.__parameters__ is None:
+                self.__parameters__ = parmed.ParameterSet.from_structure(self._structure())
+            return self.__parameters__
+        elif attrname == "ref_positions":
+            # Decoded on first access, then stored as a regular attribute
+            self.ref_positions = self._ref_positions()
+            return self.ref_positions
         else:
             raise AttributeError('The required attribute is not defined: {}'.format(attrname))
    
-    def packMDData(self, mol):
+    def packMDData(self, mol, codec=None):
         """
-        This method attached the Parmed structure to the passed OEMol()
+        This method attached the Parmed structure to the passed OEMol().
+        If the molecule already carries the topology the structure has been
+        extracted from, only the coordinates, velocities and box are rewritten
 
         Parameters
         ----------
         mol : OEMol() OpenEye Molecule object
             the molecular system
+        codec : str, compression.Codec or None
+            The codec used to compress the attached data
 
         Returns
         -------
@@ -402,13 +931,26 @@ class MDData(object):
         """
         try:
             # Try to attach the Parmed structure to the molecule. The molecule is changed in place
-            mol = PackageOEMol.pack(mol, self.__parmed_structure__)
+            if (self.__topology_hash__ is not None and
+                    self.__topology_hash__ == PackageOEMol.getTopologyHash(mol)):
+                if self.__parmed_structure__ is None:
+                    # The structure has never been decoded: the coordinates are unchanged
+                    if mol is not self.__molecule__:
+                        mol.SetData(oechem.OEGetTag(PackageOEMol.COORDS_TAG),
+                                    PackageOEMol.getData(self.__molecule__, PackageOEMol.COORDS_TAG))
+                else:
+                    mol = PackageOEMol.packCoords(mol, self.__parmed_structure__, self.__topology_hash__,
+                                                  codec=codec)
+            else:
+                mol = PackageOEMol.pack(mol, self._structure(), codec=codec)
         except Exception as e:
             raise RuntimeError('It was not possible to attached '
                                'the parmed structure to the molecule {}'.format(e))
-            
-        if self.ref_positions:
-            packedpos = PackageOEMol.encodePyObj(self.ref_positions)
-            mol.SetData(oechem.OEGetTag('OEMDDataRefPositions'), packedpos)
+
+        # The reference positions never change along the stages
+        if not mol.HasData(oechem.OEGetTag('OEMDDataRefPositions')):
+            if self.ref_positions is not None:
+                packedpos = PackageOEMol.encodeRefPositions(self.ref_positions, codec=codec)
+                mol.SetData(oechem.OEGetTag('OEMDDataRefPositions'), packedpos)
         
-        return mol
\ No newline at end of file
+        return mol
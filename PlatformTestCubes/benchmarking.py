@@ -24,21 +24,35 @@ def timeIntegration(context, steps, initialSteps):
 
 
 def run_platform_benchmarks(options, stream=None):
+    """
+    Runs the benchmarks on all the available platforms and returns
+    the list of the results of the successful runs, see run_benchmark
+    """
     if stream is None:
         stream = sys.stdout
+    results = []
     platforms = [mm.Platform.getPlatform(i) for i in range(mm.Platform.getNumPlatforms())]
     for platform in platforms:
         stream.write("Performing Benchmarks on {}\n".format(platform.getName()))
         options.__dict__.update({"platform": platform})
         for test_type in ["rf", "pme", "amoebagk", "amoebapme"]:
             stream.write("Running Benchmarks for {} using {}\n".format(test_type, platform.getName()))
-            run_benchmark("{}_{}".format(platform.getName(), test_type), options, stream=stream)
+            result = run_benchmark("{}_{}".format(platform.getName(), test_type), options, stream=stream)
+            if result is not None:
+                result['test'] = test_type
+                results.append(result)
             stream.write("\n\n")  # add line breaks to seperate runs
             stream.flush()
+    return results
 
 
 def run_benchmark(test_name, options, stream=None):
-    """Perform a single benchmarking simulation."""
+    """Perform a single benchmarking simulation.
+
+    Returns a dictionary with the platform name and precision, the System,
+    the ns/day and the forces on the starting positions in kJ/mol/nm, or
+    None if the platform could not run the test.
+    """
     if stream is None:
         stream = sys.stdout
     benchmark_data_dir = os.path.join(os.path.dirname(__file__), "data")
@@ -125,8 +139,10 @@ def run_benchmark(test_name, options, stream=None):
     except Exception as e:
         stream.write("Unable to Benchmark '{}'\n".format(test_name))
         stream.write("ERROR: {}\n".format(str(e)))
-        return
+        return None
     context.setPositions(pdb.positions)
+    forces = context.getState(getForces=True).getForces(asNumpy=True).value_in_unit(
+        unit.kilojoules_per_mole / unit.nanometer)
     context.setVelocitiesToTemperature(300 * unit.kelvin)
     steps = 20
     while True:
@@ -138,4 +154,7 @@ def run_benchmark(test_name, options, stream=None):
         else:
             steps = int(steps * options.seconds / time)
     stream.write('Integrated %d steps in %g seconds\n' % (steps, time))
-    stream.write('%g ns/day\n' % (dt * steps * 86400 / time).value_in_unit(unit.nanoseconds))
+    ns_per_day = (dt * steps * 86400 / time).value_in_unit(unit.nanoseconds)
+    stream.write('%g ns/day\n' % ns_per_day)
+    return {'platform': options.platform.getName(), 'precision': properties.get('Precision'),
+            'system': system, 'ns_per_day': ns_per_day, 'forces': forces}
@@ -7,6 +7,7 @@ from floe.api import(
 
 from PlatformTestCubes import testInstallation
 from PlatformTestCubes.benchmarking import run_platform_benchmarks
+from OpenMMCubes import platforms
 
 
 # For parallel, import and inherit from ParallelOEMolComputeCube
@@ -79,11 +80,18 @@ class BenchmarkCube(SourceCube):
         default="single",
         choices=["single", "mixed", "double"]
     )
+    update_benchmark_cache = parameter.BooleanParameter(
+        "update_benchmark_cache",
+        default=True,
+        title="Update the host benchmark cache used by the Auto-Benchmarked platform"
+    )
 
     def __iter__(self):
         stream = StringIO()
         stream.write("Benchmarking Results:\n")
-        run_platform_benchmarks(self.args, stream=stream)
+        results = run_platform_benchmarks(self.args, stream=stream)
+        if self.args.update_benchmark_cache:
+            platforms.record_platform_benchmarks(results)
         stream.flush()
         stream.seek(0)
         output = stream.readline()
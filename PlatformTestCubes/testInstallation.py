@@ -16,6 +16,20 @@ else:
     simtk_import_failed = False
 
 
+def median_force_error(forces1, forces2):
+    """
+    Returns the median of the per atom relative force differences
+    |f1 - f2| / |f1| between two sets of forces computed on the same
+    positions, e.g. by two different platforms
+    """
+    errors = []
+    for f1, f2 in zip(forces1, forces2):
+        d = f1-f2
+        error = sqrt((d[0]*d[0]+d[1]*d[1]+d[2]*d[2])/(f1[0]*f1[0]+f1[1]*f1[1]+f1[2]*f1[2]))
+        errors.append(error)
+    return sorted(errors)[len(errors)//2]
+
+
 def run_tests( pdbFilename):
     """
     Runs a set of tests to determine which platforms are available and tests the
@@ -76,14 +90,9 @@ def run_tests( pdbFilename):
         for i in range(numPlatforms):
             for j in range(i):
                 if forces[i] is not None and forces[j] is not None:
-                    errors = []
-                    for f1, f2 in zip(forces[i], forces[j]):
-                        d = f1-f2
-                        error = sqrt((d[0]*d[0]+d[1]*d[1]+d[2]*d[2])/(f1[0]*f1[0]+f1[1]*f1[1]+f1[2]*f1[2]))
-                        errors.append(error)
                     outStr += ('\n{0} vs. {1}: {2:g}'.format(Platform.getPlatform(j).getName(),
                                                   Platform.getPlatform(i).getName(),
-                                                  sorted(errors)[len(errors)//2]))
+                                                  median_force_error(forces[i], forces[j])))
     outStr += '\n'
     return outStr
 
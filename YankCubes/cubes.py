@@ -8,7 +8,8 @@ from LigPrepCubes.ports import CustomMoleculeInputPort, CustomMoleculeOutputPort
 from YankCubes.utils import molecule_is_charged, download_dataset_to_file
 from yank.experiment import ExperimentBuilder
 from oeommtools import utils as oeommutils
-from oeommtools import data_utils
+from OpenMMCubes import utils as pack_utils
+from OpenMMCubes import profiling
 from simtk.openmm import app, unit, XmlSerializer, openmm
 import os
 import numpy as np
@@ -140,6 +141,12 @@ class YankHydrationCube(ParallelOEMolComputeCube):
     verbose = parameter.BooleanParameter('verbose', default=False,
                                      help_text="Print verbose YANK logging output")
 
+    port_codec = parameter.StringParameter('port_codec', default='gzip',
+                                 choices=['none', 'gzip', 'zstd', 'lz4'],
+                                 help_text="Compression codec used to encode the output molecules. "
+                                           "Codecs other than gzip require custom molecule input "
+                                           "ports downstream")
+
     def construct_yaml(self, **kwargs):
         # Make substitutions to YAML here.
         # TODO: Can we override YAML parameters without having to do string substitutions?
@@ -167,6 +174,12 @@ class YankHydrationCube(ParallelOEMolComputeCube):
         kB = unit.BOLTZMANN_CONSTANT_kB * unit.AVOGADRO_CONSTANT_NA # Boltzmann constant
         self.kT = kB * (self.args.temperature * unit.kelvin)
 
+        # Select the output ports compression codec
+        self.success.set_codec(self.args.port_codec)
+        self.failure.set_codec(self.args.port_codec)
+
+        self.profiler = profiling.Profiler(self.name)
+
     def process(self, mol, port):
         kT_in_kcal_per_mole = self.kT.value_in_unit(unit.kilocalories_per_mole)
 
@@ -175,6 +188,8 @@ class YankHydrationCube(ParallelOEMolComputeCube):
 
         with TemporaryDirectory() as output_directory:
             try:
+                self.profiler.start(title)
+
                 # Print out which molecule we are processing
                 self.log.info('Processing {} in directory {}.'.format(title, output_directory))
 
@@ -195,13 +210,15 @@ class YankHydrationCube(ParallelOEMolComputeCube):
                 from yank.yamlbuild import YamlBuilder
                 yaml = self.construct_yaml(output_directory=output_directory)
                 yaml_builder = YamlBuilder(yaml)
-                yaml_builder.build_experiments()
+                with self.profiler.phase('yank'):
+                    yaml_builder.build_experiments()
                 self.log.info('Ran Yank experiments for molecule {}.'.format(title))
 
                 # Analyze the hydration free energy.
                 from yank.analyze import estimate_free_energies
-                (Deltaf_ij_solvent, dDeltaf_ij_solvent) = estimate_free_energies(netcdf.Dataset(output_directory + '/experiments/solvent1.nc', 'r'))
-                (Deltaf_ij_vacuum,  dDeltaf_ij_vacuum)  = estimate_free_energies(netcdf.Dataset(output_directory + '/experiments/solvent2.nc', 'r'))
+                with self.profiler.phase('analysis'):
+                    (Deltaf_ij_solvent, dDeltaf_ij_solvent) = estimate_free_energies(netcdf.Dataset(output_directory + '/experiments/solvent1.nc', 'r'))
+                    (Deltaf_ij_vacuum,  dDeltaf_ij_vacuum)  = estimate_free_energies(netcdf.Dataset(output_directory + '/experiments/solvent2.nc', 'r'))
                 DeltaG_hydration = Deltaf_ij_vacuum[0,-1] - Deltaf_ij_solvent[0,-1]
                 dDeltaG_hydration = np.sqrt(Deltaf_ij_vacuum[0,-1]**2 + Deltaf_ij_solvent[0,-1]**2)
 
@@ -211,6 +228,7 @@ class YankHydrationCube(ParallelOEMolComputeCube):
                 self.log.info('Analyzed and stored hydration free energy for molecule {}.'.format(title))
 
                 # Emit molecule to success port.
+                self.profiler.finish(mol)
                 self.success.emit(mol)
 
             except Exception as e:
@@ -220,6 +238,7 @@ class YankHydrationCube(ParallelOEMolComputeCube):
                 # we should capture that and attach it to the failed molecule.
                 self.log.error(traceback.format_exc())
                 mol.SetData('error', str(e))
+                self.profiler.finish(mol)
                 # Return failed molecule
                 self.failure.emit(mol)
 
@@ -366,6 +385,12 @@ class YankBindingCube(ParallelOEMolComputeCube):
     verbose = parameter.BooleanParameter('verbose', default=False,
                                      help_text="Print verbose YANK logging output")
 
+    port_codec = parameter.StringParameter('port_codec', default='gzip',
+                                 choices=['none', 'gzip', 'zstd', 'lz4'],
+                                 help_text="Compression codec used to encode the output molecules. "
+                                           "Codecs other than gzip require custom molecule input "
+                                           "ports downstream")
+
     def construct_yaml(self, **kwargs):
         # Make substitutions to YAML here.
         # TODO: Can we override YAML parameters without having to do string substitutions?
@@ -395,6 +420,12 @@ class YankBindingCube(ParallelOEMolComputeCube):
         kB = unit.BOLTZMANN_CONSTANT_kB * unit.AVOGADRO_CONSTANT_NA # Boltzmann constant
         self.kT = kB * (self.args.temperature * unit.kelvin)
 
+        # Select the output ports compression codec
+        self.success.set_codec(self.args.port_codec)
+        self.failure.set_codec(self.args.port_codec)
+
+        self.profiler = profiling.Profiler(self.name)
+
         # Load receptor
         self.receptor = oechem.OEMol()
         receptor_filename = download_dataset_to_file(self.args.receptor)
@@ -410,6 +441,8 @@ class YankBindingCube(ParallelOEMolComputeCube):
 
         with TemporaryDirectory() as output_directory:
             try:
+                self.profiler.start(title)
+
                 # Print out which molecule we are processing
                 self.log.info('Processing {} in {}.'.format(title, output_directory))
 
@@ -438,14 +471,16 @@ class YankBindingCube(ParallelOEMolComputeCube):
                 from yank.yamlbuild import YamlBuilder
                 yaml = self.construct_yaml(output_directory=output_directory)
                 yaml_builder = YamlBuilder(yaml)
-                yaml_builder.build_experiments()
+                with self.profiler.phase('yank'):
+                    yaml_builder.build_experiments()
                 self.log.info('Ran Yank experiments for molecule {}.'.format(title))
 
                 # Analyze the binding free energy
                 # TODO: Use yank.analyze API for this
                 from YankCubes.analysis import analyze
                 store_directory = os.path.join(output_directory, 'experiments')
-                [DeltaG_binding, dDeltaG_binding] = analyze(store_directory)
+                with self.profiler.phase('analysis'):
+                    [DeltaG_binding, dDeltaG_binding] = analyze(store_directory)
 
                 """
                 # Extract trajectory (DEBUG)
@@ -469,6 +504,7 @@ class YankBindingCube(ParallelOEMolComputeCube):
                 self.log.info('Analyzed and stored binding free energy for molecule {}.'.format(title))
 
                 # Emit molecule to success port.
+                self.profiler.finish(mol)
                 self.success.emit(mol)
 
             except Exception as e:
@@ -478,6 +514,7 @@ class YankBindingCube(ParallelOEMolComputeCube):
                 # we should capture that and attach it to the failed molecule.
                 self.log.error(traceback.format_exc())
                 mol.SetData('error', str(e))
+                self.profiler.finish(mol)
                 # Return failed molecule
                 self.failure.emit(mol)
 
@@ -547,10 +584,13 @@ class YankSolvationFECube(ParallelOEMolComputeCube):
     def begin(self):
         self.opt = vars(self.args)
         self.opt['Logger'] = self.log
+        self.profiler = profiling.Profiler(self.name)
 
     def process(self, solvated_system, port):
 
         try:
+            self.profiler.start(solvated_system.GetTitle())
+
             # The copy of the dictionary option as local variable
             # is necessary to avoid filename collisions due to
             # the parallel cube processes
@@ -573,7 +613,8 @@ class YankSolvationFECube(ParallelOEMolComputeCube):
                 opt.update(new_args)
 
             # Extract the MD data
-            mdData = data_utils.MDData(solvated_system)
+            with self.profiler.phase('decode'):
+                mdData = pack_utils.MDData(solvated_system)
             solvated_structure = mdData.structure
 
             # Extract the ligand parmed structure
@@ -584,10 +625,11 @@ class YankSolvationFECube(ParallelOEMolComputeCube):
             solute.SetTitle(solvated_system.GetTitle())
 
             # Create the solvated and vacuum system
-            solvated_omm_sys = solvated_structure.createSystem(nonbondedMethod=app.PME,
-                                                               nonbondedCutoff=opt['nonbondedCutoff'] * unit.angstroms,
-                                                               constraints=app.HBonds,
-                                                               removeCMMotion=False)
+            solvated_omm_sys = pack_utils.create_system(solvated_structure, molecule=solvated_system,
+                                                        logger=self.log,
+                                                        nonbondedMethod='PME',
+                                                        nonbondedCutoff=opt['nonbondedCutoff'],
+                                                        constraints='HBonds')
 
             solute_omm_sys = solute_structure.createSystem(nonbondedMethod=app.NoCutoff,
                                                            constraints=app.HBonds,
@@ -640,24 +682,28 @@ class YankSolvationFECube(ParallelOEMolComputeCube):
                                                  solute_xml_fn=solute_omm_sys_serialized_fn))
 
                 # Run Yank
-                yaml_builder.run_experiments()
+                with self.profiler.phase('yank'):
+                    yaml_builder.run_experiments()
 
                 exp_dir = os.path.join(output_directory, "experiments")
 
                 # Calculate solvation free energy, solvation Enthalpy and their errors
-                DeltaG_solvation, dDeltaG_solvation, DeltaH, dDeltaH = yankutils.analyze_directory(exp_dir)
+                with self.profiler.phase('analysis'):
+                    DeltaG_solvation, dDeltaG_solvation, DeltaH, dDeltaH = yankutils.analyze_directory(exp_dir)
 
                 # # Add result to the original molecule in kcal/mol
                 oechem.OESetSDData(solute, 'DG_yank_solv', str(DeltaG_solvation))
                 oechem.OESetSDData(solute, 'dG_yank_solv', str(dDeltaG_solvation))
 
             # Emit the ligand
+            self.profiler.finish(solute)
             self.success.emit(solute)
 
         except Exception as e:
             # Attach an error message to the molecule that failed
             self.log.error(traceback.format_exc())
             solvated_system.SetData('error', str(e))
+            self.profiler.finish(solvated_system)
             # Return failed mol
             self.failure.emit(solvated_system)
 
@@ -793,10 +839,12 @@ class YankBindingFECube(ParallelOEMolComputeCube):
     def begin(self):
         self.opt = vars(self.args)
         self.opt['Logger'] = self.log
+        self.profiler = profiling.Profiler(self.name)
 
     def process(self, solvated_system, port):
 
         try:
+            self.profiler.start(solvated_system[1].GetTitle())
             opt = dict(self.opt)
 
             # Extract the solvated ligand and the solvated complex
@@ -816,22 +864,27 @@ class YankBindingFECube(ParallelOEMolComputeCube):
                 opt.update(new_args)
 
             # Extract the MD data
-            mdData_ligand = data_utils.MDData(solvated_ligand)
-            solvated_ligand_structure = mdData_ligand.structure
+            with self.profiler.phase('decode'):
+                mdData_ligand = pack_utils.MDData(solvated_ligand)
+                solvated_ligand_structure = mdData_ligand.structure
 
-            mdData_complex = data_utils.MDData(solvated_complex)
-            solvated_complex_structure = mdData_complex.structure
+                mdData_complex = pack_utils.MDData(solvated_complex)
+                solvated_complex_structure = mdData_complex.structure
 
             # Create the solvated OpenMM systems
-            solvated_complex_omm_sys = solvated_complex_structure.createSystem(nonbondedMethod=app.PME,
-                                                                               nonbondedCutoff=opt['nonbondedCutoff'] * unit.angstroms,
-                                                                               constraints=app.HBonds,
-                                                                               removeCMMotion=False)
-
-            solvated_ligand_omm_sys = solvated_ligand_structure.createSystem(nonbondedMethod=app.PME,
-                                                                             nonbondedCutoff=opt['nonbondedCutoff'] * unit.angstroms,
-                                                                             constraints=app.HBonds,
-                                                                             removeCMMotion=False)
+            solvated_complex_omm_sys = pack_utils.create_system(solvated_complex_structure,
+                                                                molecule=solvated_complex,
+                                                                logger=self.log,
+                                                                nonbondedMethod='PME',
+                                                                nonbondedCutoff=opt['nonbondedCutoff'],
+                                                                constraints='HBonds')
+
+            solvated_ligand_omm_sys = pack_utils.create_system(solvated_ligand_structure,
+                                                               molecule=solvated_ligand,
+                                                               logger=self.log,
+                                                               nonbondedMethod='PME',
+                                                               nonbondedCutoff=opt['nonbondedCutoff'],
+                                                               constraints='HBonds')
 
             # Write out all the required files and set-run the Yank experiment
             with TemporaryDirectory() as output_directory:
@@ -874,11 +927,13 @@ class YankBindingFECube(ParallelOEMolComputeCube):
                     ligand_resname=opt['ligand_resname']))
 
                 # Run Yank
-                yaml_builder.run_experiments()
+                with self.profiler.phase('yank'):
+                    yaml_builder.run_experiments()
 
                 exp_dir = os.path.join(output_directory, "experiments")
 
-                DeltaG_binding, dDeltaG_binding, DeltaH, dDeltaH = yankutils.analyze_directory(exp_dir)
+                with self.profiler.phase('analysis'):
+                    DeltaG_binding, dDeltaG_binding, DeltaH, dDeltaH = yankutils.analyze_directory(exp_dir)
 
                 protein, ligand, water, excipients = oeommutils.split(solvated_ligand,
                                                                       ligand_res_name=opt['ligand_resname'])
@@ -886,12 +941,14 @@ class YankBindingFECube(ParallelOEMolComputeCube):
                 oechem.OESetSDData(ligand, 'DG_yank_binding', str(DeltaG_binding))
                 oechem.OESetSDData(ligand, 'dG_yank_binding', str(dDeltaG_binding))
 
+            self.profiler.finish(ligand)
             self.success.emit(ligand)
 
         except Exception as e:
             # Attach an error message to the molecule that failed
             self.log.error(traceback.format_exc())
             solvated_system[1].SetData('error', str(e))
+            self.profiler.finish(solvated_system[1])
             # Return failed mol
             self.failure.emit(solvated_system[1])
 
@@ -0,0 +1,50 @@
+import os
+import tempfile
+from unittest import TestCase
+from OpenMMCubes import utils
+from floes.openmm_MDprod_segmented import job as floe
+from openeye import oechem
+import numpy as np
+
+
+class SegmentedProdTestCase(TestCase):
+    """ Invocation: python -m pytest floes/floe_tests/test_MDprod_segmented.py -s
+
+    This test is not marked as slow: it runs the floe, whose production cube
+    output port is connected to its own intake, and it is part of the CI runs
+    """
+
+    def test_segmented_prod(self):
+
+        complex_path = utils.get_data_filename('examples', 'data/pP38_lp38a_2x_complex.oeb.gz')
+        segment_store = tempfile.mkdtemp()
+        run_args = [
+            '--system', complex_path,
+            '--picosec', '0.6',
+            '--segments', '3',
+            '--segment_store', segment_store,
+            '--temperature', '300',
+            '--pressure', '1',
+            '--trajectory_interval', '50',
+            '--reporter_interval', '50',
+            '--suffix', 'prod',
+            '--ofs-data_out', 'success.oeb',
+            '--fail-data_out', 'fail.oeb',
+        ]
+
+        # The floe terminates once the last segment leaves the loop
+        self.assertFalse(floe.run(args=run_args))
+
+        mol = oechem.OEMol()
+        with oechem.oemolistream('success.oeb') as ifs:
+            self.assertTrue(oechem.OEReadMolecule(ifs, mol))
+        self.assertFalse(mol.HasData(oechem.OEGetTag('MDSegment')))
+        self.assertFalse(mol.HasData(oechem.OEGetTag(utils.PackageOEMol.SEGMENT_FILES_TAG)))
+
+        # Each of the 3 segments has gone through the cycle: 100 steps and 2 records per segment
+        energies = utils.PackageOEMol.getEnergies(mol)
+        self.assertEqual(list(energies['step']), [50, 100, 150, 200, 250, 300])
+        self.assertTrue(np.all(energies['temperature'] > 0.0))
+
+        # The segment files are removed from the store once merged
+        self.assertEqual(os.listdir(segment_store), [])
@@ -67,6 +67,8 @@ ff.promote_parameter('protein_forcefield', promoted_name='protein_ff', default='
 ff.promote_parameter('solvent_forcefield', promoted_name='solvent_ff', default='tip3p.xml')
 ff.promote_parameter('ligand_forcefield', promoted_name='ligand_ff', default='GAFF2')
 ff.promote_parameter('other_forcefield', promoted_name='other_ff', default='GAFF2')
+ff.promote_parameter('topology_store', promoted_name='topology_store', default='',
+                     description='Local content-addressed store for the parametrized topology')
 
 # Output the prepared systems
 complex_prep_ofs = OEMolOStreamCube('complex_prep_ofs', title='ComplexSetUpOut')
@@ -119,6 +121,8 @@ equil1.promote_parameter('reporter_interval', promoted_name='eq1_reporter_interv
                          description='Reporter saving interval')
 equil1.promote_parameter('outfname', promoted_name='eq1_outfname', default='equil1',
                          description='Equilibration suffix name')
+equil1.promote_parameter('adaptive', promoted_name='eq1_adaptive', default=False,
+                         description='Stop the equilibration once converged. The run time is the maximum time')
 
 # NPT Equilibration stage 2
 equil2 = OpenMMnptCube('equil2', title='equil2')
@@ -134,6 +138,8 @@ equil2.promote_parameter('reporter_interval', promoted_name='eq2_reporter_interv
                          description='Reporter saving interval')
 equil2.promote_parameter('outfname', promoted_name='eq2_outfname', default='equil2',
                          description='Equilibration suffix name')
+equil2.promote_parameter('adaptive', promoted_name='eq2_adaptive', default=False,
+                         description='Stop the equilibration once converged. The run time is the maximum time')
 
 # NPT Equilibration stage 3
 equil3 = OpenMMnptCube('equil3', title='equil3')
@@ -149,6 +155,8 @@ equil3.promote_parameter('reporter_interval', promoted_name='eq3_reporter_interv
                          description='Reporter saving interval')
 equil3.promote_parameter('outfname', promoted_name='eq3_outfname', default='equil3',
                          description='Equilibration suffix name')
+equil3.promote_parameter('adaptive', promoted_name='eq3_adaptive', default=False,
+                         description='Stop the equilibration once converged. The run time is the maximum time')
 
 # Output the equilibrated systems
 equilibration_ofs = OEMolOStreamCube("equilibration_ofs", title='EquilibrationOut')
@@ -165,6 +173,8 @@ prod.promote_parameter('reporter_interval', promoted_name='prod_reporter_interva
                        description='Reporter saving interval')
 prod.promote_parameter('outfname', promoted_name='prod_outfname', default='prod',
                        description='Equilibration suffix name')
+prod.promote_parameter('trajectory_subset', promoted_name='prod_trajectory_subset', default='',
+                       description='Mask selection of the atoms written in the trajectory e.g. protein or ligand')
 
 ofs = OEMolOStreamCube('ofs', title='OFS-Success')
 ofs.set_parameters(backend='s3')
@@ -0,0 +1,117 @@
+from __future__ import unicode_literals
+from floe.api import WorkFloe, OEMolOStreamCube
+from OpenMMCubes.cubes import OpenMMprotocolCube
+from ComplexPrepCubes.cubes import HydrationCube, ComplexPrep, ForceFieldPrep, SolvationCube
+from ComplexPrepCubes.port import ProteinReader
+from LigPrepCubes.ports import LigandReader
+from LigPrepCubes.cubes import LigChargeCube
+
+
+job = WorkFloe('Merk Frosst Fused MD Protocol')
+
+job.description = """
+Set up an OpenMM complex then minimize, warm up, equilibrate and run the production of a system.
+All the MD stages are run by a single cube in the same OpenMM Context
+
+Ex: python floes/openmm_MDprotocol.py --ligands ligands.oeb --protein protein.oeb --ofs-data_out prep.oeb
+
+Parameters:
+-----------
+ligands (file): oeb file of ligand posed in the protein active site.
+protein (file): oeb file of the protein structure, assumed to be pre-prepared
+
+Optionals:
+-----------
+
+Outputs:
+--------
+ofs: Outputs the systems after the MD production run
+"""
+
+job.classification = [['Complex Setup', 'FrosstMD']]
+job.tags = [tag for lists in job.classification for tag in lists]
+
+# Ligand setting
+iligs = LigandReader("LigandReader", title="Ligand Reader")
+iligs.promote_parameter("data_in", promoted_name="ligands", title="Ligand Input File", description="Ligand file name")
+
+
+chargelig = LigChargeCube("LigCharge")
+chargelig.promote_parameter('max_conformers', promoted_name='max_conformers',
+                            description="Set the max number of conformers per ligand", default=800)
+
+# Protein Reading cube. The protein prefix parameter is used to select a name for the
+# output system files
+iprot = ProteinReader("ProteinReader")
+iprot.promote_parameter("data_in", promoted_name="protein", title='Protein Input File',
+                        description="Protein file name")
+iprot.promote_parameter("protein_prefix", promoted_name="protein_prefix",
+                        default='PRT', description="Protein prefix")
+
+# Complex cube used to assemble the ligands and the solvated protein
+complx = ComplexPrep("Complex")
+
+# The solvation cube is used to solvate the system and define the ionic strength of the solution
+# solvate = HydrationCube("Hydration")
+
+solvate = SolvationCube("Hydration")
+solvate.promote_parameter('density', promoted_name='density', default=1.25,
+                          description="Solution density in g/ml")
+solvate.promote_parameter('close_solvent', promoted_name='close_solvent', default=True,
+                          description='The solvent molecules will be placed very close to the solute')
+solvate.promote_parameter('salt_concentration', promoted_name='salt_concentration', default=50.0,
+                          description='Salt concentration (Na+, Cl-) in millimolar')
+
+# Force Field Application
+ff = ForceFieldPrep("ForceField")
+ff.promote_parameter('protein_forcefield', promoted_name='protein_ff', default='amber99sbildn.xml')
+ff.promote_parameter('solvent_forcefield', promoted_name='solvent_ff', default='tip3p.xml')
+ff.promote_parameter('ligand_forcefield', promoted_name='ligand_ff', default='GAFF2')
+ff.promote_parameter('other_forcefield', promoted_name='other_ff', default='GAFF2')
+ff.promote_parameter('topology_store', promoted_name='topology_store', default='',
+                     description='Local content-addressed store for the parametrized topology')
+
+# Output the prepared systems
+complex_prep_ofs = OEMolOStreamCube('complex_prep_ofs', title='ComplexSetUpOut')
+complex_prep_ofs.set_parameters(backend='s3')
+complex_prep_ofs.set_parameters(data_out=iprot.promoted_parameters['protein_prefix']['default']+'_SetUp.oeb.gz')
+
+# Fused MD protocol: minimization, warm up, three equilibration stages and production
+md = OpenMMprotocolCube('MDProtocol', title='MD Protocol')
+md.promote_parameter('stages', promoted_name='stages',
+                     description='JSON list of the MD protocol stages')
+
+# Output the minimized systems
+minimization_ofs = OEMolOStreamCube('minimization_ofs', title='MinimizationOut')
+minimization_ofs.set_parameters(backend='s3')
+minimization_ofs.set_parameters(data_out=iprot.promoted_parameters['protein_prefix']['default']+'_Minimization.oeb.gz')
+
+# Output the equilibrated systems
+equilibration_ofs = OEMolOStreamCube("equilibration_ofs", title='EquilibrationOut')
+equilibration_ofs.set_parameters(backend='s3')
+equilibration_ofs.set_parameters(data_out=iprot.promoted_parameters['protein_prefix']['default']+'_Equilibration.oeb.gz')
+
+ofs = OEMolOStreamCube('ofs', title='OFS-Success')
+ofs.set_parameters(backend='s3')
+
+fail = OEMolOStreamCube('fail', title='OFS-Failure')
+fail.set_parameters(backend='s3')
+fail.set_parameters(data_out='fail.oeb.gz')
+
+job.add_cubes(iprot, iligs, chargelig, complx, solvate, ff, complex_prep_ofs,
+              md, minimization_ofs, equilibration_ofs, ofs, fail)
+
+iprot.success.connect(complx.system_port)
+iligs.success.connect(chargelig.intake)
+chargelig.success.connect(complx.intake)
+complx.success.connect(solvate.intake)
+solvate.success.connect(ff.intake)
+ff.success.connect(md.intake)
+ff.success.connect(complex_prep_ofs.intake)
+md.minimization.connect(minimization_ofs.intake)
+md.equilibration.connect(equilibration_ofs.intake)
+md.success.connect(ofs.intake)
+md.failure.connect(fail.intake)
+
+if __name__ == "__main__":
+    job.run()